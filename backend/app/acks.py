@@ -0,0 +1,86 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .stats import LatencyHistogram
+
+
+class AckTracker:
+    """
+    Корреляция команд и подтверждений: каждая команда получает id,
+    ожидающий Future лежит в таблице, пока сим не пришлёт {"type": "ack", "id": ...}
+    или не истечёт таймаут. RTT копится в гистограммах по каждому линку.
+    """
+
+    def __init__(self, timeout_s: float = 0.5, id_base: int = 0):
+        self.timeout_s = timeout_s
+        self._ids = itertools.count(id_base + 1)
+        self.pending: Dict[int, Tuple[asyncio.Future, float, str]] = {}
+        # id отправленной команды → id заменённых ею (coalesced), ack общий
+        self.followers: Dict[int, List[int]] = {}
+        self.rtt: Dict[str, LatencyHistogram] = {}
+        self.timeouts: Dict[str, int] = {}
+        self.late_acks = 0
+
+    def register(self, link: str = "sim") -> Tuple[int, asyncio.Future]:
+        cmd_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[cmd_id] = (fut, time.monotonic(), link)
+        return cmd_id, fut
+
+    def chain(self, old_id: int, new_id: int):
+        """Команду old_id заменила new_id до отправки: ack new_id подтверждает обе."""
+        self.followers.setdefault(new_id, []).extend([old_id, *self.followers.pop(old_id, ())])
+
+    def resolve(self, cmd_id: int, foreign: Optional[List[int]] = None) -> Optional[float]:
+        """
+        RTT ack'а (и заменённых им команд). foreign — список для id, которых здесь не
+        ждут: с шиной это команды других воркеров, им ack пересылается, а не считается поздним.
+        """
+        for old_id in self.followers.pop(cmd_id, ()):
+            self.resolve(old_id, foreign)
+        entry = self.pending.pop(cmd_id, None)
+        if entry is None:
+            if foreign is not None:
+                foreign.append(cmd_id)
+                return None
+            # ack пришёл после таймаута или на чужой id
+            self.late_acks += 1
+            return None
+        fut, t0, link = entry
+        rtt_ms = (time.monotonic() - t0) * 1000.0
+        self.rtt.setdefault(link, LatencyHistogram()).record(rtt_ms)
+        if not fut.done():
+            fut.set_result(rtt_ms)
+        return rtt_ms
+
+    async def wait(self, cmd_id: int, fut: asyncio.Future, timeout_s: Optional[float] = None) -> Optional[float]:
+        """RTT в мс или None по таймауту/обрыву линка."""
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout_s or self.timeout_s)
+        except (asyncio.TimeoutError, ConnectionError):
+            entry = self.pending.pop(cmd_id, None)
+            self.followers.pop(cmd_id, None)
+            if entry is not None:
+                link = entry[2]
+                self.timeouts[link] = self.timeouts.get(link, 0) + 1
+            return None
+
+    def fail_link(self, link: str = "sim"):
+        """Линк оборвался — все ожидающие команды этого линка завершаются ошибкой."""
+        for cmd_id, (fut, _, l) in list(self.pending.items()):
+            if l == link:
+                self.pending.pop(cmd_id, None)
+                self.followers.pop(cmd_id, None)
+                if not fut.done():
+                    fut.set_exception(ConnectionError(f"{link} disconnected"))
+
+    def stats(self) -> Dict[str, Dict]:
+        links = set(self.rtt) | set(self.timeouts)
+        out = {}
+        for link in sorted(links):
+            snap = self.rtt.get(link, LatencyHistogram()).snapshot()
+            snap["timeouts"] = self.timeouts.get(link, 0)
+            out[link] = snap
+        return out
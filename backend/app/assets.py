@@ -0,0 +1,177 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, List, Optional, Tuple
+
+try:  # optional: pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+# Меньше этого не сжимаем: заголовки gzip съедают выигрыш
+_MIN_COMPRESS = 512
+# Браузер хранит копию, но на каждую загрузку проверяет ETag (304 без тела)
+_REVALIDATE = "no-cache"
+
+log = logging.getLogger(__name__)
+
+
+class _Asset:
+    """Файл в памяти: исходник + готовые br/gzip, свой ETag на каждое кодирование."""
+
+    __slots__ = ("path", "mtime", "media_type", "tag", "bodies", "etags")
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            raw = f.read()
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type.endswith(("javascript", "json")):
+            self.media_type += "; charset=utf-8"
+        self.tag = hashlib.sha1(raw).hexdigest()[:16]
+        # кодирование → тело; порядок — предпочтение при равных q
+        self.bodies: Dict[str, bytes] = {}
+        if len(raw) >= _MIN_COMPRESS:
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(raw, quality=11)
+            self.bodies["gzip"] = gzip.compress(raw, compresslevel=9, mtime=0)
+            # сжатое длиннее исходника — не отдаём
+            self.bodies = {k: v for k, v in self.bodies.items() if len(v) < len(raw)}
+        self.bodies["identity"] = raw
+        self.etags = {enc: f'"{self.tag}-{enc}"' if enc != "identity" else f'"{self.tag}"' for enc in self.bodies}
+
+
+def _accepted(header: str) -> Dict[str, float]:
+    # "gzip, br;q=0.9, *;q=0" → {"gzip": 1.0, "br": 0.9, "*": 0.0}
+    out: Dict[str, float] = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        out[name.strip().lower()] = q
+    return out
+
+
+class StaticAssets:
+    """
+    Статика UI из памяти вместо StaticFiles: каталог читается один раз при старте,
+    каждый файл заранее сжат (brotli — если установлен, gzip — всегда), ETag — хэш
+    содержимого. На запрос — выбор кодирования по Accept-Encoding, 304 на
+    совпавший If-None-Match, ни чтения диска, ни сжатия. Всё отдаётся с no-cache:
+    проверка ETag на каждую загрузку — 304 без тела. STATIC_RELOAD=1 — перечитывать
+    изменённые файлы (разработка).
+    """
+
+    def __init__(self, directory: str, reload: bool = False):
+        self.directory = directory
+        self.reload = reload
+        self.assets: Dict[str, _Asset] = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        self._load()
+
+    def _load(self):
+        assets = {}
+        if not os.path.isdir(self.directory):
+            log.warning("static directory %r not found, UI is not served", self.directory)
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                assets["/" + rel] = _Asset(full)
+        self.assets = assets
+
+    def _lookup(self, path: str) -> Optional[_Asset]:
+        if path.endswith("/"):
+            path += "index.html"
+        elif path not in self.assets and "." not in path.rsplit("/", 1)[-1]:
+            # /dir → /dir/index.html, как StaticFiles(html=True)
+            path += "/index.html"
+        asset = self.assets.get(path)
+        if asset is not None and self.reload:
+            try:
+                if os.stat(asset.path).st_mtime != asset.mtime:
+                    asset = self.assets[path] = _Asset(asset.path)
+            except OSError:
+                return None
+        return asset
+
+    def _pick(self, asset: _Asset, accept: str) -> str:
+        # лучшее из готовых сжатий по q; при равных — порядок bodies (br раньше gzip)
+        acc = _accepted(accept)
+        best, best_q = "identity", 0.0
+        for enc in asset.bodies:
+            if enc == "identity":
+                continue
+            q = acc.get(enc, acc.get("*", 0.0))
+            if q > best_q:
+                best, best_q = enc, q
+        return best
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": 1000})
+            return
+        method = scope["method"]
+        asset = self._lookup(scope["path"]) if method in ("GET", "HEAD") else None
+        if asset is None:
+            status = 404 if method in ("GET", "HEAD") else 405
+            body = b"Not Found" if status == 404 else b"Method Not Allowed"
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                    (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        self.requests += 1
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        enc = self._pick(asset, headers.get("accept-encoding", ""))
+        etag = asset.etags[enc]
+        out: List[Tuple[bytes, bytes]] = [
+            (b"etag", etag.encode()),
+            (b"cache-control", _REVALIDATE.encode()),
+            (b"vary", b"Accept-Encoding"),
+        ]
+        inm = headers.get("if-none-match")
+        if inm and (inm.strip() == "*" or any(t.strip().removeprefix("W/") in asset.etags.values()
+                                              for t in inm.split(","))):
+            self.not_modified += 1
+            await send({"type": "http.response.start", "status": 304, "headers": out})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        body = asset.bodies[enc]
+        out += [(b"content-type", asset.media_type.encode()), (b"content-length", str(len(body)).encode())]
+        if enc != "identity":
+            out.append((b"content-encoding", enc.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": out})
+        await send({"type": "http.response.body", "body": body if method == "GET" else b""})
+        if method == "GET":
+            self.bytes_sent += len(body)
+            self.bytes_raw += len(asset.bodies["identity"])
+
+    def stats(self) -> Dict:
+        return {
+            "files": len(self.assets),
+            "brotli": brotli is not None,
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "bytes_sent": self.bytes_sent,
+            "bytes_raw": self.bytes_raw,
+            "assets": {p: {enc: len(b) for enc, b in a.bodies.items()} for p, a in self.assets.items()},
+        }
+
+
+def assets_from_env(directory: str = "static") -> StaticAssets:
+    return StaticAssets(directory, reload=os.getenv("STATIC_RELOAD") == "1")
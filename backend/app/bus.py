@@ -0,0 +1,302 @@
+import asyncio
+import fcntl
+import json
+import os
+import struct
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+# Сообщение шины: u32 длина | JSON {"t": топик, "w": воркер-отправитель, "m": тело}
+_LEN = struct.Struct("<I")
+
+Handler = Callable[[str, Dict], Union[None, Awaitable[None]]]
+
+
+class _Leader:
+    """Лидер без конкурентов (один процесс)."""
+
+    def try_acquire(self) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+    @property
+    def held(self) -> bool:
+        return True
+
+
+class FileLeader:
+    """
+    Лидерство через flock(LOCK_EX | LOCK_NB) на файле: держит тот, кто первым взял;
+    умер процесс — ядро снимает блокировку, следующий try_acquire другого воркера
+    её получает. Ни демона, ни TTL.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+
+
+class LocalBus:
+    """
+    Один воркер: чужих процессов нет, publish — ничего не делает, лидер всегда мы.
+    Код публикует изменения после локального действия, поэтому в одном процессе
+    шина ничего не стоит.
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.worker_id = str(os.getpid())
+        self._leader = _Leader()
+
+    def subscribe(self, prefix: str, handler: Handler):
+        pass
+
+    def on_connect(self, fn: Callable[[], None]):
+        pass
+
+    def publish(self, topic: str, msg: Dict):
+        pass
+
+    def leader(self, name: str):
+        return self._leader
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {"backend": "local", "worker": self.worker_id}
+
+
+class UnixBus:
+    """
+    Шина между воркерами одного хоста через Unix-сокет, без внешних сервисов.
+    Ретранслятор — тот воркер, кто взял flock на <path>.lock: он слушает сокет
+    и пересылает каждое сообщение всем остальным подключениям, не разбирая его.
+    Сам ретранслятор подключается к себе как обычный участник. Умер — блокировку
+    снимает ядро, участники переподключаются, и первый взявший flock поднимает
+    сокет заново. Доставка best-effort: медленный участник теряет сообщения
+    (буфер > max_buffer), отключённый — всё, что шло мимо него; состояние
+    догоняется следующими сообщениями и анонсами on_connect.
+    """
+
+    distributed = True
+
+    def __init__(self, path: str = "/tmp/rocu-bus.sock", max_buffer: int = 4 << 20):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.worker_id = str(os.getpid())
+        self._handlers: List[Tuple[str, Handler]] = []
+        self._on_connect: List[Callable[[], None]] = []
+        self._leaders: Dict[str, FileLeader] = {}
+        self._relay_lock = FileLeader(path + ".lock")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: set = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.relayed = 0
+        self.reconnects = 0
+        self.connected_ts: Optional[float] = None
+
+    # --- API -------------------------------------------------------------------
+
+    def subscribe(self, prefix: str, handler: Handler):
+        """handler(topic, msg) для сообщений других воркеров с топиком prefix*."""
+        self._handlers.append((prefix, handler))
+
+    def on_connect(self, fn: Callable[[], None]):
+        """
+        Вызывается после каждого (пере)подключения: анонс своего состояния.
+        Служебные топики: bus.hello (участник подключился), bus.gone (отключился).
+        """
+        self._on_connect.append(fn)
+
+    def publish(self, topic: str, msg: Dict):
+        w = self._writer
+        if w is None or w.is_closing():
+            self.dropped += 1
+            return
+        if w.transport.get_write_buffer_size() > self.max_buffer:
+            # ретранслятор не успевает читать — телеметрия устареет раньше, чем дойдёт
+            self.dropped += 1
+            return
+        body = json.dumps({"t": topic, "w": self.worker_id, "m": msg}).encode()
+        w.write(_LEN.pack(len(body)) + body)
+        self.sent += 1
+
+    def leader(self, name: str) -> FileLeader:
+        lk = self._leaders.get(name)
+        if lk is None:
+            lk = self._leaders[name] = FileLeader(f"{self.path}.{name}.lock")
+        return lk
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            for w in list(self._peers):
+                w.close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self._relay_lock.release()
+        for lk in self._leaders.values():
+            lk.release()
+
+    # --- участник ----------------------------------------------------------------
+
+    async def _run(self):
+        while True:
+            if self._server is None and self._relay_lock.try_acquire():
+                await self._serve()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(0.2)
+                continue
+            self._writer = writer
+            self.connected_ts = time.time()
+            # первое сообщение — кто мы: по нему ретранслятор объявит о нашем уходе
+            self.publish("bus.hello", {"worker": self.worker_id})
+            for fn in self._on_connect:
+                try:
+                    fn()
+                except Exception:
+                    pass
+            try:
+                while True:
+                    topic, msg = await self._read(reader)
+                    self.received += 1
+                    for prefix, handler in self._handlers:
+                        if topic.startswith(prefix):
+                            try:
+                                res = handler(topic, msg)
+                                if asyncio.iscoroutine(res):
+                                    await res
+                            except Exception:
+                                pass
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                pass
+            finally:
+                self._writer = None
+                writer.close()
+            self.reconnects += 1
+            await asyncio.sleep(0.1)
+
+    @staticmethod
+    async def _read(reader: asyncio.StreamReader) -> Tuple[str, Dict]:
+        (n,) = _LEN.unpack(await reader.readexactly(_LEN.size))
+        env = json.loads(await reader.readexactly(n))
+        return env["t"], env["m"]
+
+    # --- ретранслятор ------------------------------------------------------------
+
+    async def _serve(self):
+        # сокет предыдущего ретранслятора мог остаться файлом — flock наш, значит он мёртв
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._relay, self.path)
+
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        worker = None
+        try:
+            while True:
+                hdr = await reader.readexactly(_LEN.size)
+                frame = hdr + await reader.readexactly(_LEN.unpack(hdr)[0])
+                if worker is None:
+                    # разбираем только первое сообщение участника (bus.hello)
+                    worker = json.loads(frame[_LEN.size:]).get("w")
+                self._fanout(frame, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+            if worker is not None:
+                # воркер пропал (упал/вышел): остальные снимают его сокеты симов
+                body = json.dumps({"t": "bus.gone", "w": self.worker_id, "m": {"worker": worker}}).encode()
+                self._fanout(_LEN.pack(len(body)) + body, None)
+
+    def _fanout(self, frame: bytes, source):
+        for w in self._peers:
+            if w is source or w.is_closing():
+                continue
+            if w.transport.get_write_buffer_size() > self.max_buffer:
+                self.dropped += 1
+                continue
+            w.write(frame)
+            self.relayed += 1
+
+    def stats(self) -> Dict:
+        return {
+            "backend": "unix",
+            "worker": self.worker_id,
+            "path": self.path,
+            "relay": self._server is not None,
+            "relay_peers": len(self._peers),
+            "connected": self._writer is not None,
+            "sent": self.sent,
+            "received": self.received,
+            "relayed": self.relayed,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+            "leading": sorted(n for n, lk in self._leaders.items() if lk.held),
+        }
+
+
+def make_bus(backend: Optional[str] = None):
+    """STATE_BACKEND=local (по умолчанию, один воркер) | unix (STATE_BUS_PATH)."""
+    backend = (backend or os.getenv("STATE_BACKEND", "local")).strip().lower()
+    if backend == "unix":
+        return UnixBus(os.getenv("STATE_BUS_PATH", "/tmp/rocu-bus.sock"))
+    if backend != "local":
+        raise ValueError(f"unknown STATE_BACKEND={backend!r} (local|unix)")
+    return LocalBus()
@@ -0,0 +1,326 @@
+import json
+import math
+import os
+import struct
+from typing import Dict, Optional, Tuple, Union
+
+try:  # optional: pip install msgpack
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# Поля TelemetryFrame в порядке бинарной раскладки (см. schemas.TelemetryFrame)
+TELEMETRY_FIELDS = (
+    "ts", "seq",
+    "imu_ax", "imu_ay", "imu_az",
+    "yaw", "pitch", "roll",
+    "lat", "lon",
+    "vx", "vy", "wz",
+)
+
+# Binary layout (little-endian, 65 bytes):
+#   u8 tag | f64 ts | u32 seq | f32 imu_ax..roll (6) | f64 lat, lon | f32 vx, vy, wz
+# lat/lon остаются double — float32 даёт ~1 м ошибки на наших широтах.
+TAG_TELEMETRY = 0x01
+TELEMETRY_STRUCT = struct.Struct("<BdI6f2d3f")
+# С аппаратом: u8 tag=0x02 | u8 len | vehicle_id (utf-8) | тело как выше без тега.
+# Сим шлёт 0x01 (аппарат известен по сокету), UI получает 0x02 с именем борта.
+TAG_TELEMETRY_V = 0x02
+TELEMETRY_BODY = struct.Struct("<dI6f2d3f")
+
+# Компактный режим (delta): ключевой кадр + дельты от него, квантование по полям.
+#   u8 tag | u8 len | vehicle_id | u8 key_id | ...
+#   0x03 ключевой: zigzag-varint q для всех полей TELEMETRY_FIELDS
+#   0x04 дельта:   u16 mask | zigzag-varint (q - q_key) для полей с битом в mask
+# q = round(value / step). Поле, не изменившееся относительно ключевого кадра
+# (после квантования), не передаётся. Дельты считаются от ключевого кадра, а не от
+# предыдущего: выброшенная из очереди или потерянная дельта ничего не ломает.
+# Потерян ключевой — у клиента другой key_id, он просит resync и получает
+# текущий ключевой кадр. От сима len=0 (аппарат известен по сокету).
+TAG_DELTA_KEY = 0x03
+TAG_DELTA = 0x04
+DEFAULT_QUANT = {
+    "ts": 1e-3, "seq": 1,
+    "imu_ax": 1e-3, "imu_ay": 1e-3, "imu_az": 1e-3,
+    "yaw": 1e-3, "pitch": 1e-3, "roll": 1e-3,  # рад, ~0.06°
+    "lat": 1e-7, "lon": 1e-7,                  # град, ~1 см
+    "vx": 1e-3, "vy": 1e-3, "wz": 1e-3,
+}
+
+FORMATS = ("json", "msgpack", "bin", "delta")
+
+# /ws/control (UI → бэкенд), little-endian:
+#   команда: u8 0x10 | u32 seq | f64 ts | f32 vx, vy, wz           (25 байт)
+#   ack:     u8 0x11 | u32 seq | u8 accepted | f32 rtt_ms           (10 байт)
+# seq — номер команды у клиента, возвращается в ack. То же в JSON:
+#   {"type":"drive","seq":n,"ts":..,"vx":..,"vy":..,"wz":..} → {"type":"ack","seq":n,"accepted":..,"rtt_ms":..}
+TAG_CONTROL_DRIVE = 0x10
+TAG_CONTROL_ACK = 0x11
+CONTROL_DRIVE = struct.Struct("<BIdfff")
+CONTROL_ACK = struct.Struct("<BIBf")
+
+Payload = Union[str, bytes]
+
+
+def negotiate(requested: Optional[str]) -> str:
+    """Выбрать формат по ?fmt=..., с откатом на json, если он недоступен."""
+    fmt = (requested or "json").strip().lower()
+    if fmt not in FORMATS:
+        return "json"
+    if fmt == "msgpack" and msgpack is None:
+        return "json"
+    return fmt
+
+
+def encode_telemetry(d: Dict, fmt: str, vehicle_id: Optional[str] = None) -> Payload:
+    if fmt == "bin":
+        if vehicle_id is None:
+            return TELEMETRY_STRUCT.pack(TAG_TELEMETRY, *(d[k] for k in TELEMETRY_FIELDS))
+        vid = vehicle_id.encode()[:255]
+        return bytes((TAG_TELEMETRY_V, len(vid))) + vid + TELEMETRY_BODY.pack(*(d[k] for k in TELEMETRY_FIELDS))
+    msg = {"type": "telemetry", "data": d}
+    if vehicle_id is not None:
+        msg["vehicle_id"] = vehicle_id
+    if fmt == "msgpack":
+        return msgpack.packb(msg, use_bin_type=True)
+    return json.dumps(msg)
+
+
+def parse_quant(raw: Optional[str]) -> Dict[str, float]:
+    """TELEMETRY_QUANT="lat=1e-6,yaw=1e-2" — переопределить шаги квантования полей."""
+    steps = dict(DEFAULT_QUANT)
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        k, v = (x.strip() for x in item.split("=", 1))
+        if k in steps and k != "seq" and float(v) > 0:
+            steps[k] = float(v)
+    return steps
+
+
+DELTA_QUANT = parse_quant(os.getenv("TELEMETRY_QUANT"))
+# ключевой кадр раз в N кадров (20 при 10 Гц — раз в 2 с)
+DELTA_KEYFRAME_EVERY = int(os.getenv("TELEMETRY_KEYFRAME_EVERY", "20"))
+
+
+def _put_varint(out: bytearray, v: int):
+    v = (v << 1) ^ (v >> 63)  # zigzag: маленькие по модулю → короткие
+    while v > 0x7F:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+
+
+def _get_varint(buf, pos: int) -> Tuple[int, int]:
+    v = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (v >> 1) ^ -(v & 1), pos
+        shift += 7
+
+
+class DeltaEncoder:
+    """Кодер одного потока кадров (аппарат → все его delta-клиенты, или сим → бэкенд)."""
+
+    def __init__(self, steps: Dict[str, float] = DELTA_QUANT, keyframe_every: int = DELTA_KEYFRAME_EVERY):
+        self.steps = [steps[f] for f in TELEMETRY_FIELDS]
+        self.keyframe_every = max(1, keyframe_every)
+        self.key_id = 0
+        self._key_q = None
+        self._since_key = 0
+        self.key_payload: Optional[bytes] = None  # последний ключевой кадр — его и шлём на resync
+        self.force_key = False
+
+    def encode(self, d: Dict, vehicle_id: Optional[str] = None) -> bytes:
+        q = [round(d[f] / st) for f, st in zip(TELEMETRY_FIELDS, self.steps)]
+        vid = (vehicle_id or "").encode()[:255]
+        if self._key_q is None or self.force_key or self._since_key >= self.keyframe_every:
+            self.key_id = (self.key_id + 1) & 0xFF
+            self._key_q = q
+            self._since_key = 0
+            self.force_key = False
+            out = bytearray((TAG_DELTA_KEY, len(vid)))
+            out += vid
+            out.append(self.key_id)
+            for v in q:
+                _put_varint(out, v)
+            self.key_payload = bytes(out)
+            return self.key_payload
+        self._since_key += 1
+        out = bytearray((TAG_DELTA, len(vid)))
+        out += vid
+        out.append(self.key_id)
+        out += b"\0\0"
+        mask = 0
+        for i, (v, k) in enumerate(zip(q, self._key_q)):
+            if v != k:
+                mask |= 1 << i
+                _put_varint(out, v - k)
+        hdr = 3 + len(vid)
+        out[hdr] = mask & 0xFF
+        out[hdr + 1] = mask >> 8
+        return bytes(out)
+
+
+class DeltaDecoder:
+    """Обратная сторона DeltaEncoder; None — дельта к неизвестному ключевому кадру."""
+
+    def __init__(self, steps: Dict[str, float] = DELTA_QUANT):
+        self.steps = [steps[f] for f in TELEMETRY_FIELDS]
+        self.key_id: Optional[int] = None
+        self._key_q = None
+        self.stale = 0          # дельт, выброшенных без своего ключевого кадра
+        self._lost = False      # ждём ключевой кадр
+        self._asked = False     # resync в этом эпизоде уже запрошен
+
+    def decode(self, raw) -> Optional[Dict]:
+        n = raw[1]
+        vid = bytes(raw[2:2 + n]).decode() if n else None
+        key_id = raw[2 + n]
+        pos = 3 + n
+        if raw[0] == TAG_DELTA_KEY:
+            q = []
+            for _ in TELEMETRY_FIELDS:
+                v, pos = _get_varint(raw, pos)
+                q.append(v)
+            self.key_id, self._key_q = key_id, q
+            self._lost = self._asked = False
+        else:
+            if key_id != self.key_id:
+                self.stale += 1
+                self._lost = True
+                return None
+            mask = raw[pos] | (raw[pos + 1] << 8)
+            pos += 2
+            q = list(self._key_q)
+            for i in range(len(q)):
+                if mask >> i & 1:
+                    dv, pos = _get_varint(raw, pos)
+                    q[i] += dv
+        data = {f: v * st for f, v, st in zip(TELEMETRY_FIELDS, q, self.steps)}
+        msg = {"type": "telemetry", "data": data}
+        if vid is not None:
+            msg["vehicle_id"] = vid
+        return msg
+
+    def want_resync(self) -> bool:
+        """True один раз на эпизод рассинхронизации (до следующего ключевого кадра)."""
+        if self._lost and not self._asked:
+            self._asked = True
+            return True
+        return False
+
+
+def encode_event(obj: Dict, fmt: str) -> Payload:
+    # у событий нет бинарной раскладки: bin-клиенты получают их текстом (как hello)
+    if fmt == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj)
+
+
+class DeltaDemux:
+    """
+    delta для мультиплексного сокета сима (?mux=1): свой DeltaDecoder на каждый
+    аппарат, аппарат — из заголовка кадра. want_resync() отдаёт id аппарата.
+    """
+
+    def __init__(self, steps: Dict[str, float] = DELTA_QUANT):
+        self.steps = steps
+        self.decoders: Dict[str, DeltaDecoder] = {}
+        self._last: Optional[str] = None
+
+    def decode(self, raw) -> Optional[Dict]:
+        n = raw[1]
+        vid = bytes(raw[2:2 + n]).decode()
+        dec = self.decoders.get(vid)
+        if dec is None:
+            dec = self.decoders[vid] = DeltaDecoder(self.steps)
+        self._last = vid
+        return dec.decode(raw)
+
+    def want_resync(self) -> Optional[str]:
+        dec = self.decoders.get(self._last)
+        return self._last if dec is not None and dec.want_resync() else None
+
+
+def decode_message(raw: Payload, delta: Optional[DeltaDecoder] = None) -> Tuple[Optional[Dict], bool]:
+    """
+    Разобрать входящее сообщение сима (text → JSON, bytes → struct или msgpack).
+    Возвращает (obj, typed): typed=True значит, что поля телеметрии уже
+    имеют правильные типы (struct) и pydantic-валидацию можно пропустить.
+    delta — состояние delta-потока этого соединения (fmt=delta).
+    """
+    if isinstance(raw, (bytes, bytearray)):
+        if delta is not None and len(raw) > 2 and raw[0] in (TAG_DELTA_KEY, TAG_DELTA):
+            return delta.decode(raw), True
+        if len(raw) == TELEMETRY_STRUCT.size and raw[0] == TAG_TELEMETRY:
+            vals = TELEMETRY_STRUCT.unpack(raw)
+            return {"type": "telemetry", "data": dict(zip(TELEMETRY_FIELDS, vals[1:]))}, True
+        if len(raw) > 2 and raw[0] == TAG_TELEMETRY_V and len(raw) == 2 + raw[1] + TELEMETRY_BODY.size:
+            n = raw[1]
+            vals = TELEMETRY_BODY.unpack_from(raw, 2 + n)
+            return {"type": "telemetry", "vehicle_id": bytes(raw[2:2 + n]).decode(),
+                    "data": dict(zip(TELEMETRY_FIELDS, vals))}, True
+        if msgpack is not None:
+            return msgpack.unpackb(raw, raw=False), False
+        return None, False
+    return json.loads(raw), False
+
+
+def decode_control(raw: Payload) -> Optional[Dict]:
+    """Команда /ws/control → {"seq", "ts", "vx", "vy", "wz"}; None — не команда/мусор."""
+    if isinstance(raw, (bytes, bytearray)):
+        if len(raw) != CONTROL_DRIVE.size or raw[0] != TAG_CONTROL_DRIVE:
+            return None
+        _, seq, ts, vx, vy, wz = CONTROL_DRIVE.unpack(raw)
+    else:
+        try:
+            obj = json.loads(raw)
+            if obj.get("type", "drive") != "drive":
+                return None
+            seq = int(obj.get("seq", 0))
+            ts, vx, vy, wz = (float(obj.get(k, 0.0)) for k in ("ts", "vx", "vy", "wz"))
+        except (ValueError, TypeError, AttributeError):
+            return None
+    if not all(map(math.isfinite, (ts, vx, vy, wz))):
+        return None
+    return {"seq": seq, "ts": ts, "vx": vx, "vy": vy, "wz": wz}
+
+
+def encode_control_ack(seq: int, accepted: bool, rtt_ms: Optional[float], fmt: str) -> Payload:
+    rtt = round(rtt_ms, 3) if rtt_ms is not None else None
+    if fmt == "bin":
+        return CONTROL_ACK.pack(TAG_CONTROL_ACK, seq & 0xFFFFFFFF, int(accepted), rtt if rtt is not None else -1.0)
+    return json.dumps({"type": "ack", "seq": seq, "accepted": accepted, "rtt_ms": rtt})
+
+
+class EncodedFrame:
+    """Кадр телеметрии, сериализуемый лениво и не более одного раза на формат."""
+
+    __slots__ = ("data", "vehicle_id", "delta", "_cache")
+
+    def __init__(self, data: Dict, vehicle_id: Optional[str] = None, delta: Optional[DeltaEncoder] = None):
+        self.data = data
+        self.vehicle_id = vehicle_id
+        self.delta = delta  # общий кодер аппарата: кадр кодируется один раз на всех delta-клиентов
+        self._cache: Dict[str, Payload] = {}
+
+    def get(self, fmt: str) -> Payload:
+        out = self._cache.get(fmt)
+        if out is None:
+            if fmt == "delta" and self.delta is not None:
+                out = self._cache[fmt] = self.delta.encode(self.data, self.vehicle_id)
+            else:
+                out = self._cache[fmt] = encode_telemetry(self.data, fmt, self.vehicle_id)
+        return out
+
+
+def normalize_frame(d: Dict) -> Dict:
+    """Нормализация курса в [-pi, pi] и yaw_deg для UI — один раз на кадр."""
+    yaw = math.atan2(math.sin(d["yaw"]), math.cos(d["yaw"]))
+    d["yaw"] = yaw
+    d["yaw_deg"] = round(math.degrees(yaw), 1)
+    return d
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+# Источники команд по приоритету: ручное управление перебивает автопилот,
+# стоп watchdog'а уходит мимо очереди (send_now)
+MANUAL = "manual"
+MISSION = "mission"
+SAFETY = "safety"
+
+
+class _Pending:
+    __slots__ = ("data", "cmd_id", "source", "t")
+
+    def __init__(self, data: Dict, cmd_id: Optional[int], source: str):
+        self.data = data
+        self.cmd_id = cmd_id
+        self.source = source
+        self.t = time.monotonic()
+
+
+class CommandScheduler:
+    """
+    Планировщик drive-команд одного аппарата. Хранит только последнюю уставку:
+    новая команда заменяет ещё не отправленную (coalesced), отправка не чаще
+    max_hz. Пока оператор рулит вручную (последняя ручная команда моложе
+    manual_hold_s), команды автопилота отбрасываются. Команда, пролежавшая
+    дольше stale_s, не отправляется вовсе — устаревшая уставка не придёт после
+    свежей. Задача-отправитель живёт, только пока есть что отправлять.
+
+    on_coalesce(old_id, new_id) — id заменённой команды привязывается к новой,
+    чтобы ожидающий ack HTTP-запрос получил подтверждение фактической уставки.
+    """
+
+    def __init__(self, send: Callable[[Dict], Awaitable[bool]], max_hz: float = 20.0,
+                 manual_hold_s: float = 1.0, stale_s: float = 0.8,
+                 on_coalesce: Optional[Callable[[int, int], None]] = None):
+        self._send = send
+        self.period = 1.0 / max_hz if max_hz > 0 else 0.0
+        self.manual_hold_s = manual_hold_s
+        self.stale_s = stale_s
+        self.on_coalesce = on_coalesce
+        self._pending: Optional[_Pending] = None
+        self._next_at = 0.0
+        self._last_manual = float("-inf")
+        self._task: Optional[asyncio.Task] = None
+
+        self.submitted: Dict[str, int] = {MANUAL: 0, MISSION: 0, SAFETY: 0}
+        self.sent = 0
+        self.coalesced = 0          # заменены более новой уставкой до отправки
+        self.dropped_override = 0   # команды автопилота во время ручного управления
+        self.dropped_stale = 0      # пролежали дольше stale_s
+        self.preempted = 0          # сняты стопом watchdog'а
+        self.not_connected = 0      # на момент отправки сима не было
+
+    def manual_active(self) -> bool:
+        return time.monotonic() - self._last_manual < self.manual_hold_s
+
+    def submit(self, data: Dict, source: str = MANUAL, cmd_id: Optional[int] = None) -> bool:
+        """Поставить уставку; False — отброшена (автопилот при ручном управлении)."""
+        self.submitted[source] = self.submitted.get(source, 0) + 1
+        if source == MANUAL:
+            self._last_manual = time.monotonic()
+        elif self.manual_active():
+            self.dropped_override += 1
+            return False
+        old = self._pending
+        if old is not None:
+            self.coalesced += 1
+            if old.cmd_id is not None:
+                if cmd_id is not None and self.on_coalesce is not None:
+                    self.on_coalesce(old.cmd_id, cmd_id)
+                elif cmd_id is None:
+                    # новая уставка без id (автопилот) — несём id старой, её ack не пропадёт
+                    cmd_id = old.cmd_id
+        self._pending = _Pending(data, cmd_id, source)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return True
+
+    async def send_now(self, data: Dict, cmd_id: Optional[int] = None) -> bool:
+        """Стоп watchdog'а: без очереди и лимита; отложенная уставка снимается."""
+        self.submitted[SAFETY] += 1
+        if self._pending is not None:
+            self._pending = None
+            self.preempted += 1
+        ok = await self._send(self._message(data, cmd_id))
+        if ok:
+            self.sent += 1
+            self._next_at = time.monotonic() + self.period
+        else:
+            self.not_connected += 1
+        return ok
+
+    @staticmethod
+    def _message(data: Dict, cmd_id: Optional[int]) -> Dict:
+        msg = {"type": "command", "command": "drive", "data": data}
+        if cmd_id is not None:
+            msg["id"] = cmd_id
+        return msg
+
+    async def _run(self):
+        while self._pending is not None:
+            wait = self._next_at - time.monotonic()
+            if wait > 0:
+                # окно лимита: за это время уставку может заменить более новая
+                await asyncio.sleep(wait)
+                continue
+            p, self._pending = self._pending, None
+            if time.monotonic() - p.t > self.stale_s:
+                self.dropped_stale += 1
+                continue
+            if await self._send(self._message(p.data, p.cmd_id)):
+                self.sent += 1
+            else:
+                self.not_connected += 1
+            self._next_at = time.monotonic() + self.period
+
+    def stats(self) -> Dict:
+        return {
+            "max_hz": round(1.0 / self.period, 1) if self.period else None,
+            "manual_active": self.manual_active(),
+            "submitted": dict(self.submitted),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped_override": self.dropped_override,
+            "dropped_stale": self.dropped_stale,
+            "preempted": self.preempted,
+            "not_connected": self.not_connected,
+        }
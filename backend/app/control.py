@@ -0,0 +1,111 @@
+import asyncio
+import time
+from typing import Dict, Set
+
+from fastapi import WebSocket
+
+from .codec import decode_control, encode_control_ack
+from .commands import MANUAL
+from .stats import LatencyHistogram
+
+# ack'ов в очереди на клиента; медленный клиент теряет старейшие, а не копит память
+ACK_QUEUE = 64
+
+
+class ControlHub:
+    """
+    /ws/control: постоянный канал ручного управления вместо POST на каждую команду.
+    Каждая команда — heartbeat аппарата и уставка в его планировщик; ack с RTT
+    (приём → ack сима) уходит по тому же сокету, как только сим подтвердит.
+    Приёмный цикл ack не ждёт: ожидание — в отдельной задаче на команду,
+    отправка в сокет — одной задачей-писателем на клиента через очередь до ACK_QUEUE
+    (переполнилась — выкидывается старейший ack). Писатель упал — сессия закрывается.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.clients: Set[WebSocket] = set()
+        self.commands = 0
+        self.accepted = 0
+        self.not_connected = 0
+        self.bad = 0
+        self.acks_dropped = 0
+        self.rtt = LatencyHistogram()
+
+    async def serve(self, ws: WebSocket, vehicle_id: str, fmt: str):
+        out: asyncio.Queue = asyncio.Queue(maxsize=ACK_QUEUE)
+        waiters: Set[asyncio.Task] = set()
+
+        def send(msg):
+            if out.full():
+                out.get_nowait()
+                self.acks_dropped += 1
+            out.put_nowait(msg)
+
+        async def writer():
+            while True:
+                msg = await out.get()
+                if isinstance(msg, str):
+                    await ws.send_text(msg)
+                else:
+                    await ws.send_bytes(msg)
+
+        async def ack(seq: int, cmd_id: int, fut: asyncio.Future):
+            rtt_ms = await self.state.acks.wait(cmd_id, fut)
+            if rtt_ms is not None:
+                self.accepted += 1
+                self.rtt.record(rtt_ms)
+            send(encode_control_ack(seq, rtt_ms is not None, rtt_ms, fmt))
+
+        async def receiver():
+            while True:
+                msg = await ws.receive()
+                if msg["type"] == "websocket.disconnect":
+                    break
+                raw = msg.get("bytes") if msg.get("bytes") is not None else msg.get("text")
+                cmd = decode_control(raw) if raw is not None else None
+                if cmd is None:
+                    self.bad += 1
+                    continue
+                self.commands += 1
+                seq = cmd.pop("seq")
+                v = self.state.vehicle(vehicle_id)
+                if v is not None:
+                    # команда и есть heartbeat: отдельный keepalive не нужен
+                    v.touch_cmd()
+                if v is None or not v.connected:
+                    self.not_connected += 1
+                    send(encode_control_ack(seq, False, None, fmt))
+                    continue
+                cmd_id, fut = self.state.acks.register(v.vehicle_id)
+                v.submit(cmd, MANUAL, cmd_id)
+                t = asyncio.create_task(ack(seq, cmd_id, fut))
+                waiters.add(t)
+                t.add_done_callback(waiters.discard)
+
+        self.clients.add(ws)
+        w = asyncio.create_task(writer())
+        r = asyncio.create_task(receiver())
+        # писатель не смог отправить — сокет мёртв: приём тоже заканчиваем, ack'и некому слать
+        w.add_done_callback(lambda _: r.cancel())
+        try:
+            await asyncio.wait({r})
+            if not r.cancelled():
+                r.result()  # WebSocketDisconnect и прочие ошибки приёма — наружу, как раньше
+        finally:
+            self.clients.discard(ws)
+            tasks = list(waiters) + [w, r]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "clients": len(self.clients),
+            "commands": self.commands,
+            "accepted": self.accepted,
+            "not_connected": self.not_connected,
+            "bad": self.bad,
+            "acks_dropped": self.acks_dropped,
+            "rtt": self.rtt.snapshot(),
+        }
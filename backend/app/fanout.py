@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from fastapi import WebSocket
+
+from .codec import EncodedFrame, Payload, encode_event
+
+
+class ClientChannel:
+    """
+    Один UI-клиент: ограниченная очередь на каждый аппарат + собственная задача-отправитель.
+    Если клиент не успевает, старые кадры аппарата выбрасываются (остаётся самый свежий),
+    а широковещательная рассылка никогда не ждёт медленный сокет. Очереди разных
+    аппаратов не вытесняют друг друга и отдаются по кругу.
+    """
+
+    def __init__(self, ws: WebSocket, client_id: int, queue_size: int = 2, fmt: str = "json"):
+        self.ws = ws
+        self.client_id = client_id
+        self.fmt = fmt
+        self.topics: Set[str] = set()  # vehicle_id или "*" (все аппараты)
+        self.queue_size = max(1, queue_size)
+        # topic → deque((t_enq, msg)); порядок ключей — очередь на отправку
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+
+        self.connected_ts = time.time()
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.resyncs = 0   # запросы ключевого кадра от клиента (fmt=delta)
+        self.bytes_sent = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def offer(self, msg: Payload, topic: str = "*", first: bool = False):
+        # first=True — очередь топика встаёт в начало круга (история перед живыми кадрами)
+        if self.closed:
+            return
+        q = self.queues.get(topic)
+        if q is None:
+            q = self.queues[topic] = deque(maxlen=self.queue_size)
+        elif len(q) == q.maxlen:
+            # deque(maxlen) сам выкинет самый старый — просто считаем
+            self.dropped += 1
+        q.append((time.monotonic(), msg))
+        if first:
+            self.queues.move_to_end(topic, last=False)
+        self.enqueued += 1
+        self._wake.set()
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self._wake.wait()
+                self._wake.clear()
+                while self.queues:
+                    # по кадру от аппарата за раз: непустую очередь — в конец
+                    topic, q = next(iter(self.queues.items()))
+                    t_enq, msg = q.popleft()
+                    if q:
+                        self.queues.move_to_end(topic)
+                    else:
+                        del self.queues[topic]
+                    if isinstance(msg, str):
+                        await self.ws.send_text(msg)
+                    else:
+                        await self.ws.send_bytes(msg)
+                    self.bytes_sent += len(msg)
+                    lag = (time.monotonic() - t_enq) * 1000.0
+                    self.last_lag_ms = lag
+                    self.max_lag_ms = max(self.max_lag_ms, lag)
+                    self.sent += 1
+        except Exception:
+            # сокет умер — отправитель завершается, канал снимет hub
+            pass
+        finally:
+            self.closed = True
+
+    async def close(self):
+        self.closed = True
+        self._wake.set()
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def stats(self) -> Dict:
+        return {
+            "client_id": self.client_id,
+            "fmt": self.fmt,
+            "topics": sorted(self.topics),
+            "queued": self.queued(),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "resyncs": self.resyncs,
+            "bytes_sent": self.bytes_sent,
+            "last_lag_ms": round(self.last_lag_ms, 3),
+            "max_lag_ms": round(self.max_lag_ms, 3),
+            "connected_s": round(time.time() - self.connected_ts, 1),
+        }
+
+
+WILDCARD = "*"
+
+
+class TelemetryFanout:
+    """
+    Рассылка телеметрии UI-клиентам: O(1) на клиента в горячем пути, без await.
+    Клиенты подписаны на аппараты (топики); кадр борта обходит только его
+    подписчиков и подписчиков "*", а не всех клиентов.
+    """
+
+    def __init__(self, queue_size: int = 2):
+        self.queue_size = queue_size
+        self.channels: Dict[WebSocket, ClientChannel] = {}
+        self.topics: Dict[str, Set[ClientChannel]] = {}
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def add(self, ws: WebSocket, fmt: str = "json", topics: Iterable[str] = (WILDCARD,)) -> ClientChannel:
+        ch = ClientChannel(ws, self._next_id, self.queue_size, fmt)
+        self._next_id += 1
+        self.channels[ws] = ch
+        self.subscribe(ws, topics)
+        ch.start()
+        return ch
+
+    def subscribe(self, ws: WebSocket, topics: Iterable[str]):
+        ch = self.channels.get(ws)
+        if ch is None:
+            return
+        for t in topics:
+            ch.topics.add(t)
+            self.topics.setdefault(t, set()).add(ch)
+
+    def unsubscribe(self, ws: WebSocket, topics: Iterable[str]):
+        ch = self.channels.get(ws)
+        if ch is not None:
+            self._drop_topics(ch, list(topics))
+
+    def _drop_topics(self, ch: ClientChannel, topics: Iterable[str]):
+        for t in topics:
+            ch.topics.discard(t)
+            subs = self.topics.get(t)
+            if subs is not None:
+                subs.discard(ch)
+                if not subs:
+                    del self.topics[t]
+
+    async def remove(self, ws: WebSocket):
+        ch = self.channels.pop(ws, None)
+        if ch:
+            self._drop_topics(ch, list(ch.topics))
+            await ch.close()
+
+    def has_subscribers(self, topic: str) -> bool:
+        return topic in self.topics or WILDCARD in self.topics
+
+    def broadcast(self, frame: EncodedFrame, topic: str = WILDCARD):
+        # frame.get() кэширует результат: сериализация один раз на формат, не на клиента
+        dead = []
+        for ch in self.topics.get(topic, ()):
+            if ch.closed:
+                dead.append(ch)
+                continue
+            ch.offer(frame.get(ch.fmt), topic)
+        if topic != WILDCARD:
+            for ch in self.topics.get(WILDCARD, ()):
+                if ch.closed:
+                    dead.append(ch)
+                elif topic not in ch.topics:  # подписан и на борт, и на "*" — один раз
+                    ch.offer(frame.get(ch.fmt), topic)
+        for ch in dead:
+            if self.channels.get(ch.ws) is ch:
+                del self.channels[ch.ws]
+            self._drop_topics(ch, list(ch.topics))
+
+    def publish(self, topic: str, event: Dict):
+        """Событие (не кадр) подписчикам аппарата; своя очередь — телеметрия его не вытеснит."""
+        cache: Dict[str, Payload] = {}
+        key = "event:" + topic
+        for ch in self.topics.get(topic, set()) | self.topics.get(WILDCARD, set()):
+            if ch.closed:
+                continue
+            msg = cache.get(ch.fmt)
+            if msg is None:
+                msg = cache[ch.fmt] = encode_event(event, ch.fmt)
+            ch.offer(msg, key)
+
+    def stats(self) -> List[Dict]:
+        return [ch.stats() for ch in self.channels.values()]
@@ -0,0 +1,291 @@
+import math
+import time
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from .fanout import TelemetryFanout
+from .stats import PERF
+
+# Плоская Земля в локальной системе (как в автопилоте): на масштабе миссии/полигона
+# ошибка — доли процента, а пересчёт — два умножения
+M_PER_DEG = 111_111.0
+
+KEEP_OUT = "keep_out"
+KEEP_IN = "keep_in"
+
+_FAR = 1e30  # y заглушки в таблице полос: дальше любой точки
+
+
+def offset_m(lat0: float, lon0: float, lat1: float, lon1: float) -> Tuple[float, float]:
+    """(север, восток) в метрах от точки 0 до точки 1."""
+    return (lat1 - lat0) * M_PER_DEG, (lon1 - lon0) * M_PER_DEG * math.cos(math.radians(lat0))
+
+
+class Route:
+    """
+    Геометрия миссии, посчитанная один раз при загрузке: точки в локальных метрах
+    (север/восток от первой точки), длины и курсы плеч, накопленная длина.
+    Остаток пути с текущей точки = до активного WP + cum[-1] - cum[idx] — O(1) на кадр.
+    """
+
+    def __init__(self, waypoints: Sequence[Dict]):
+        self.lat = np.array([w["lat"] for w in waypoints], dtype=float)
+        self.lon = np.array([w["lon"] for w in waypoints], dtype=float)
+        self.lat0 = float(self.lat[0]) if len(self.lat) else 0.0
+        self.lon0 = float(self.lon[0]) if len(self.lon) else 0.0
+        self.kx = M_PER_DEG * math.cos(math.radians(self.lat0))
+        self.y = (self.lat - self.lat0) * M_PER_DEG
+        self.x = (self.lon - self.lon0) * self.kx
+        dx, dy = np.diff(self.x), np.diff(self.y)
+        self.seg = np.hypot(dx, dy)
+        self.cum = np.concatenate(([0.0], np.cumsum(self.seg)))
+        # курс плеча: 0° — север, по часовой
+        self.bearing = np.degrees(np.arctan2(dx, dy)) % 360.0
+        self.total = float(self.cum[-1]) if len(self.cum) else 0.0
+        # python-списки — для горячего пути по одному кадру (без накладных numpy на скаляр)
+        self._x, self._y, self._cum = self.x.tolist(), self.y.tolist(), self.cum.tolist()
+
+    def __len__(self) -> int:
+        return len(self._x)
+
+    def offset(self, idx: int, lat: float, lon: float) -> Tuple[float, float]:
+        """(север, восток) в метрах от позиции до WP idx."""
+        return (self._y[idx] - (lat - self.lat0) * M_PER_DEG,
+                self._x[idx] - (lon - self.lon0) * self.kx)
+
+    def remaining(self, idx: int, lat: float, lon: float) -> float:
+        dn, de = self.offset(idx, lat, lon)
+        return math.hypot(dn, de) + self.total - self._cum[idx]
+
+    def status(self, idx: int, lat: float, lon: float, speed: float) -> Dict:
+        idx = min(max(idx, 0), len(self) - 1)
+        rem = self.remaining(idx, lat, lon)
+        return {
+            "idx": idx,
+            "total_m": round(self.total, 1),
+            "remaining_m": round(rem, 1),
+            "progress": round(max(0.0, 1.0 - rem / self.total), 3) if self.total > 0 else None,
+            # ETA — по текущей путевой скорости; стоим — ETA нет
+            "eta_s": round(rem / speed, 1) if speed > 0.05 else None,
+            "leg_bearing_deg": round(float(self.bearing[idx - 1]), 1) if idx > 0 else None,
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            "total_m": round(self.total, 1),
+            "legs": [{"length_m": round(float(l), 1), "bearing_deg": round(float(b), 1)}
+                     for l, b in zip(self.seg, self.bearing)],
+            "cum_m": [round(float(c), 1) for c in self.cum],
+        }
+
+
+class GeofenceIndex:
+    """
+    Набор полигонов в локальных метрах + сеточный индекс по горизонтальным полосам
+    (slab): для каждой полосы высотой cell_m — рёбра всех полигонов, которые её
+    пересекают. Точка-в-полигоне — чётность пересечений луча вправо, а луч
+    пересекает только рёбра своей полосы. Проверка P точек × F полигонов идёт
+    пачкой: каждая точка берёт строку своей полосы из таблицы (nbands × M),
+    пересечения — одна матрица P × M, чётность по полигонам — bincount.
+    """
+
+    def __init__(self, fences: Sequence[Dict], cell_m: float = 25.0, max_bands: int = 4096):
+        if not fences:
+            raise ValueError("no fences")
+        self.fences = [dict(f) for f in fences]
+        self.ids = [str(f["id"]) for f in fences]
+        if len(set(self.ids)) != len(self.ids):
+            raise ValueError("duplicate fence id")
+        kinds = [f.get("kind", KEEP_OUT) for f in fences]
+        if any(k not in (KEEP_OUT, KEEP_IN) for k in kinds):
+            raise ValueError("kind must be keep_out|keep_in")
+        self.keep_in = np.array([k == KEEP_IN for k in kinds])
+        self._keep_in_idx = {i for i, k in enumerate(kinds) if k == KEEP_IN}
+
+        rings = []
+        for f in fences:
+            pts = [(p["lat"], p["lon"]) for p in f["polygon"]]
+            if len(pts) > 1 and pts[0] == pts[-1]:
+                pts = pts[:-1]
+            if len(pts) < 3:
+                raise ValueError(f"fence {f['id']}: polygon needs at least 3 points")
+            rings.append(np.array(pts, dtype=float))
+        allpts = np.concatenate(rings)
+        self.lat0 = float(allpts[:, 0].mean())
+        self.lon0 = float(allpts[:, 1].mean())
+        self.kx = M_PER_DEG * math.cos(math.radians(self.lat0))
+
+        # все рёбра всех полигонов одним массивом
+        x0, y0, x1, y1, fid = [], [], [], [], []
+        for i, r in enumerate(rings):
+            y = (r[:, 0] - self.lat0) * M_PER_DEG
+            x = (r[:, 1] - self.lon0) * self.kx
+            x0.append(x); y0.append(y)
+            x1.append(np.roll(x, -1)); y1.append(np.roll(y, -1))
+            fid.append(np.full(len(r), i))
+        x0, y0, x1, y1, fid = (np.concatenate(a) for a in (x0, y0, x1, y1, fid))
+        dy = y1 - y0
+        # горизонтальные рёбра луч не пересекают (условие по y их отсекает), inv для них не важен
+        inv = np.divide(x1 - x0, dy, out=np.zeros_like(dy), where=dy != 0)
+
+        self.ymin = float(min(y0.min(), y1.min()))
+        ymax = float(max(y0.max(), y1.max()))
+        self.nbands = max(1, min(max_bands, int(math.ceil((ymax - self.ymin) / cell_m)) or 1))
+        self.cell = max((ymax - self.ymin) / self.nbands, 1e-9)
+        self.ymax = ymax
+        lo = np.clip(((np.minimum(y0, y1) - self.ymin) / self.cell).astype(int), 0, self.nbands - 1)
+        hi = np.clip(((np.maximum(y0, y1) - self.ymin) / self.cell).astype(int), 0, self.nbands - 1)
+        members: List[List[int]] = [[] for _ in range(self.nbands)]
+        for e, (a, b) in enumerate(zip(lo.tolist(), hi.tolist())):
+            for band in range(a, b + 1):
+                members[band].append(e)
+        # таблица полос (nbands × M), добитая до самой населённой полосы: пустые
+        # места — ребро на y=_FAR, оно никогда не пересекает луч
+        m = max(1, max(len(es) for es in members))
+        self.b_x0 = np.zeros((self.nbands, m))
+        self.b_y0 = np.full((self.nbands, m), _FAR)
+        self.b_y1 = np.full((self.nbands, m), _FAR)
+        self.b_inv = np.zeros((self.nbands, m))
+        self.b_fid = np.zeros((self.nbands, m), dtype=np.int64)
+        for band, es in enumerate(members):
+            k = len(es)
+            if k:
+                self.b_x0[band, :k] = x0[es]
+                self.b_y0[band, :k] = y0[es]
+                self.b_y1[band, :k] = y1[es]
+                self.b_inv[band, :k] = inv[es]
+                self.b_fid[band, :k] = fid[es]
+        self.edges = len(x0)
+        self.band_width = m
+        # те же полосы python-кортежами — для проверки одного кадра без накладных numpy
+        self._rows = [list(zip(x0[es].tolist(), y0[es].tolist(), y1[es].tolist(), inv[es].tolist(),
+                               fid[es].tolist())) for es in members]
+
+    def inside_one(self, lat: float, lon: float) -> Set[int]:
+        """Индексы полигонов, внутри которых точка (путь одного кадра телеметрии)."""
+        py = (float(lat) - self.lat0) * M_PER_DEG
+        odd: Set[int] = set()
+        if not self.ymin <= py <= self.ymax:
+            return odd
+        px = (float(lon) - self.lon0) * self.kx
+        for x0, y0, y1, inv, f in self._rows[min(int((py - self.ymin) / self.cell), self.nbands - 1)]:
+            if (y0 > py) != (y1 > py) and px < x0 + (py - y0) * inv:
+                if f in odd:
+                    odd.discard(f)
+                else:
+                    odd.add(f)
+        return odd
+
+    def violations_one(self, lat: float, lon: float) -> Set[int]:
+        return self.inside_one(lat, lon) ^ self._keep_in_idx
+
+    def inside(self, lat, lon) -> np.ndarray:
+        """Матрица (P, F): точка внутри полигона."""
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        py = (lat - self.lat0) * M_PER_DEG
+        px = (lon - self.lon0) * self.kx
+        nf = len(self.ids)
+        ok = (py >= self.ymin) & (py <= self.ymax)
+        if not ok.any():
+            return np.zeros((len(py), nf), dtype=bool)
+        pts = np.flatnonzero(ok)
+        band = np.minimum(((py[pts] - self.ymin) / self.cell).astype(np.int64), self.nbands - 1)
+        # рёбра своей полосы для каждой точки: (P, M), пересечения луча — одной операцией
+        qy, qx = py[pts, None], px[pts, None]
+        y0, y1 = self.b_y0[band], self.b_y1[band]
+        cross = ((y0 > qy) != (y1 > qy)) & (qx < self.b_x0[band] + (qy - y0) * self.b_inv[band])
+        # чётность пересечений по полигонам: bincount по (точка, полигон)
+        key = (np.arange(len(pts))[:, None] * nf + self.b_fid[band])[cross]
+        counts = np.bincount(key, minlength=len(pts) * nf).reshape(len(pts), nf)
+        out = np.zeros((len(py), nf), dtype=bool)
+        out[pts] = counts & 1
+        return out
+
+    def violations(self, lat, lon) -> np.ndarray:
+        """(P, F): keep_out — точка внутри, keep_in — точка снаружи."""
+        return self.inside(lat, lon) ^ self.keep_in
+
+    def stats(self) -> Dict:
+        return {"fences": len(self.ids), "edges": self.edges, "bands": self.nbands,
+                "cell_m": round(self.cell, 1), "max_edges_per_band": self.band_width}
+
+
+class GeofenceMonitor:
+    """
+    Проверка каждого кадра телеметрии против геозон. Переходы публикуются
+    событиями в топик аппарата на /ws/telemetry:
+    {"type":"event","event":"geofence","vehicle_id","fence","kind","state":"breach"|"clear"}.
+    Без геозон — ноль работы на кадр.
+    """
+
+    def __init__(self, fanout: TelemetryFanout, cell_m: float = 25.0):
+        self.fanout = fanout
+        self.cell_m = cell_m
+        self.index: Optional[GeofenceIndex] = None
+        self.breached: Dict[str, frozenset] = {}   # vehicle_id → нарушенные геозоны
+        self.checks = 0
+        self.breaches = 0
+        self.events: deque = deque(maxlen=100)
+        self.check_hist = PERF.histogram("geofence_check", "geofence check of one telemetry frame")
+
+    def set(self, fences: Sequence[Dict]):
+        """Заменить набор геозон (пустой — выключить); ValueError — кривой полигон."""
+        index = GeofenceIndex(fences, self.cell_m) if fences else None
+        # старые нарушения снимаем, новые пересчитаются на следующих кадрах
+        for vid, ids in list(self.breached.items()):
+            for fence in ids:
+                self._publish(vid, fence, "clear")
+        self.breached.clear()
+        self.index = index
+
+    def check(self, vehicle_id: str, lat: float, lon: float):
+        idx = self.index
+        if idx is None:
+            return
+        t0 = time.perf_counter()
+        viol = idx.violations_one(lat, lon)
+        now = frozenset(idx.ids[i] for i in viol) if viol else frozenset()
+        prev = self.breached.get(vehicle_id, frozenset())
+        if now != prev:
+            for fence in now - prev:
+                self.breaches += 1
+                self._publish(vehicle_id, fence, "breach")
+            for fence in prev - now:
+                self._publish(vehicle_id, fence, "clear")
+            self.breached[vehicle_id] = now
+        self.checks += 1
+        self.check_hist.record((time.perf_counter() - t0) * 1000.0)
+
+    def _publish(self, vehicle_id: str, fence: str, state: str):
+        kind = KEEP_OUT
+        if self.index is not None and fence in self.index.ids:
+            kind = KEEP_IN if self.index.keep_in[self.index.ids.index(fence)] else KEEP_OUT
+        ev = {"type": "event", "event": "geofence", "vehicle_id": vehicle_id, "fence": fence,
+              "kind": kind, "state": state, "ts": time.time()}
+        self.events.append(ev)
+        self.fanout.publish(vehicle_id, ev)
+
+    def status(self, positions: Dict[str, Tuple[float, float]]) -> Dict[str, List[str]]:
+        """Нарушения для набора аппаратов одной векторной проверкой: vehicle_id → [fence]."""
+        if self.index is None or not positions:
+            return {vid: [] for vid in positions}
+        vids = list(positions)
+        lat, lon = np.array([positions[v] for v in vids], dtype=float).T
+        viol = self.index.violations(lat, lon)
+        ids = self.index.ids
+        return {vid: [ids[i] for i in np.flatnonzero(r)] for vid, r in zip(vids, viol)}
+
+    def stats(self, events: Optional[int] = None) -> Dict:
+        out = {
+            "index": self.index.stats() if self.index is not None else None,
+            "checks": self.checks,
+            "breaches": self.breaches,
+            "breached": {vid: sorted(ids) for vid, ids in self.breached.items() if ids},
+            "check": self.check_hist.snapshot(),
+        }
+        if events:
+            out["events"] = list(self.events)[-events:]
+        return out
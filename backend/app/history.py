@@ -0,0 +1,132 @@
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .codec import TELEMETRY_FIELDS
+
+# Раскладка строки кольца — как в бинарном формате (codec.TELEMETRY_STRUCT):
+# ts и lat/lon в double, остальное float32. 64 байта на кадр.
+FRAME_DTYPE = np.dtype([
+    ("ts", "<f8"), ("seq", "<u4"),
+    ("imu_ax", "<f4"), ("imu_ay", "<f4"), ("imu_az", "<f4"),
+    ("yaw", "<f4"), ("pitch", "<f4"), ("roll", "<f4"),
+    ("lat", "<f8"), ("lon", "<f8"),
+    ("vx", "<f4"), ("vy", "<f4"), ("wz", "<f4"),
+])
+assert FRAME_DTYPE.names == TELEMETRY_FIELDS
+
+# Поля, по которым не ищут экстремумы при прореживании (ось времени / счётчик)
+_AXIS_FIELDS = ("ts", "seq")
+
+
+class UnknownField(ValueError):
+    pass
+
+
+def parse_fields(raw: Optional[str]) -> Sequence[str]:
+    """?fields=lat,lon → ("ts", "lat", "lon"); ts всегда первым. Пусто — все поля."""
+    if not raw:
+        return TELEMETRY_FIELDS
+    out: List[str] = ["ts"]
+    for f in (x.strip() for x in raw.split(",")):
+        if not f or f in out:
+            continue
+        if f not in FRAME_DTYPE.names:
+            raise UnknownField(f)
+        out.append(f)
+    return tuple(out)
+
+
+def minmax_rows(rows: np.ndarray, fields: Sequence[str], buckets: int) -> np.ndarray:
+    """
+    Min/max-прореживание: окно делится на buckets равных по числу кадров корзин,
+    в каждой остаются первый кадр и кадры с min/max каждого поля. Берутся целые
+    строки, а не отдельные экстремумы — пара lat/lon остаётся реальной точкой
+    трека, а пики на графиках не теряются. Результат — не больше
+    buckets × (1 + 2 × полей) строк в исходном порядке.
+    """
+    n = len(rows)
+    if buckets <= 0 or n <= buckets:
+        return rows
+    k = -(-n // buckets)  # кадров в корзине (последняя может быть неполной)
+    b = -(-n // k)
+    starts = np.arange(b) * k
+    keep = [starts]
+    pad = b * k - n
+    for f in fields:
+        if f in _AXIS_FIELDS:
+            continue
+        col = rows[f].astype(np.float64)
+        if pad:
+            col = np.concatenate((col, np.full(pad, np.nan)))
+        grid = col.reshape(b, k)
+        keep.append(starts + np.nanargmin(grid, axis=1))
+        keep.append(starts + np.nanargmax(grid, axis=1))
+    return rows[np.unique(np.concatenate(keep))]
+
+
+def _column(rows: np.ndarray, f: str) -> list:
+    col = rows[f]
+    if col.dtype == np.float32:
+        # float32 → double даёт хвосты вида 0.10000000149; в JSON это лишние байты
+        return col.astype(np.float64).round(5).tolist()
+    return col.tolist()
+
+
+class TelemetryHistory:
+    """
+    Кольцевой буфер последних кадров одного аппарата на структурированном
+    массиве NumPy: память фиксирована (capacity × 64 байта), запись — одна
+    строка без аллокаций. Пишет event loop, читают запросы истории (в том числе
+    из threadpool), поэтому вставка и снимок — под коротким lock.
+    """
+
+    def __init__(self, capacity: int = 3000):
+        self.capacity = max(1, capacity)
+        self._buf = np.zeros(self.capacity, dtype=FRAME_DTYPE)
+        self._head = 0     # куда писать следующий кадр
+        self.count = 0     # сколько кадров в кольце (≤ capacity)
+        self.total = 0     # сколько кадров записано всего
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, frame):
+        row = tuple(getattr(frame, f) for f in TELEMETRY_FIELDS)
+        with self._lock:
+            self._buf[self._head] = row
+            self._head = (self._head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            self.total += 1
+
+    def snapshot(self) -> np.ndarray:
+        """Копия содержимого в порядке записи (от старых к новым)."""
+        with self._lock:
+            if self.count < self.capacity:
+                return self._buf[:self.count].copy()
+            return np.concatenate((self._buf[self._head:], self._buf[:self._head]))
+
+    def query(self, since: Optional[float] = None, fields: Sequence[str] = TELEMETRY_FIELDS,
+              decimate: Optional[int] = None) -> Dict:
+        """
+        Кадры с ts > since, колонками: {"ts": [...], "lat": [...], ...}.
+        decimate=N — min/max-прореживание до ~N корзин (см. minmax_rows).
+        """
+        rows = self.snapshot()
+        if since is not None:
+            rows = rows[rows["ts"] > since]
+        matched = len(rows)
+        if decimate:
+            rows = minmax_rows(rows, fields, decimate)
+        return {
+            "count": len(rows),
+            "matched": matched,
+            "decimated": len(rows) < matched,
+            "columns": {f: _column(rows, f) for f in fields},
+        }
+
+    def stats(self) -> Dict:
+        return {"capacity": self.capacity, "count": self.count, "total": self.total}
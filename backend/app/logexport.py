@@ -0,0 +1,206 @@
+import bisect
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+from .logwriter import INDEX_ENTRY, INDEX_MAGIC
+
+CSV_COLUMNS = ["ts", "lat", "lon", "vx", "vy", "wz", "idx", "vehicle_id"]
+CHUNK_BYTES = 64 * 1024
+
+
+def segments(path: str) -> List[str]:
+    """Файлы лога от самого старого к самому новому: path.N(.gz) … path.1(.gz), path."""
+    i = 1
+    rotated = []
+    while True:
+        found = None
+        for cand in (f"{path}.{i}", f"{path}.{i}.gz"):
+            if os.path.exists(cand):
+                found = cand
+        if not found:
+            break
+        rotated.append(found)
+        i += 1
+    out = rotated[::-1]
+    if os.path.exists(path):
+        out.append(path)
+    return out
+
+
+def _index_path(seg: str) -> str:
+    return (seg[:-3] if seg.endswith(".gz") else seg) + ".idx"
+
+
+class LogIndex:
+    """Блоки сайдкара одного сегмента: ts начала, [off, off + length), диапазон idx [lo, hi]."""
+
+    __slots__ = ("ts", "off", "length", "lo", "hi")
+
+    def __init__(self):
+        self.ts, self.off, self.length = array("d"), array("Q"), array("L")
+        self.lo, self.hi = array("l"), array("l")
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def ranges(self, t_from: Optional[float], t_to: Optional[float], idx: Optional[int]) -> List[Tuple[int, Optional[int]]]:
+        """Байтовые диапазоны, которые нужно прочитать (end=None — до конца файла)."""
+        n = len(self.ts)
+        if not n:
+            return [(0, None)]
+        out: List[Tuple[int, Optional[int]]] = []
+
+        def add(a: int, b: Optional[int]):
+            if out and out[-1][1] == a:
+                out[-1] = (out[-1][0], b)  # соседние блоки — одним чтением
+            else:
+                out.append((a, b))
+
+        # начало файла без блоков (индекс потерян или был старого формата) — целиком
+        if self.off[0] > 0 and (t_from is None or t_from < self.ts[0]):
+            add(0, self.off[0])
+        first = 0
+        if t_from is not None:
+            first = max(0, bisect.bisect_right(self.ts, t_from) - 1)
+        for i in range(first, n):
+            if t_to is not None and self.ts[i] > t_to:
+                return out
+            if idx is not None and not self.lo[i] <= idx <= self.hi[i]:
+                continue
+            add(self.off[i], self.off[i] + self.length[i])
+        # хвост после последнего закрытого блока в индексе ещё не описан
+        add(self.off[n - 1] + self.length[n - 1], None)
+        return out
+
+
+def load_index(seg: str) -> LogIndex:
+    """Блоки из сайдкара; пустой индекс, если сайдкара нет или он старого формата."""
+    ix = LogIndex()
+    try:
+        with open(_index_path(seg), "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return ix
+    if not raw.startswith(INDEX_MAGIC):
+        return ix
+    raw = raw[len(INDEX_MAGIC):]
+    n = len(raw) // INDEX_ENTRY.size
+    for t, o, ln, lo, hi in INDEX_ENTRY.iter_unpack(raw[: n * INDEX_ENTRY.size]):
+        ix.ts.append(t)
+        ix.off.append(o)
+        ix.length.append(ln)
+        ix.lo.append(lo)
+        ix.hi.append(hi)
+    return ix
+
+
+def _open(seg: str):
+    return gzip.open(seg, "rb") if seg.endswith(".gz") else open(seg, "rb")
+
+
+def iter_records(
+    path: str,
+    t_from: Optional[float] = None,
+    t_to: Optional[float] = None,
+    idx: Optional[int] = None,
+    vehicle: Optional[str] = None,
+) -> Iterator[dict]:
+    """
+    Записи лога в диапазоне [t_from, t_to] (и с заданным idx/аппаратом), по всем сегментам.
+    По индексу пропускаются целые сегменты, а внутри сегмента читаются только блоки,
+    которые пересекают диапазон времени и содержат нужный idx (seek к каждому);
+    строки внутри прочитанных блоков фильтруются как обычно.
+    """
+    segs = segments(path)
+    indexes = [load_index(s) for s in segs]
+    for n, seg in enumerate(segs):
+        ix = indexes[n]
+        if t_to is not None and len(ix) and ix.ts[0] > t_to:
+            break
+        # весь сегмент раньше диапазона: следующий начинается не позже t_from
+        if t_from is not None and n + 1 < len(segs):
+            nxt = indexes[n + 1]
+            if len(nxt) and nxt.ts[0] <= t_from:
+                continue
+        ranges = ix.ranges(t_from, t_to, idx)
+        if not ranges:
+            continue
+        try:
+            f = _open(seg)
+        except FileNotFoundError:
+            continue
+        with f:
+            for start, end in ranges:
+                f.seek(start)
+                pos = start
+                for line in f:
+                    pos += len(line)
+                    try:
+                        j = json.loads(line)
+                    except ValueError:
+                        j = None
+                    if j is not None:
+                        t = j.get("ts")
+                        if t_to is not None and t is not None and t > t_to:
+                            return
+                        if (
+                            (t_from is None or t is None or t >= t_from)
+                            and (idx is None or j.get("idx") == idx)
+                            # старые записи без vehicle_id — от единственного борта
+                            and (vehicle is None or j.get("vehicle_id", "default") == vehicle)
+                        ):
+                            yield j
+                    if end is not None and pos >= end:
+                        break
+
+
+def iter_csv(path: str, **query) -> Iterator[str]:
+    """CSV кусками ~64 КБ — для StreamingResponse, память не растёт с длиной миссии."""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(CSV_COLUMNS)
+    for j in iter_records(path, **query):
+        w.writerow([j.get(c) for c in CSV_COLUMNS])
+        if buf.tell() >= CHUNK_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def iter_parquet(path: str, row_group: int = 65_536, **query) -> Iterator[bytes]:
+    """
+    Parquet-экспорт (нужен pyarrow). Row group'ы пишутся во временный файл по мере
+    чтения лога, затем файл отдаётся кусками — весь лог в памяти не держится.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("ts", pa.float64()), ("lat", pa.float64()), ("lon", pa.float64()),
+        ("vx", pa.float64()), ("vy", pa.float64()), ("wz", pa.float64()), ("idx", pa.int32()), ("vehicle_id", pa.string()),
+    ])
+    with tempfile.TemporaryFile() as tmp:
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+            cols = {c: [] for c in CSV_COLUMNS}
+            for j in iter_records(path, **query):
+                for c in CSV_COLUMNS:
+                    cols[c].append(j.get(c))
+                if len(cols["ts"]) >= row_group:
+                    writer.write_table(pa.table(cols, schema=schema))
+                    cols = {c: [] for c in CSV_COLUMNS}
+            if cols["ts"]:
+                writer.write_table(pa.table(cols, schema=schema))
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,261 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+# Сайдкар-индекс <path>.idx: заголовок INDEX_MAGIC, затем запись на блок строк лога —
+# ts первой строки, смещение и длина блока в байтах, min/max поля idx (точка маршрута)
+# в блоке; без idx — lo > hi. Little-endian f64, u64, u32, i32, i32.
+INDEX_MAGIC = b"RIX2"
+INDEX_ENTRY = struct.Struct("<dQIii")
+# Ошибки записи (полный диск, отвалившаяся SD-карта) — в лог не чаще раза в столько секунд
+ERROR_LOG_EVERY_S = 30.0
+
+log = logging.getLogger(__name__)
+
+
+class JsonlLogger:
+    """
+    Асинхронный JSONL-логгер: write() только кладёт запись в кольцевой буфер,
+    на диск пишет фоновая задача пачками (по размеру или по времени) через
+    asyncio.to_thread — event loop с управляющим трафиком не ждёт SD-карту.
+    Файл ротируется по размеру (path.1 … path.N), старые сегменты можно жать в gzip.
+    С index_every_s рядом ведётся <path>.idx: лог режется на блоки по index_every_s,
+    на блок — ts начала, байтовый диапазон и диапазон idx; выборки по времени и по
+    точке маршрута читают только подходящие блоки. Запись блока появляется, когда
+    блок закрыт, — хвост файла после последней записи читается подряд.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval_s: float = 1.0,
+        flush_batch: int = 256,
+        ring_size: int = 20_000,
+        max_bytes: int = 50 * 1024 * 1024,
+        backups: int = 5,
+        compress: bool = False,
+        index_every_s: float = 0.0,
+    ):
+        self.path = path
+        self.flush_interval_s = flush_interval_s
+        self.flush_batch = flush_batch
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.index_every_s = index_every_s
+
+        self._buf: deque = deque(maxlen=ring_size)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._inflight: Optional[asyncio.Future] = None
+        self._fh = None
+        self._idx_fh = None
+        self._block: Optional[List] = None  # открытый блок индекса: [ts, offset, length, lo, hi]
+
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._error_logged_mono = float("-inf")
+        self._errors_suppressed = 0
+
+    # ---------- hot path (event loop) ----------
+    def write(self, record: Dict):
+        if len(self._buf) == self._buf.maxlen:
+            # буфер переполнен (диск не успевает) — теряем самые старые записи
+            self.dropped += 1
+        self._buf.append(record)
+        if len(self._buf) >= self.flush_batch:
+            self._wake.set()
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # отмена задачи не останавливает поток: ждём начатую пачку, иначе
+        # _close закроет файл посреди записи
+        if self._inflight is not None:
+            await asyncio.wait({self._inflight})
+        await self.flush()
+        await asyncio.to_thread(self._close)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buf:
+                return
+            batch = list(self._buf)
+            self._buf.clear()
+            # пачка — отдельный future: учёт и ошибки — по её завершению, даже если
+            # ожидающую задачу отменили (stop)
+            fut = self._inflight = asyncio.ensure_future(asyncio.to_thread(self._write_batch, batch))
+            fut.add_done_callback(lambda f, n=len(batch): self._batch_done(f, n))
+            try:
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass  # уже учтено в _batch_done
+
+    def _batch_done(self, fut: asyncio.Future, n: int):
+        if fut is self._inflight:
+            self._inflight = None
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is None:
+            self.written += n
+            self.flushes += 1
+            return
+        self.errors += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+        now = time.monotonic()
+        if now - self._error_logged_mono < ERROR_LOG_EVERY_S:
+            # полный диск падает на каждой пачке — не забиваем stdout
+            self._errors_suppressed += 1
+            return
+        more = f" ({self._errors_suppressed} more since last report)" if self._errors_suppressed else ""
+        log.warning("write to %s failed: %s%s", self.path, self.last_error, more)
+        self._error_logged_mono = now
+        self._errors_suppressed = 0
+
+    # ---------- writer thread ----------
+    def _write_batch(self, batch: List[Dict]):
+        if self._fh is None:
+            self._fh = open(self.path, "ab")
+        lines = [(json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8") for r in batch]
+        if self.index_every_s > 0:
+            self._write_index(batch, lines, self._fh.tell())
+        self._fh.write(b"".join(lines))
+        self._fh.flush()
+        if self.max_bytes and self._fh.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _write_index(self, batch: List[Dict], lines: List[bytes], offset: int):
+        if self._idx_fh is None:
+            self._idx_fh = self._open_index()
+            self._block = None
+        entries = []
+        blk = self._block
+        for rec, line in zip(batch, lines):
+            ts = rec.get("ts")
+            has_ts = isinstance(ts, (int, float))
+            if blk is not None and has_ts and ts - blk[0] >= self.index_every_s:
+                entries.append(INDEX_ENTRY.pack(*blk))
+                blk = None
+            if blk is None:
+                blk = [float(ts) if has_ts else 0.0, offset, 0, 1, 0]
+            blk[2] += len(line)
+            i = rec.get("idx")
+            if isinstance(i, int) and not isinstance(i, bool):
+                if blk[3] > blk[4]:
+                    blk[3] = blk[4] = i
+                else:
+                    blk[3], blk[4] = min(blk[3], i), max(blk[4], i)
+            offset += len(line)
+        self._block = blk
+        if entries:
+            self._idx_fh.write(b"".join(entries))
+            self._idx_fh.flush()
+
+    def _open_index(self):
+        path = self.path + ".idx"
+        try:
+            with open(path, "rb") as f:
+                head = f.read(len(INDEX_MAGIC))
+        except FileNotFoundError:
+            head = b""
+        if head != INDEX_MAGIC:
+            # нет индекса или старый формат (без блоков) — начинаем заново; строки
+            # до первого блока экспорт читает подряд
+            with open(path, "wb") as f:
+                f.write(INDEX_MAGIC)
+        return open(path, "ab")
+
+    def _close_block(self):
+        if self._block is not None and self._idx_fh is not None:
+            self._idx_fh.write(INDEX_ENTRY.pack(*self._block))
+            self._idx_fh.flush()
+        self._block = None
+
+    def _rotate(self):
+        self._close()
+        # path.N самый старый — выкидываем, остальные сдвигаем
+        for i in range(self.backups - 1, 0, -1):
+            for e in ("", ".gz", ".idx"):
+                src = f"{self.path}.{i}{e}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}{e}")
+        if self.backups > 0:
+            dst = f"{self.path}.1"
+            os.replace(self.path, dst)
+            if os.path.exists(self.path + ".idx"):
+                os.replace(self.path + ".idx", dst + ".idx")
+            if self.compress:
+                with open(dst, "rb") as fi, gzip.open(dst + ".gz", "wb") as fo:
+                    shutil.copyfileobj(fi, fo)
+                os.remove(dst)
+        else:
+            os.remove(self.path)
+            if os.path.exists(self.path + ".idx"):
+                os.remove(self.path + ".idx")
+        self.rotations += 1
+
+    def _close(self):
+        self._close_block()
+        for name in ("_fh", "_idx_fh"):
+            fh = getattr(self, name)
+            if fh is not None:
+                fh.close()
+                setattr(self, name, None)
+
+    def stats(self) -> Dict:
+        return {
+            "path": self.path,
+            "buffered": len(self._buf),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "rotations": self.rotations,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+def logger_from_env(path: str, prefix: str, index_every_s: float = 0.0) -> JsonlLogger:
+    """JsonlLogger с настройками из окружения: <PREFIX>_MAX_MB, <PREFIX>_BACKUPS, LOG_COMPRESS, LOG_FLUSH_S."""
+    return JsonlLogger(
+        path,
+        flush_interval_s=float(os.getenv("LOG_FLUSH_S", "1.0")),
+        max_bytes=int(float(os.getenv(f"{prefix}_MAX_MB", "50")) * 1024 * 1024),
+        backups=int(os.getenv(f"{prefix}_BACKUPS", "5")),
+        compress=os.getenv("LOG_COMPRESS", "0") == "1",
+        index_every_s=index_every_s,
+    )
@@ -1,212 +1,658 @@
 import math
+import os
 import time
 import json
 import asyncio
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 _qos_log: list[Dict] = []
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
-
-from .schemas import TelemetryFrame, DriveCommand, CommandAck, Metrics, Mission, Waypoint
-from .state import STATE, MISSION
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response, Query, Body
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+
+from .codec import (DELTA_QUANT, TELEMETRY_FIELDS, DeltaDecoder, DeltaDemux, EncodedFrame, decode_message,
+                    encode_event, negotiate, normalize_frame)
+from .history import UnknownField, parse_fields
+from .schemas import TelemetryFrame, DriveCommand, CommandAck, Metrics, Mission, Waypoint, Geofences
+from .state import STATE, MISSION, DEFAULT_VEHICLE, valid_vehicle_id
+from .commands import MANUAL
+from .control import ControlHub
+from .geo import GeofenceMonitor, Route
+from .profiler import SamplingProfiler
+from .stats import PERF, LoopLagMonitor
+from .logwriter import logger_from_env
+from .assets import assets_from_env
+from .logexport import iter_csv, iter_parquet
+from .media import VideoUnavailable, video_from_env
+from .mission import DriverPool
+from .recorder import recorder_from_env
+from .summary import MetricsWatch
 
 app = FastAPI(title="ROCU-Lite Backend", version="0.1.0")
 
+# Логи пишутся фоновыми задачами пачками — без файлового I/O в event loop
+MISSION_LOG = logger_from_env(MISSION.log_path, "MISSION_LOG", index_every_s=1.0)
+QOS_LOG = logger_from_env(os.environ.get("QOS_LOG", "/tmp/rocu_qos.jsonl"), "QOS_LOG")
+# Автопилоты по аппаратам: будятся телеметрией, частота — MISSION_CONTROL_HZ
+DRIVERS = DriverPool(MISSION_LOG, bus=STATE.bus, on_state=lambda vid, m: _publish_mission(vid, m))
+# Ручное управление по постоянному сокету /ws/control
+CONTROL = ControlHub(STATE)
+# Видеостек (cv2/av/aiortc) — лениво, на первом offer; VIDEO_ENABLED=0 — не грузить вовсе
+VIDEO = video_from_env()
+# UI: статика из памяти, заранее сжатая, с ETag; сводка метрик — push/long-poll по изменению
+ASSETS = assets_from_env("static")
+METRICS_TS_RES_S = float(os.getenv("METRICS_TS_RES_S", "1"))
+
+def _summary(vehicle_id: str) -> Dict:
+    # только то, что показывает UI; ts — с точностью METRICS_TS_RES_S, иначе
+    # сводка менялась бы с каждым кадром телеметрии
+    v = STATE.vehicle(vehicle_id)
+    res = METRICS_TS_RES_S
+    ts = lambda x: round(round(x / res) * res, 3) if x else None
+    return {
+        "vehicle_id": vehicle_id,
+        "sim_connected": bool(v is not None and v.connected),
+        "safe_mode": bool(v is not None and v.safe_mode),
+        "telemetry_clients": len(STATE.fanout),
+        "last_telemetry_ts": ts(v.last_telemetry_ts) if v is not None else None,
+        "last_cmd_ts": ts(v.last_cmd_ts) if v is not None else None,
+        "mission": {"active": v.mission.active, "paused": v.mission.paused, "idx": v.mission.current_idx}
+        if v is not None else None,
+        "uptime_s": round(STATE.uptime(), 1),
+    }
+
+METRICS_WATCH = MetricsWatch(_summary, interval_s=float(os.getenv("METRICS_WATCH_MS", "500")) / 1000.0)
+# Бортовая запись кольцом сегментов (REC_*); REC_ENABLED=1 — писать с самого старта
+RECORDER = recorder_from_env()
+
+# Геозоны: каждый кадр телеметрии проверяется по сеточному индексу (GEOFENCE_CELL_M — высота полосы)
+GEOFENCES = GeofenceMonitor(STATE.fanout, cell_m=float(os.getenv("GEOFENCE_CELL_M", "25")))
+
+# Инструментация горячего пути: гистограммы в PERF → /metrics (Prometheus) и /api/v1/perf
+_H_SIM = {stage: PERF.histogram("ws_sim_stage", "ws_sim per-frame stage time", stage=stage)
+          for stage in ("parse", "validate", "publish", "broadcast")}
+_H_CMD_DRIVE = PERF.histogram("cmd_drive", "POST /api/v1/cmd/drive handler time, incl. ack wait")
+LOOP_LAG = LoopLagMonitor(
+    PERF.histogram("event_loop_lag", "event loop wakeup lateness"),
+    interval_s=float(os.getenv("LOOP_LAG_INTERVAL_MS", "100")) / 1000.0,
+)
+# PROFILER=1 — сэмплировать стек event loop с самого старта; иначе POST /api/v1/debug/profiler
+PROFILER = SamplingProfiler(interval_s=float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000.0)
+
+# --- несколько воркеров: общее состояние через шину (STATE_BACKEND) ----------------
+# Каждый воркер держит зеркало: кадры чужих симов ("tele") идут в его историю,
+# автопилот и UI-клиентов; "owner" — у кого сокет сима; команды к чужому симу
+# уходят "cmd" владельцу, ack — обратно "ack"; миссии — "mission". Автопилот
+# аппарата крутит один воркер — держатель flock mission-<vehicle>.
+BUS = STATE.bus
+
+def _publish_mission(vehicle_id: str, m, waypoints: bool = False):
+    if not BUS.distributed:
+        return
+    msg = {"v": vehicle_id, "active": m.active, "paused": m.paused, "rtl": m.rtl,
+           "home": m.home, "idx": m.current_idx}
+    if waypoints:
+        msg["waypoints"] = m.waypoints
+    BUS.publish("mission", msg)
+
+def _bus_owner(topic: str, msg: Dict):
+    vid, worker = msg["v"], msg["w"]
+    if not valid_vehicle_id(vid):
+        return
+    v = STATE.fleet.ensure(vid)
+    if msg["on"]:
+        v.remote_owner = worker
+        # dead-man switch аппарата теперь у нового владельца
+        STATE.safety.forget(vid)
+        ws = v.sim_websocket
+        if ws is not None:
+            # борт переподключился к другому воркеру — наш сокет устарел (takeover)
+            v.sim_websocket = None
+            v.takeovers += 1
+            STATE.acks.fail_link(vid)
+            asyncio.create_task(ws.close(code=4000))
+    elif v.remote_owner == worker:
+        v.remote_owner = None
+        STATE.acks.fail_link(vid)
+
+async def _bus_tele(topic: str, msg: Dict):
+    if not valid_vehicle_id(msg["v"]):
+        return
+    v = STATE.fleet.ensure(msg["v"])
+    d = msg["d"]
+    await v.publish_frame(TelemetryFrame.model_construct(**{k: d[k] for k in TELEMETRY_FIELDS}))
+    GEOFENCES.check(v.vehicle_id, d["lat"], d["lon"])
+    _broadcast_to_clients(v, d)
+
+def _bus_cmd(topic: str, msg: Dict):
+    # уставка с другого воркера — в наш планировщик наравне со своими: heartbeat
+    # watchdog'а, приоритет ручного управления, лимит частоты
+    v = STATE.vehicle(msg["v"])
+    if v is not None and v.sim_websocket is not None:
+        v.touch_cmd()
+        v.commands.submit(msg["data"], msg["source"], msg.get("id"))
+
+def _bus_ack(topic: str, msg: Dict):
+    for cmd_id in msg["ids"]:
+        if cmd_id in STATE.acks.pending:
+            STATE.acks.resolve(cmd_id)
+
+def _bus_touch(topic: str, msg: Dict):
+    v = STATE.vehicle(msg["v"])
+    if v is not None and v.sim_websocket is None:
+        v.touch_remote(msg["ts"])
+
+def _bus_safety(topic: str, msg: Dict):
+    if valid_vehicle_id(msg.get("vehicle_id", "")):
+        STATE.safety.deliver(msg)
+
+def _bus_mission(topic: str, msg: Dict):
+    v = _fleet_vehicle(msg["v"])
+    if v is None:
+        return
+    m = v.mission
+    if "waypoints" in msg:
+        m.waypoints = msg["waypoints"]
+        m.route = Route(m.waypoints) if m.waypoints else None
+    m.active, m.paused, m.rtl = msg["active"], msg["paused"], msg["rtl"]
+    m.home, m.current_idx = msg["home"], msg["idx"]
+    if m.active and not m.paused:
+        DRIVERS.ensure(v.vehicle_id, v, m)
+
+def _bus_gone(topic: str, msg: Dict):
+    # воркер отключился от шины — его симов больше нет (переподключатся к живым)
+    for v in STATE.fleet:
+        if v.remote_owner is not None and v.remote_owner == msg["worker"]:
+            v.remote_owner = None
+            STATE.acks.fail_link(v.vehicle_id)
+
+def _bus_sync(topic: str = "", msg: Optional[Dict] = None):
+    # свои симы и миссии, которыми рулим: новому участнику или всем после переподключения
+    for v in STATE.fleet:
+        if v.sim_websocket is not None:
+            BUS.publish("owner", {"v": v.vehicle_id, "w": BUS.worker_id, "on": True})
+    for drv in list(DRIVERS.drivers.values()):
+        if drv.leader is not None and drv.leader.held:
+            _publish_mission(drv.vehicle_id, drv.mission, waypoints=True)
+
+def _bus_connected():
+    # (пере)подключились: чужие владельцы могли смениться, пока нас не было —
+    # сбрасываем и просим всех повторить анонсы
+    for v in STATE.fleet:
+        v.remote_owner = None
+    _bus_sync()
+
+BUS.subscribe("owner", _bus_owner)
+BUS.subscribe("tele", _bus_tele)
+BUS.subscribe("cmd", _bus_cmd)
+BUS.subscribe("ack", _bus_ack)
+BUS.subscribe("touch", _bus_touch)
+BUS.subscribe("safety", _bus_safety)
+BUS.subscribe("mission", _bus_mission)
+BUS.subscribe("video.max_kbps", lambda topic, msg: VIDEO.set_max_kbps(msg["kbps"]))
+BUS.subscribe("bus.hello", _bus_sync)
+BUS.subscribe("bus.gone", _bus_gone)
+BUS.on_connect(_bus_connected)
+
 @app.on_event("startup")
 async def _startup():
-    asyncio.create_task(mission_driver())
+    MISSION_LOG.start()
+    QOS_LOG.start()
+    LOOP_LAG.start()
+    await BUS.start()
+    PROFILER.bind()
+    if os.getenv("PROFILER") == "1":
+        PROFILER.start()
+    if VIDEO.preload and VIDEO.enabled:
+        # контур управления уже готов; видео догружается в фоне
+        asyncio.create_task(VIDEO.warm())
+    if os.getenv("REC_ENABLED") == "1":
+        asyncio.create_task(_start_recorder(_rec_src()))
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await RECORDER.stop()
+    await VIDEO.close_all()
+    await DRIVERS.stop_all()
+    await STATE.safety.close()
+    await BUS.close()
+    await LOOP_LAG.stop()
+    PROFILER.stop()
+    await MISSION_LOG.stop()
+    await QOS_LOG.stop()
 
 @app.get("/health")
 def health():
     return {"status": "ok", "uptime_s": STATE.uptime()}
 
 @app.get("/api/v1/metrics", response_model=Metrics)
-def metrics():
+async def metrics():
+    # верхнеуровневые поля — аппарат по умолчанию (однобортовой UI), флот — в vehicles.
+    # async — снимок на event loop: флот, каналы и ack'и меняются на нём при каждом подключении
+    v = STATE.default
     return Metrics(
-        safe_mode=STATE.safe_mode,
-        last_cmd_ts=STATE.last_cmd_ts,
-        last_telemetry_ts=STATE.last_telemetry_ts,
-        telemetry_clients=len(STATE.telemetry_clients),
-        sim_connected=STATE.sim_websocket is not None,
+        safe_mode=v.safe_mode,
+        last_cmd_ts=v.last_cmd_ts,
+        last_telemetry_ts=v.last_telemetry_ts,
+        telemetry_clients=len(STATE.fanout),
+        sim_connected=v.connected,
         uptime_s=STATE.uptime(),
+        fanout=STATE.fanout.stats(),
+        cmd_rtt=STATE.acks.stats(),
+        logs=[MISSION_LOG.stats(), QOS_LOG.stats()],
+        video=VIDEO.stats(),
+        video_sources=VIDEO.sources_stats(),
+        video_peers=VIDEO.peers_stats(),
+        recorder=RECORDER.stats(),
+        static_assets=ASSETS.stats(),
+        metrics_watch=METRICS_WATCH.stats(),
+        mission_drivers=DRIVERS.stats(),
+        vehicles=STATE.fleet.stats(),
+        safety=STATE.safety.stats(),
+        control=CONTROL.stats(),
+        geofences=GEOFENCES.stats(),
+        bus=BUS.stats(),
     )
 
+@app.get("/api/v1/metrics/summary")
+async def metrics_summary(request: Request, vehicle: str = Query(DEFAULT_VEHICLE), wait: float = Query(0.0, le=60.0)):
+    """
+    Короткая сводка для UI. С If-None-Match и wait=N — long-poll: ответ, как
+    только сводка изменится, иначе через N секунд 304 без тела.
+    """
+    if not valid_vehicle_id(vehicle):
+        return JSONResponse({"error": "bad vehicle id"}, status_code=400)
+    got = await METRICS_WATCH.wait(vehicle, request.headers.get("if-none-match"), wait)
+    if got is None:
+        return Response(status_code=304)
+    tag, summary = got
+    return JSONResponse(summary, headers={"ETag": tag, "Cache-Control": "no-cache"})
+
+@app.get("/api/v1/safety")
+async def safety(events: int = 50):
+    # счётчики watchdog'а, гистограммы trigger→stop и последние переходы safe mode
+    return STATE.safety.stats(events=events)
+
+def _collect_state():
+    # то, что уже считается в объектах состояния, — в тот же экспорт
+    for link, h in list(STATE.acks.rtt.items()):
+        yield "histogram", "cmd_ack_rtt", "drive command → sim ack", {"vehicle": link}, h
+    for link, n in list(STATE.acks.timeouts.items()):
+        yield "counter", "cmd_ack_timeouts", "drive commands without ack", {"vehicle": link}, n
+    yield "histogram", "safety_trigger_lag", "heartbeat deadline → watchdog timer", {}, STATE.safety.trigger_lag
+    yield "histogram", "safety_trigger_to_stop", "heartbeat deadline → acked stop", {}, STATE.safety.trigger_to_stop
+    yield "histogram", "control_rtt", "/ws/control command → sim ack", {}, CONTROL.rtt
+    yield "gauge", "uptime_seconds", "", {}, round(STATE.uptime(), 1)
+    yield "counter", "geofence_breaches", "geofence breach transitions", {}, GEOFENCES.breaches
+    yield "gauge", "telemetry_clients", "", {}, len(STATE.fanout)
+    yield "gauge", "control_clients", "", {}, len(CONTROL.clients)
+    yield "gauge", "vehicles_connected", "", {}, STATE.fleet.connected()
+    chans = list(STATE.fanout.channels.values())
+    yield "counter", "fanout_sent", "telemetry messages sent to UI", {}, sum(c.sent for c in chans)
+    yield "counter", "fanout_dropped", "telemetry messages dropped for slow UI", {}, sum(c.dropped for c in chans)
+    for v in STATE.fleet:
+        lbl = {"vehicle": v.vehicle_id}
+        yield "counter", "telemetry_frames", "", lbl, v.frame_count
+        yield "gauge", "safe_mode", "", lbl, int(v.safe_mode)
+        c = v.commands
+        yield "counter", "cmd_sent", "drive commands sent to sim", lbl, c.sent
+        yield "counter", "cmd_coalesced", "", lbl, c.coalesced
+        yield "counter", "cmd_dropped", "", dict(lbl, reason="override"), c.dropped_override
+        yield "counter", "cmd_dropped", "", dict(lbl, reason="stale"), c.dropped_stale
+
+PERF.collect(_collect_state)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus():
+    # Prometheus text exposition; гистограммы — в секундах. На event loop, как и metrics()
+    return PlainTextResponse(PERF.prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/v1/perf")
+async def perf():
+    # те же данные JSON-снимком (мс), плюс состояние профайлера
+    return {"ts": time.time(), "metrics": PERF.snapshot(), "profiler": PROFILER.stats()}
+
+@app.post("/api/v1/debug/profiler")
+def profiler_ctl(payload: dict = Body(...)):
+    # {"action": "start"|"stop"|"reset", "interval_ms": 5}
+    act = (payload.get("action") or "").lower()
+    if act == "start":
+        PROFILER.start(float(payload.get("interval_ms") or 0) / 1000.0 or None)
+    elif act == "stop":
+        PROFILER.stop()
+    elif act == "reset":
+        PROFILER.reset()
+    else:
+        return JSONResponse({"error": "action must be start|stop|reset"}, status_code=400)
+    return PROFILER.stats()
+
+@app.get("/api/v1/debug/profiler", response_class=PlainTextResponse)
+def profiler_dump(limit: int = 500):
+    # свёрнутые стеки: flamegraph.pl / speedscope / inferno
+    return PlainTextResponse(PROFILER.folded(limit))
+
 @app.post("/api/v1/cmd/drive", response_model=CommandAck)
-async def cmd_drive(cmd: DriveCommand, request: Request):
-    # Update heartbeat timestamp
-    STATE.last_cmd_ts = time.time()
-    STATE.last_cmd_mono = time.monotonic()
+async def cmd_drive(cmd: DriveCommand, request: Request, vehicle: str = Query(DEFAULT_VEHICLE)):
+    t_in = time.perf_counter()
+    # Update heartbeat timestamp (неизвестный аппарат в реестр не заводим)
+    v = STATE.vehicle(vehicle)
+    if v is not None:
+        v.touch_cmd()
 
     # Forward to simulator if connected; measure RTT via explicit ack
-    start = time.time()
+    start = time.monotonic()
     accepted = False
-    if STATE.sim_websocket is not None:
-        try:
-            payload = {
-                "type": "command",
-                "command": "drive",
-                "data": cmd.model_dump(),
-            }
-            await STATE.sim_websocket.send_text(json.dumps(payload))
-
-            # Wait briefly for ack (non-blocking timeout)
-            # In a more robust system, use correlation IDs
-            await asyncio.sleep(0.01)
-            accepted = True
-        except Exception:
-            accepted = False
+    cmd_id = None
+    rtt_ms = None
+    if v is not None and v.connected:
+        cmd_id, fut = STATE.acks.register(v.vehicle_id)
+        # в планировщик аппарата: если до отправки придёт более новая уставка,
+        # эта не уйдёт, а ack новой подтвердит и её (RTT — от этого запроса)
+        v.submit(cmd.model_dump(), MANUAL, cmd_id)
+        # Возвращаемся сразу по ack (или по таймауту CMD_ACK_TIMEOUT_MS)
+        rtt_ms = await STATE.acks.wait(cmd_id, fut)
+        accepted = rtt_ms is not None
+
+    if rtt_ms is None:
+        rtt_ms = (time.monotonic() - start) * 1000.0
+    _H_CMD_DRIVE.record((time.perf_counter() - t_in) * 1000.0)
+    return CommandAck(accepted=accepted, ts=time.time(), rtt_ms=rtt_ms, id=cmd_id)
+
+@app.websocket("/ws/control")
+async def ws_control(websocket: WebSocket):
+    # ?vehicle=<id> — кем управляем; ?fmt=bin — ack'и бинарные (команды принимаются в обоих видах)
+    vehicle_id = websocket.query_params.get("vehicle") or DEFAULT_VEHICLE
+    if not valid_vehicle_id(vehicle_id):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    fmt = "bin" if websocket.query_params.get("fmt") == "bin" else "json"
+    await websocket.send_text(json.dumps({"type": "hello", "fmt": fmt, "vehicle_id": vehicle_id}))
+    try:
+        await CONTROL.serve(websocket, vehicle_id, fmt)
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        pass
 
-    rtt_ms = (time.time() - start) * 1000.0
-    return CommandAck(accepted=accepted, ts=time.time(), rtt_ms=rtt_ms)
+def _history(v, since: Optional[float], fields, decimate: Optional[int]) -> Dict[str, Any]:
+    # since < 0 — относительно текущего момента: since=-60 → последняя минута
+    if since is not None and since < 0:
+        since = time.time() + since
+    return {"type": "history", "vehicle_id": v.vehicle_id, "since": since,
+            **v.history.query(since, fields, decimate)}
+
+@app.get("/api/v1/telemetry/history")
+def telemetry_history(
+    vehicle: str = Query(DEFAULT_VEHICLE),
+    since: Optional[float] = None,
+    fields: Optional[str] = None,
+    decimate: Optional[int] = Query(None, ge=1),
+):
+    # sync-эндпоинт: снимок кольца и сериализация идут в threadpool, не в event loop
+    v = STATE.vehicle(vehicle)
+    if v is None:
+        return JSONResponse({"error": "unknown vehicle"}, status_code=404)
+    try:
+        flds = parse_fields(fields)
+    except UnknownField as e:
+        return JSONResponse({"error": f"unknown field: {e}"}, status_code=400)
+    return _history(v, since, flds, decimate)
+
+async def _send_backfill(ch, topics: List[str], seconds: float, fields, decimate: Optional[int]):
+    # История кладётся в начало очереди клиента — приходит раньше живых кадров.
+    # Клиент уже подписан, поэтому кадры, пришедшие пока считаем, не теряются
+    # (возможен повтор по ts на стыке — UI отбрасывает кадры не новее последнего).
+    vehicles = list(STATE.fleet) if "*" in topics else [v for v in map(STATE.vehicle, topics) if v]
+    fmt = ch.fmt
+
+    def build():
+        return [(v.vehicle_id, encode_event(_history(v, -seconds, fields, decimate), fmt))
+                for v in vehicles if len(v.history)]
+
+    for vid, msg in reversed(await asyncio.to_thread(build)):
+        ch.offer(msg, "history:" + vid, first=True)
+
+def _backfill_args(src) -> Optional[tuple]:
+    # ?backfill=<сек>[&fields=lat,lon][&decimate=N] (или те же ключи в subscribe)
+    try:
+        seconds = float(src.get("backfill") or 0)
+        decimate = int(src["decimate"]) if src.get("decimate") else None
+        fields = src.get("fields")
+        fields = parse_fields(",".join(map(str, fields)) if isinstance(fields, list) else fields)
+    except (TypeError, ValueError):
+        return None
+    if seconds <= 0:
+        return None
+    return seconds, fields, decimate
+
+def _hello(fmt: str, **extra) -> str:
+    msg = {"type": "hello", "fmt": fmt, **extra}
+    if fmt == "delta":
+        # шаги квантования и порядок полей — чтобы клиент мог разобрать ключевые кадры/дельты
+        msg["quant"] = DELTA_QUANT
+        msg["fields"] = TELEMETRY_FIELDS
+    return json.dumps(msg)
+
+def _send_keyframes(ch, topics: List[str]):
+    # delta-клиенту — текущий ключевой кадр аппаратов (подключение, subscribe, resync);
+    # вперёд очереди, чтобы дельты за ним сразу декодировались
+    if ch.fmt != "delta":
+        return
+    vehicles = list(STATE.fleet) if "*" in topics else [v for v in map(STATE.vehicle, topics) if v]
+    for v in vehicles:
+        if v.delta.key_payload is not None:
+            ch.offer(v.delta.key_payload, "key:" + v.vehicle_id, first=True)
+
+def _topics(raw) -> List[str]:
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    if not isinstance(raw, list):
+        return []
+    return [t for t in (str(x).strip() for x in raw) if t == "*" or valid_vehicle_id(t)]
 
 @app.websocket("/ws/telemetry")
 async def ws_telemetry(websocket: WebSocket):
     await websocket.accept()
-    STATE.telemetry_clients.add(websocket)
+    # ?fmt=json|msgpack|bin — формат выбирается на соединение, hello сообщает итог
+    fmt = negotiate(websocket.query_params.get("fmt"))
+    # ?vehicles=a,b (или *) — на какие аппараты подписан клиент; по умолчанию аппарат default
+    topics = _topics(websocket.query_params.get("vehicles") or DEFAULT_VEHICLE)
+    await websocket.send_text(_hello(fmt, vehicles=topics))
+    ch = STATE.fanout.add(websocket, fmt, topics)
+    _send_keyframes(ch, topics)
+    # ?metrics=1 — сводка метрик подписанных аппаратов событием при каждом изменении
+    pushed: Dict[str, Any] = {}
+
+    def _push_metrics(vids):
+        for vid in vids:
+            if vid == "*" or vid in pushed:
+                continue
+            fn = pushed[vid] = lambda tag, summary, vid=vid: ch.offer(
+                encode_event({"type": "metrics", "etag": tag, **summary}, ch.fmt), "metrics:" + vid)
+            METRICS_WATCH.subscribe(vid, fn)
+            fn(*METRICS_WATCH.current(vid))
+
+    def _unpush_metrics(vids):
+        for vid in vids:
+            fn = pushed.pop(vid, None)
+            if fn is not None:
+                METRICS_WATCH.unsubscribe(vid, fn)
+
+    push = websocket.query_params.get("metrics") in ("1", "true")
+    if push:
+        _push_metrics(topics)
     try:
+        bf = _backfill_args(websocket.query_params)
+        if bf:
+            await _send_backfill(ch, topics, *bf)
         while True:
-            # This is a pure broadcast socket; we don't expect messages from UI
+            # Broadcast socket; from UI we only accept subscription changes:
+            # {"type": "subscribe"|"unsubscribe", "vehicles": [...]}
+            # and, for fmt=delta, {"type": "resync", "vehicles": [...]} after a lost keyframe
             msg = await websocket.receive_text()
-            # Ignore any incoming (simple keepalive if user sends pings)
+            try:
+                obj = json.loads(msg)
+            except ValueError:
+                continue  # simple keepalive pings
+            if not isinstance(obj, dict):
+                continue
+            if obj.get("type") == "subscribe":
+                added = _topics(obj.get("vehicles"))
+                STATE.fanout.subscribe(websocket, added)
+                _send_keyframes(ch, added)
+                if push:
+                    _push_metrics(added)
+                bf = _backfill_args(obj)
+                if bf:
+                    await _send_backfill(ch, added, *bf)
+            elif obj.get("type") == "unsubscribe":
+                removed = _topics(obj.get("vehicles"))
+                STATE.fanout.unsubscribe(websocket, removed)
+                _unpush_metrics(removed)
+            elif obj.get("type") == "resync":
+                ch.resyncs += 1
+                _send_keyframes(ch, _topics(obj.get("vehicles")) or sorted(ch.topics))
+                continue
+            else:
+                continue
+            await websocket.send_text(json.dumps({"type": "subscribed", "vehicles": sorted(ch.topics)}))
     except WebSocketDisconnect:
-        STATE.telemetry_clients.discard(websocket)
+        pass
     except Exception:
-        STATE.telemetry_clients.discard(websocket)
+        pass
+    finally:
+        _unpush_metrics(list(pushed))
+        await STATE.fanout.remove(websocket)
+
+async def _attach_sim(vehicle_id: str, websocket: WebSocket):
+    v = STATE.fleet.ensure(vehicle_id)
+    old = v.sim_websocket
+    v.sim_websocket = websocket
+    v.remote_owner = None
+    BUS.publish("owner", {"v": vehicle_id, "w": BUS.worker_id, "on": True})
+    if old is not None and old is not websocket:
+        # переподключение того же борта: старый сокет явно закрываем, ack'и по нему — отказ
+        # (мультиплексный старый сокет закрывается целиком — его борта переподключатся)
+        v.takeovers += 1
+        STATE.acks.fail_link(vehicle_id)
+        try:
+            await old.close(code=4000)
+        except Exception:
+            pass
+    return v
 
 @app.websocket("/ws/sim")
 async def ws_sim(websocket: WebSocket):
+    # ?vehicle=<id> — какой аппарат за этим сокетом; без него — default.
+    # ?mux=1 — много аппаратов в одном сокете: vehicle_id в каждом кадре (json/msgpack
+    # поле, bin — тег 0x02, delta — заголовок), аппарат подключается первым своим кадром;
+    # команды к симу всегда несут vehicle_id
+    mux = websocket.query_params.get("mux") in ("1", "true")
+    vehicle_id = websocket.query_params.get("vehicle") or DEFAULT_VEHICLE
+    if not mux and not valid_vehicle_id(vehicle_id):
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
-    STATE.sim_websocket = websocket
+    fmt = negotiate(websocket.query_params.get("fmt"))
+    await websocket.send_text(_hello(fmt, mux=True) if mux else _hello(fmt, vehicle_id=vehicle_id))
+    # fmt=delta: состояние потока ключевой кадр + дельты этого соединения (mux — по аппарату)
+    delta = (DeltaDemux() if mux else DeltaDecoder()) if fmt == "delta" else None
+    attached: Dict[str, object] = {}
+    if not mux:
+        attached[vehicle_id] = await _attach_sim(vehicle_id, websocket)
     try:
         while True:
-            raw = await websocket.receive_text()
+            msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(msg.get("code", 1000))
+            raw = msg.get("bytes") if msg.get("bytes") is not None else msg.get("text")
+            t0 = time.perf_counter()
             try:
-                obj = json.loads(raw)
+                obj, typed = decode_message(raw, delta)
             except Exception:
                 continue
+            t1 = time.perf_counter()
+            _H_SIM["parse"].record((t1 - t0) * 1000.0)
+            if not isinstance(obj, dict):
+                resync = delta.want_resync() if delta is not None else None
+                if resync:
+                    # дельта к неизвестному ключевому кадру — просим сим прислать новый
+                    req = {"type": "resync"}
+                    if mux:
+                        req["vehicle_id"] = resync
+                    await websocket.send_text(json.dumps(req))
+                continue
 
             if obj.get("type") == "telemetry":
                 # Validate + broadcast
                 try:
-                    frame = TelemetryFrame(**obj["data"])
-                    frame.yaw = math.atan2(math.sin(frame.yaw), math.cos(frame.yaw))
-                    STATE.last_telemetry_ts = time.time()
-                    STATE.last_telemetry_mono = time.monotonic()
-
-                    STATE.last_frame = frame
-
-                    d = frame.model_dump()
-                    d["yaw_deg"] = round(math.degrees(d["yaw"]), 1)
-                    
-                    # Broadcast to UI clients (best-effort)
-                    await _broadcast_to_clients(json.dumps({"type": "telemetry", "data": d}))
+                    if mux:
+                        vid = obj["vehicle_id"]
+                        v = attached.get(vid)
+                        if v is None:
+                            if not valid_vehicle_id(vid):
+                                continue
+                            v = attached[vid] = await _attach_sim(vid, websocket)
+                    else:
+                        v = attached[vehicle_id]
+                    d = obj["data"]
+                    if typed:
+                        # struct уже дал float/int по раскладке — pydantic не нужен
+                        frame = TelemetryFrame.model_construct(**d)
+                    else:
+                        frame = TelemetryFrame(**d)
+                        d = frame.model_dump()
+                    normalize_frame(d)
+                    frame.yaw = d["yaw"]
+                    t2 = time.perf_counter()
+
+                    # штампы телеметрии + будит автопилот борта, ждущий нового кадра
+                    await v.publish_frame(frame)
+                    GEOFENCES.check(v.vehicle_id, d["lat"], d["lon"])
+                    t3 = time.perf_counter()
+
+                    # Broadcast to UI clients (best-effort, never blocks the sim socket)
+                    _broadcast_to_clients(v, d)
+                    if BUS.distributed:
+                        BUS.publish("tele", {"v": v.vehicle_id, "d": d})
+                    t4 = time.perf_counter()
+                    _H_SIM["validate"].record((t2 - t1) * 1000.0)
+                    _H_SIM["publish"].record((t3 - t2) * 1000.0)
+                    _H_SIM["broadcast"].record((t4 - t3) * 1000.0)
 
                 except Exception:
                     # Ignore malformed frames
                     pass
-            else:
-                # future: handle sim acks, etc.
-                pass
+            elif obj.get("type") == "ack":
+                try:
+                    cmd_id = int(obj["id"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if BUS.distributed:
+                    # команды с других воркеров (и заменённые ими) — ack ждут там
+                    foreign: List[int] = []
+                    STATE.acks.resolve(cmd_id, foreign)
+                    if foreign:
+                        BUS.publish("ack", {"ids": foreign})
+                else:
+                    STATE.acks.resolve(cmd_id)
     except WebSocketDisconnect:
-        STATE.sim_websocket = None
+        pass
     except Exception:
-        STATE.sim_websocket = None
-
-async def _broadcast_to_clients(text: str):
-    if not STATE.telemetry_clients:
+        pass
+    finally:
+        for vid, v in attached.items():
+            if v.sim_websocket is websocket:
+                v.sim_websocket = None
+                STATE.acks.fail_link(vid)
+                BUS.publish("owner", {"v": vid, "w": BUS.worker_id, "on": False})
+
+def _broadcast_to_clients(v, d: Dict):
+    # Только кладём в очереди подписчиков борта; отправку делают их собственные задачи
+    if not STATE.fanout.has_subscribers(v.vehicle_id):
         return
-    dead = []
-    for ws in list(STATE.telemetry_clients):
-        try:
-            await ws.send_text(text)
-        except Exception:
-            dead.append(ws)
-    for ws in dead:
-        STATE.telemetry_clients.discard(ws)
-
-async def mission_driver():
-    while True:
-        await asyncio.sleep(0.2)
-        if not (MISSION.active and not MISSION.paused and STATE.sim_websocket and MISSION.waypoints):
-            continue
-
-        cur = getattr(STATE, "last_frame", None)
-        if not cur:
-            continue
-
-        # если включён RTL и есть home — едем домой, иначе к текущему WP
-        if getattr(MISSION, "rtl", False) and getattr(MISSION, "home", None):
-            target = MISSION.home
-        else:
-            idx = min(MISSION.current_idx, len(MISSION.waypoints) - 1)
-            target = MISSION.waypoints[idx]
-
-        # Приблизительная метрика "градусы → метры" на малых расстояниях
-        dlat = (target["lat"] - cur.lat) * 111_111.0
-        dlon = (target["lon"] - cur.lon) * 111_111.0 * math.cos(math.radians(cur.lat))
-        dist = math.hypot(dlat, dlon)
-
-        # Достигли точки → переключаемся
-        if dist < 2.0:
-            if getattr(MISSION, "rtl", False):
-                # приехали домой — выключаем автопилот и RTL, шлём стоп
-                MISSION.active = False
-                MISSION.rtl = False
-                try:
-                    if STATE.sim_websocket:
-                        await STATE.sim_websocket.send_text(json.dumps({
-                            "type": "command", "command": "drive",
-                            "data": {"ts": time.time(), "vx": 0.0, "vy": 0.0, "wz": 0.0}
-                        }))
-                except Exception:
-                    pass
-            else:
-                # обычная миссия — следующая точка, а на финале стоп
-                MISSION.current_idx = min(len(MISSION.waypoints) - 1, MISSION.current_idx + 1)
-                if MISSION.current_idx == len(MISSION.waypoints) - 1:
-                    MISSION.active = False
-                    try:
-                        if STATE.sim_websocket:
-                            await STATE.sim_websocket.send_text(json.dumps({
-                                "type": "command", "command": "drive",
-                                "data": {"ts": time.time(), "vx": 0.0, "vy": 0.0, "wz": 0.0}
-                            }))
-                    except Exception:
-                        pass
-            continue
-
-        # P-контроллер с насыщением
-        vx = max(-1.0, min(1.0, dlat * 0.05))
-        vy = max(-1.0, min(1.0, dlon * 0.05))
-
-        cmd = {
-            "type": "command",
-            "command": "drive",
-            "data": {"ts": time.time(), "vx": vx, "vy": vy, "wz": 0.0},
-        }
-
-        try:
-            await STATE.sim_websocket.send_text(json.dumps(cmd))
-        except Exception:
-            pass
-
-        # Лог JSONL → потом скачиваем /api/v1/mission/log.csv
-        try:
-            with open(MISSION.log_path, "a", encoding="utf-8") as f:
-                f.write(json.dumps({
-                    "ts": time.time(),
-                    "lat": cur.lat, "lon": cur.lon,
-                    "vx": cur.vx, "vy": cur.vy, "wz": cur.wz,
-                    "idx": idx
-                }) + "\n")
-        except Exception:
-            pass
-
-from fastapi import Body
-from .video import create_pc_and_answer, set_max_kbps, document_max_kbps
+    STATE.fanout.broadcast(EncodedFrame(d, v.vehicle_id, v.delta), v.vehicle_id)
 
 @app.api_route("/api/v1/webrtc/offer", methods=["GET", "POST"])
 @app.api_route("/api/v1/webrtc/offer/", methods=["GET", "POST"])
@@ -215,33 +661,44 @@ async def webrtc_offer(payload: dict | None = Body(None)):
     sdp = (payload or {}).get("sdp", "")
     typ = (payload or {}).get("type", "offer")
     max_kbps = int((payload or {}).get("max_kbps", 1500))
-    set_max_kbps(max_kbps)
-    answer_sdp, answer_type = await create_pc_and_answer(sdp, typ, max_kbps)
-    return {"sdp": answer_sdp, "type": answer_type}
+    VIDEO.set_max_kbps(max_kbps)
+    BUS.publish("video.max_kbps", {"kbps": max_kbps})
+    try:
+        # первый offer импортирует видеостек (cv2/av/aiortc), см. media.py
+        answer_sdp, answer_type, peer_id = await VIDEO.offer(sdp, typ, max_kbps)
+    except VideoUnavailable as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+    return {"sdp": answer_sdp, "type": answer_type, "peer_id": peer_id}
 
 @app.post("/api/v1/webrtc/qos")
 async def webrtc_qos(payload: Dict = Body(...)):
     """
     Принимает метрики из фронта:
     {
+      "peer_id": "…",         # из ответа /api/v1/webrtc/offer
       "bitrate_kbps": 1234,
       "jitter": 0.012,        # сек
-      "rtt_ms": 85
+      "rtt_ms": 85,
+      "packetsLost": 10, "packetsReceived": 5000   # накопительные
     }
-    Возвращает рекомендацию по новому max_kbps (или null).
+    С peer_id отчёт идёт в AIMD-регулятор пира, и новый битрейт сразу
+    применяется к живому sender'у (applied=true, перезапуск не нужен).
+    Без peer_id — старая одноразовая рекомендация по новому max_kbps (или null).
     """
-    import os, json, time
-
-    LOG_PATH = os.environ.get("QOS_LOG", "/tmp/rocu_qos.jsonl")
-
     # не мутируем исходный payload, добавим timestamp в копию
     record = dict(payload)
     record.setdefault("ts", time.time())
 
-    # пишем одну JSON-строку (JSONL)
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    
+    peer_id = payload.get("peer_id")
+    result = VIDEO.apply_qos(peer_id, payload) if peer_id else None
+    if result is not None:
+        record["target_kbps"] = result["target_kbps"]
+        QOS_LOG.write(record)
+        return {"recommend_max_kbps": result["target_kbps"], **result}
+
+    # в буфер логгера; на диск уйдёт пачкой из фоновой задачи
+    QOS_LOG.write(record)
+
     recommend = None
     bitrate = payload.get("bitrate_kbps") or 0
     jitter  = payload.get("jitter") or 0.0
@@ -249,73 +706,203 @@ async def webrtc_qos(payload: Dict = Body(...)):
 
     # простая политика: если плохо — снизить на 25% от текущего, но не ниже 300
     if (bitrate and bitrate < 600) or (jitter > 0.04) or (rtt_ms > 250):
-        try:
-            cur = int(document_max_kbps())
-        except Exception:
-            cur = 1500
+        cur = VIDEO.max_kbps
         recommend = max(300, int(cur * 0.75))
 
-    return {"recommend_max_kbps": recommend}
+    return {"recommend_max_kbps": recommend, "applied": False}
+
+def _rec_src() -> str:
+    return os.getenv("REC_SRC", os.getenv("VIDEO_SRC", "")).strip()
+
+async def _start_recorder(src: str) -> Optional[str]:
+    try:
+        await RECORDER.start(VIDEO, src)
+    except VideoUnavailable as e:
+        RECORDER.error = str(e)
+        return str(e)
+    return None
+
+@app.post("/api/v1/video/recorder")
+async def recorder_ctl(payload: Dict = Body(...)):
+    """
+    {"action": "start", "src": "rtsp://..."}   # src по умолчанию REC_SRC / VIDEO_SRC
+    {"action": "stop"}
+    {"action": "keep", "before_s": 120, "after_s": 60}   # или "from"/"to" (unix ts)
+    keep закрепляет сегменты окна: кольцо их не удалит; ещё не записанные
+    закрепятся при закрытии.
+    """
+    act = (payload.get("action") or "").lower()
+    if act == "start":
+        err = await _start_recorder(str(payload.get("src") or _rec_src()))
+        if err:
+            return JSONResponse({"error": err}, status_code=503)
+    elif act == "stop":
+        await RECORDER.stop()
+    elif act == "keep":
+        now = time.time()
+        lo = float(payload["from"]) if payload.get("from") is not None else now - float(payload.get("before_s", 60))
+        hi = float(payload["to"]) if payload.get("to") is not None else now + float(payload.get("after_s", 0))
+        if hi < lo:
+            return JSONResponse({"error": "to < from"}, status_code=400)
+        # дописывает index.jsonl — не в event loop
+        return {**await asyncio.to_thread(RECORDER.keep, lo, hi), "from": lo, "to": hi}
+    else:
+        return JSONResponse({"error": "action must be start|stop|keep"}, status_code=400)
+    return RECORDER.stats()
+
+@app.get("/api/v1/video/recorder")
+def recorder_stats():
+    return RECORDER.stats()
+
+@app.get("/api/v1/video/recordings")
+def recordings(from_ts: float = Query(0.0, alias="from"), to_ts: float = Query(float("inf"), alias="to"),
+               kept: Optional[bool] = None):
+    # по индексу: сегменты, пересекающие [from, to] — для сверки с логом миссии
+    segs = RECORDER.index.query(from_ts, to_ts, kept)
+    return {"segments": segs, "count": len(segs)}
+
+@app.get("/api/v1/video/recordings/{name}")
+def recording_file(name: str):
+    # только файлы из индекса — имя из запроса в путь напрямую не попадает
+    seg = RECORDER.index.get(name)
+    if seg is None:
+        return JSONResponse({"error": "no such segment"}, status_code=404)
+    return FileResponse(os.path.join(RECORDER.index.dir, seg["file"]), media_type="video/x-matroska",
+                        filename=seg["file"])
+
+def _fleet_vehicle(vehicle: str):
+    # миссию можно загрузить заранее, до подключения сима борта
+    if not valid_vehicle_id(vehicle):
+        return None
+    return STATE.fleet.ensure(vehicle)
 
 @app.post("/api/v1/mission")
-async def set_mission(m: Mission):
-    MISSION.waypoints = [w.model_dump() for w in m.waypoints]
-    MISSION.current_idx = 0
-    return {"ok": True, "count": len(MISSION.waypoints)}
+async def set_mission(m: Mission, vehicle: str = Query(DEFAULT_VEHICLE)):
+    v = _fleet_vehicle(vehicle)
+    if v is None:
+        return JSONResponse({"error": "bad vehicle id"}, status_code=400)
+    mission = v.mission
+    mission.waypoints = [w.model_dump() for w in m.waypoints]
+    # геометрия маршрута — один раз здесь, а не на каждом тике автопилота
+    mission.route = Route(mission.waypoints) if mission.waypoints else None
+    mission.current_idx = 0
+    _publish_mission(v.vehicle_id, mission, waypoints=True)
+    return {"ok": True, "count": len(mission.waypoints), "vehicle_id": v.vehicle_id,
+            "total_m": round(mission.route.total, 1) if mission.route else 0.0}
+
+@app.get("/api/v1/mission/route")
+def mission_route(vehicle: str = Query(DEFAULT_VEHICLE)):
+    # плечи маршрута + остаток пути и ETA от последнего кадра
+    v = STATE.vehicle(vehicle)
+    if v is None:
+        return JSONResponse({"error": "unknown vehicle"}, status_code=404)
+    route = v.mission.route
+    if route is None:
+        return {"vehicle_id": v.vehicle_id, "route": None, "status": None}
+    status = None
+    f = v.last_frame
+    if f is not None:
+        status = route.status(v.mission.current_idx, f.lat, f.lon, math.hypot(f.vx, f.vy))
+    return {"vehicle_id": v.vehicle_id, "route": route.to_dict(), "status": status}
+
+@app.post("/api/v1/geofences")
+async def set_geofences(g: Geofences):
+    # заменяет весь набор; пустой список — выключить проверку. async — на event loop:
+    # нарушения и каналы UI принадлежат ему (check() пишет их на каждом кадре)
+    try:
+        GEOFENCES.set([f.model_dump() for f in g.fences])
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"ok": True, "index": GEOFENCES.stats()["index"]}
+
+@app.get("/api/v1/geofences")
+async def get_geofences(events: int = 20):
+    # полигоны, нарушения по последним кадрам всех аппаратов (одна векторная проверка), события
+    positions = {v.vehicle_id: (v.last_frame.lat, v.last_frame.lon) for v in STATE.fleet if v.last_frame}
+    idx = GEOFENCES.index
+    return {
+        "fences": idx.fences if idx is not None else [],
+        "vehicles": GEOFENCES.status(positions),
+        **GEOFENCES.stats(events=events),
+    }
 
 @app.post("/api/v1/mission/control")
-async def mission_ctrl(payload: dict = Body(...)):
+async def mission_ctrl(payload: dict = Body(...), vehicle: str = Query(DEFAULT_VEHICLE)):
     act = (payload.get("action") or "").upper()
+    v = _fleet_vehicle(vehicle)
+    if v is None:
+        return JSONResponse({"error": "bad vehicle id"}, status_code=400)
+    mission = v.mission
 
     if act == "GO":
-        MISSION.active = True
-        MISSION.paused = False
+        mission.active = True
+        mission.paused = False
         # выключаем RTL-режим и один раз запоминаем "дом"
-        MISSION.rtl = False
+        mission.rtl = False
         try:
-            if not getattr(MISSION, "home", None) and getattr(STATE, "last_frame", None):
-                MISSION.home = {"lat": STATE.last_frame.lat, "lon": STATE.last_frame.lon}
+            if not getattr(mission, "home", None) and v.last_frame:
+                mission.home = {"lat": v.last_frame.lat, "lon": v.last_frame.lon}
         except Exception:
             pass
 
     elif act == "PAUSE":
-        MISSION.paused = True
+        mission.paused = True
         # сразу отправим стоп, чтобы сим реально остановился
-        try:
-            if STATE.sim_websocket:
-                await STATE.sim_websocket.send_text(json.dumps({
-                    "type": "command", "command": "drive",
-                    "data": {"ts": time.time(), "vx": 0.0, "vy": 0.0, "wz": 0.0}
-                }))
-        except Exception:
-            pass
+        await v.send_drive(0.0, 0.0, 0.0, source=MANUAL)
 
     elif act == "RTL":
-        # включаем возврат домой — цель будет выбрана в mission_driver()
-        MISSION.active = True
-        MISSION.paused = False
-        MISSION.rtl = True
-
-    return {"ok": True, "state": {
-        "active": MISSION.active, "paused": MISSION.paused,
-        "idx": MISSION.current_idx, "rtl": getattr(MISSION, "rtl", False)
+        # включаем возврат домой — цель выберет MissionDriver.tick()
+        mission.active = True
+        mission.paused = False
+        mission.rtl = True
+
+    _publish_mission(v.vehicle_id, mission)
+    if mission.active and not mission.paused:
+        # задача автопилота живёт только пока миссия идёт; на паузе/финише выходит сама
+        DRIVERS.ensure(v.vehicle_id, v, mission)
+
+    return {"ok": True, "vehicle_id": v.vehicle_id, "state": {
+        "active": mission.active, "paused": mission.paused,
+        "idx": mission.current_idx, "rtl": getattr(mission, "rtl", False)
     }}
 
+def _log_query(t_from: Optional[float], t_to: Optional[float], idx: Optional[int],
+               vehicle: Optional[str] = None) -> Dict[str, Any]:
+    return {"t_from": t_from, "t_to": t_to, "idx": idx, "vehicle": vehicle}
+
 @app.get("/api/v1/mission/log.csv")
-def mission_csv():
-    # на лету из JSONL соберём CSV
-    import csv, io
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["ts","lat","lon","vx","vy","wz","idx"])
+async def mission_csv(
+    t_from: Optional[float] = Query(None, alias="from"),
+    t_to: Optional[float] = Query(None, alias="to"),
+    idx: Optional[int] = None,
+    vehicle: Optional[str] = None,
+):
+    # дописать буфер логгера, чтобы CSV включал последние записи
+    await MISSION_LOG.flush()
+    # CSV генерируется кусками в threadpool; ?from=&to= ищут начало по сайдкар-индексу
+    return StreamingResponse(
+        iter_csv(MISSION.log_path, **_log_query(t_from, t_to, idx, vehicle)),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="mission_log.csv"'},
+    )
+
+@app.get("/api/v1/mission/log.parquet")
+async def mission_parquet(
+    t_from: Optional[float] = Query(None, alias="from"),
+    t_to: Optional[float] = Query(None, alias="to"),
+    idx: Optional[int] = None,
+    vehicle: Optional[str] = None,
+):
     try:
-        with open(MISSION.log_path, "r", encoding="utf-8") as f:
-            for line in f:
-                j = json.loads(line)
-                w.writerow([j.get("ts"), j.get("lat"), j.get("lon"), j.get("vx"), j.get("vy"), j.get("wz"), j.get("idx")])
-    except FileNotFoundError:
-        pass
-    return HTMLResponse(content=buf.getvalue(), media_type="text/csv")
+        import pyarrow  # noqa: F401  (optional dependency)
+    except ImportError:
+        return JSONResponse({"error": "pyarrow is not installed"}, status_code=501)
+    await MISSION_LOG.flush()
+    return StreamingResponse(
+        iter_parquet(MISSION.log_path, **_log_query(t_from, t_to, idx, vehicle)),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": 'attachment; filename="mission_log.parquet"'},
+    )
 
 # Serve minimal operator UI
-app.mount("/", StaticFiles(directory="static", html=True), name="static")
+app.mount("/", ASSETS, name="static")
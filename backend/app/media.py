@@ -0,0 +1,107 @@
+import asyncio
+import importlib
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+
+class VideoUnavailable(RuntimeError):
+    """Видео выключено конфигурацией или стек (aiortc/av/cv2) не импортируется."""
+
+
+class VideoStack:
+    """
+    Ленивая обёртка над app.video. Сам video.py тянет cv2, av, aiortc и
+    MediaRelay (~0.3 с импорта и ~50 МБ RSS), а нужен только тем, кто открывает
+    видео. Модуль грузится при первом /api/v1/webrtc/offer (в потоке, чтобы не
+    стопорить event loop телеметрии), VIDEO_PRELOAD=1 — сразу после старта в фоне,
+    VIDEO_ENABLED=0 — никогда. Пока не загружен: метрики пустые, QoS-отчёты без
+    пира, max_kbps копится здесь и применяется при загрузке.
+    """
+
+    def __init__(self, enabled: bool = True, preload: bool = False):
+        self.enabled = enabled
+        self.preload = preload
+        self.max_kbps = 1500
+        self.load_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self._mod: Any = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._mod is not None
+
+    async def load(self):
+        if self._mod is not None:
+            return self._mod
+        if self.error is not None:
+            raise VideoUnavailable(f"video stack unavailable: {self.error}")
+        if not self.enabled:
+            raise VideoUnavailable("video disabled (VIDEO_ENABLED=0)")
+        async with self._lock:
+            if self._mod is None:
+                t0 = time.perf_counter()
+                try:
+                    mod = await asyncio.to_thread(importlib.import_module, ".video", __package__)
+                except ImportError as e:
+                    # не повторяем импорт на каждый offer: стека нет и не появится
+                    self.error = f"{type(e).__name__}: {e}"
+                    raise VideoUnavailable(f"video stack unavailable: {e}") from e
+                mod.set_max_kbps(self.max_kbps)
+                self.load_ms = round((time.perf_counter() - t0) * 1000.0, 1)
+                self._mod = mod
+        return self._mod
+
+    async def warm(self):
+        # фоновая предзагрузка (VIDEO_PRELOAD=1): ошибка уже записана в stats
+        try:
+            await self.load()
+        except VideoUnavailable:
+            pass
+
+    # --- то, что main зовёт и без загруженного видео -------------------------
+
+    def set_max_kbps(self, kbps: int):
+        self.max_kbps = int(kbps)
+        if self._mod is not None:
+            self._mod.set_max_kbps(self.max_kbps)
+
+    async def offer(self, sdp: str, typ: str, max_kbps: int):
+        """→ (sdp, type, peer_id); нет стека или лимит пиров — VideoUnavailable."""
+        mod = await self.load()
+        try:
+            return await mod.create_pc_and_answer(sdp, typ, max_kbps)
+        except mod.PeerLimitError as e:
+            raise VideoUnavailable(str(e)) from e
+
+    def apply_qos(self, peer_id: str, report: Dict) -> Optional[Dict]:
+        # пиров без загруженного модуля не бывает
+        return self._mod.apply_qos(peer_id, report) if self._mod is not None else None
+
+    async def close_all(self):
+        if self._mod is not None:
+            await self._mod.PEERS.close_all()
+
+    def sources_stats(self) -> List[Dict]:
+        return self._mod.SOURCES.stats() if self._mod is not None else []
+
+    def peers_stats(self) -> Dict:
+        return self._mod.PEERS.stats() if self._mod is not None else {}
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "loaded": self.loaded,
+            "preload": self.preload,
+            "load_ms": self.load_ms,
+            "error": self.error,
+            "max_kbps": self.max_kbps,
+        }
+
+
+def video_from_env() -> VideoStack:
+    return VideoStack(
+        enabled=os.getenv("VIDEO_ENABLED", "1") != "0",
+        preload=os.getenv("VIDEO_PRELOAD", "0") == "1",
+    )
@@ -0,0 +1,181 @@
+import asyncio
+import math
+import os
+import time
+from typing import Callable, Dict, Optional
+
+from .geo import offset_m
+from .logwriter import JsonlLogger
+from .stats import PERF
+
+
+class MissionDriver:
+    """
+    Автопилот одного аппарата. Просыпается по приходу телеметрии (Condition в state),
+    а не по таймеру: без нового кадра — без команды. Частота управления ограничена
+    control_hz: кадры, пришедшие чаще, схлопываются до последнего.
+    Задача живёт, только пока миссия активна и не на паузе.
+    Несколько воркеров: рулит только держатель leader-блокировки аппарата,
+    остальные ждут в резерве и перехватывают, если лидер пропал.
+    on_state(vehicle_id, mission) — миссия изменилась (точка, финиш), для шины.
+    """
+
+    def __init__(self, vehicle_id: str, state, mission, log: JsonlLogger, control_hz: float = 10.0,
+                 leader=None, on_state: Optional[Callable] = None):
+        self.vehicle_id = vehicle_id
+        self.state = state
+        self.mission = mission
+        self.log = log
+        self.period = 1.0 / control_hz if control_hz > 0 else 0.0
+        self.leader = leader
+        self.on_state = on_state
+        self._task: Optional[asyncio.Task] = None
+        self.ticks = 0
+        self.skipped = 0
+        self.standby = 0
+        self.last_tick_ms = 0.0
+        self.tick_hist = PERF.histogram("mission_tick", "mission autopilot tick time", vehicle=vehicle_id)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _engaged(self) -> bool:
+        m = self.mission
+        return m.active and not m.paused and bool(m.waypoints)
+
+    async def _run(self):
+        try:
+            await self._drive()
+        finally:
+            if self.leader is not None:
+                self.leader.release()
+
+    async def _drive(self):
+        seen = self.state.frame_count
+        next_allowed = 0.0
+        while self._engaged():
+            if self.leader is not None and not self.leader.try_acquire():
+                # аппаратом рулит другой воркер; проверяем, жив ли он
+                self.standby += 1
+                await asyncio.sleep(1.0)
+                continue
+            # ждём новый кадр; таймаут только чтобы заметить снятие миссии
+            if not await self.state.wait_frame(seen, timeout=1.0):
+                self.skipped += 1
+                continue
+            now = time.monotonic()
+            if now < next_allowed:
+                # кадры чаще control_hz — дождёмся окна и возьмём самый свежий
+                await asyncio.sleep(next_allowed - now)
+                if not self._engaged():
+                    break
+            seen = self.state.frame_count
+            t0 = time.perf_counter()
+            await self.tick()
+            self.ticks += 1
+            self.last_tick_ms = (time.perf_counter() - t0) * 1000.0
+            self.tick_hist.record(self.last_tick_ms)
+            next_allowed = time.monotonic() + self.period
+
+    async def tick(self):
+        m, st = self.mission, self.state
+        cur = st.last_frame
+        if not cur or not st.connected:
+            return
+
+        # если включён RTL и есть home — едем домой, иначе к текущему WP
+        idx = min(m.current_idx, len(m.waypoints) - 1)
+        if getattr(m, "rtl", False) and getattr(m, "home", None):
+            target = m.home
+            dlat, dlon = offset_m(cur.lat, cur.lon, target["lat"], target["lon"])
+        elif m.route is not None:
+            # точки маршрута уже в локальных метрах (Route), на тик — два умножения
+            dlat, dlon = m.route.offset(idx, cur.lat, cur.lon)
+        else:
+            target = m.waypoints[idx]
+            dlat, dlon = offset_m(cur.lat, cur.lon, target["lat"], target["lon"])
+        dist = math.hypot(dlat, dlon)
+
+        # Достигли точки → переключаемся
+        if dist < 2.0:
+            if getattr(m, "rtl", False):
+                # приехали домой — выключаем автопилот и RTL, шлём стоп
+                m.active = False
+                m.rtl = False
+                await st.send_drive(0.0, 0.0, 0.0)
+            else:
+                # обычная миссия — следующая точка, а на финале стоп
+                m.current_idx = min(len(m.waypoints) - 1, m.current_idx + 1)
+                if m.current_idx == len(m.waypoints) - 1:
+                    m.active = False
+                    await st.send_drive(0.0, 0.0, 0.0)
+            if self.on_state is not None:
+                self.on_state(self.vehicle_id, m)
+            return
+
+        # P-контроллер с насыщением
+        vx = max(-1.0, min(1.0, dlat * 0.05))
+        vy = max(-1.0, min(1.0, dlon * 0.05))
+        await st.send_drive(vx, vy, 0.0)
+
+        # Лог JSONL → потом скачиваем /api/v1/mission/log.csv
+        self.log.write({
+            "ts": time.time(),
+            "lat": cur.lat, "lon": cur.lon,
+            "vx": cur.vx, "vy": cur.vy, "wz": cur.wz,
+            "idx": idx,
+            "vehicle_id": self.vehicle_id,
+        })
+
+    def stats(self) -> Dict:
+        return {
+            "vehicle_id": self.vehicle_id,
+            "running": self.running,
+            "ticks": self.ticks,
+            "idle_waits": self.skipped,
+            "leader": self.leader.held if self.leader is not None else True,
+            "standby_waits": self.standby,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+            "control_hz": round(1.0 / self.period, 1) if self.period else None,
+        }
+
+
+class DriverPool:
+    """По драйверу на аппарат; задача поднимается по GO/RTL и сама завершается."""
+
+    def __init__(self, log: JsonlLogger, control_hz: Optional[float] = None, bus=None,
+                 on_state: Optional[Callable] = None):
+        self.log = log
+        self.control_hz = control_hz if control_hz is not None else float(os.getenv("MISSION_CONTROL_HZ", "10"))
+        self.bus = bus
+        self.on_state = on_state
+        self.drivers: Dict[str, MissionDriver] = {}
+
+    def ensure(self, vehicle_id: str, state, mission) -> MissionDriver:
+        drv = self.drivers.get(vehicle_id)
+        if drv is None or drv.state is not state or drv.mission is not mission:
+            leader = self.bus.leader(f"mission-{vehicle_id}") if self.bus is not None else None
+            drv = self.drivers[vehicle_id] = MissionDriver(vehicle_id, state, mission, self.log, self.control_hz,
+                                                           leader=leader, on_state=self.on_state)
+        drv.start()
+        return drv
+
+    async def stop_all(self):
+        for drv in self.drivers.values():
+            await drv.stop()
+
+    def stats(self):
+        return [d.stats() for d in self.drivers.values()]
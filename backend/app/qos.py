@@ -0,0 +1,121 @@
+import time
+from typing import Dict, Optional
+
+
+class Ewma:
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.value: Optional[float] = None
+
+    def update(self, x: float) -> float:
+        self.value = x if self.value is None else self.value + self.alpha * (x - self.value)
+        return self.value
+
+
+class RateController:
+    """
+    AIMD-регулятор битрейта одного пира по отчётам /api/v1/webrtc/qos.
+    Перегрузка (потери, джиттер, RTT выше порога или растущий RTT, как delay-gradient
+    в GCC) → мультипликативное снижение от фактического битрейта; спокойный линк →
+    аддитивный рост до потолка, который пир запросил при offer.
+    """
+
+    def __init__(
+        self,
+        ceiling_kbps: int,
+        floor_kbps: int = 250,
+        decrease: float = 0.75,
+        increase_kbps: int = 100,
+        hold_s: float = 2.0,
+        jitter_max_s: float = 0.04,
+        rtt_max_ms: float = 250.0,
+        loss_max: float = 0.02,
+    ):
+        self.ceiling_kbps = ceiling_kbps
+        self.floor_kbps = floor_kbps
+        self.decrease = decrease
+        self.increase_kbps = increase_kbps
+        self.hold_s = hold_s
+        self.jitter_max_s = jitter_max_s
+        self.rtt_max_ms = rtt_max_ms
+        self.loss_max = loss_max
+
+        self.target_kbps = ceiling_kbps
+        self.bitrate = Ewma(0.3)
+        self.jitter = Ewma(0.3)
+        self.rtt = Ewma(0.3)
+        self.loss = Ewma(0.3)
+        self._prev_rtt: Optional[float] = None
+        self._prev_lost: Optional[int] = None
+        self._prev_received: Optional[int] = None
+        self._last_decrease = float("-inf")
+        self._last_increase = float("-inf")
+        self.decreases = 0
+        self.increases = 0
+        self.state = "hold"
+
+    def update(self, report: Dict, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+
+        bitrate = float(report.get("bitrate_kbps") or 0)
+        if bitrate > 0:
+            self.bitrate.update(bitrate)
+        jitter = self.jitter.update(float(report.get("jitter") or 0.0))
+        rtt_raw = report.get("rtt_ms")
+        rtt = self.rtt.update(float(rtt_raw)) if rtt_raw is not None else self.rtt.value
+
+        # доля потерь за интервал из накопительных счётчиков браузера
+        lost, received = report.get("packetsLost"), report.get("packetsReceived")
+        if lost is not None and received is not None:
+            if self._prev_lost is not None:
+                dl = max(0, int(lost) - self._prev_lost)
+                dr = max(0, int(received) - self._prev_received)
+                if dl + dr > 0:
+                    self.loss.update(dl / (dl + dr))
+            self._prev_lost, self._prev_received = int(lost), int(received)
+        loss = self.loss.value or 0.0
+
+        # рост сглаженного RTT > 15% за отчёт — очередь на линке растёт
+        rtt_rising = rtt is not None and self._prev_rtt is not None and rtt > self._prev_rtt * 1.15 + 5
+        self._prev_rtt = rtt
+
+        overuse = (
+            loss > self.loss_max
+            or jitter > self.jitter_max_s
+            or (rtt is not None and rtt > self.rtt_max_ms)
+            or rtt_rising
+        )
+
+        if overuse:
+            self.state = "decrease"
+            if now - self._last_decrease >= self.hold_s / 2:
+                base = min(self.target_kbps, self.bitrate.value or self.target_kbps)
+                self.target_kbps = max(self.floor_kbps, int(base * self.decrease))
+                self._last_decrease = now
+                self.decreases += 1
+        elif now - self._last_decrease >= self.hold_s and now - self._last_increase >= 1.0:
+            self.state = "increase"
+            if self.target_kbps < self.ceiling_kbps:
+                self.target_kbps = min(self.ceiling_kbps, self.target_kbps + self.increase_kbps)
+                self._last_increase = now
+                self.increases += 1
+        else:
+            self.state = "hold"
+        return self.target_kbps
+
+    def stats(self) -> Dict:
+        def r(v, n=3):
+            return None if v is None else round(v, n)
+        return {
+            "target_kbps": self.target_kbps,
+            "ceiling_kbps": self.ceiling_kbps,
+            "state": self.state,
+            "bitrate_kbps": r(self.bitrate.value, 1),
+            "jitter_s": r(self.jitter.value, 4),
+            "rtt_ms": r(self.rtt.value, 1),
+            "loss": r(self.loss.value, 4),
+            "decreases": self.decreases,
+            "increases": self.increases,
+        }
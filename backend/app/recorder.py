@@ -0,0 +1,490 @@
+import asyncio
+import bisect
+import fractions
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Сегменты — Matroska: файл читается и без финализации (упали посреди сегмента —
+# теряется хвост, а не весь файл, как у mp4 без moov)
+SEGMENT_EXT = ".mkv"
+
+
+class SegmentIndex:
+    """
+    Индекс сегментов записи: <dir>/index.jsonl, строка на закрытый сегмент
+    {"file", "start_ts", "end_ts", "bytes", "frames", "mode", "codec", "kept"}
+    плюс строки-события {"keep": file} и {"drop": file}. При старте сворачивается
+    в список по start_ts (и переписывается компактно). Выборка по времени —
+    bisect по началам/концам, сами видеофайлы не открываются; ts — unix-время,
+    как в JSONL логах миссии.
+    """
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.path = os.path.join(directory, "index.jsonl")
+        self.segments: List[Dict] = []
+        self._starts: List[float] = []
+        self._ends: List[float] = []
+        self._by_file: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        by_file: Dict[str, Dict] = {}
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка после падения
+                    if "keep" in rec:
+                        if rec["keep"] in by_file:
+                            by_file[rec["keep"]]["kept"] = True
+                    elif "drop" in rec:
+                        by_file.pop(rec["drop"], None)
+                    else:
+                        by_file[rec["file"]] = rec
+        except FileNotFoundError:
+            return
+        # файлы, удалённые руками, в индекс не попадают
+        segs = [r for r in by_file.values() if os.path.exists(os.path.join(self.dir, r["file"]))]
+        self._set(sorted(segs, key=lambda r: r["start_ts"]))
+        if lines != len(segs):
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.writelines(json.dumps(r) + "\n" for r in self.segments)
+            os.replace(tmp, self.path)
+
+    def _set(self, segs: List[Dict]):
+        self.segments = segs
+        self._starts = [r["start_ts"] for r in segs]
+        self._ends = [r["end_ts"] for r in segs]
+        self._by_file = {r["file"]: r for r in segs}
+
+    def _append(self, rec: Dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+
+    def add(self, rec: Dict):
+        with self._lock:
+            i = bisect.bisect_right(self._starts, rec["start_ts"])
+            self.segments.insert(i, rec)
+            self._set(self.segments)
+            self._append(rec)
+
+    def drop(self, rec: Dict):
+        with self._lock:
+            try:
+                os.remove(os.path.join(self.dir, rec["file"]))
+            except FileNotFoundError:
+                pass
+            self._set([r for r in self.segments if r is not rec])
+            self._append({"drop": rec["file"]})
+
+    def _overlap(self, from_ts: float, to_ts: float) -> List[Dict]:
+        # сегменты идут подряд и не пересекаются — концы тоже отсортированы
+        lo = bisect.bisect_left(self._ends, from_ts)
+        hi = bisect.bisect_right(self._starts, to_ts)
+        return self.segments[lo:hi]
+
+    def query(self, from_ts: float = 0.0, to_ts: float = float("inf"), kept: Optional[bool] = None) -> List[Dict]:
+        with self._lock:
+            segs = self._overlap(from_ts, to_ts)
+            return [dict(r) for r in segs if kept is None or bool(r.get("kept")) == kept]
+
+    def keep(self, from_ts: float, to_ts: float) -> List[str]:
+        with self._lock:
+            out = []
+            for r in self._overlap(from_ts, to_ts):
+                if not r.get("kept"):
+                    r["kept"] = True
+                    self._append({"keep": r["file"]})
+                    out.append(r["file"])
+            return out
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self._by_file.get(name)
+
+    def ring(self) -> List[Dict]:
+        """Незакреплённые сегменты, от старых к новым — кандидаты на удаление."""
+        with self._lock:
+            return [r for r in self.segments if not r.get("kept")]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            kept = [r for r in self.segments if r.get("kept")]
+            return {
+                "segments": len(self.segments),
+                "kept": len(kept),
+                "bytes": sum(r["bytes"] for r in self.segments),
+                "kept_bytes": sum(r["bytes"] for r in kept),
+                "first_ts": self._starts[0] if self.segments else None,
+                "last_ts": self._ends[-1] if self.segments else None,
+            }
+
+
+class _Segment:
+    """Один открытый файл записи: ремукс пакетов источника или кодирование кадров."""
+
+    def __init__(self, rec: "Recorder", start_ts: float, mode: str):
+        import av  # стек уже загружен VideoStack; здесь — просто ссылка на модуль
+
+        self.rec = rec
+        self.start_ts = start_ts
+        self.end_ts = start_ts
+        self.mode = mode
+        self.frames = 0
+        self.bytes = 0
+        self.codec = ""
+        self.file = "seg-%s-%03d%s" % (time.strftime("%Y%m%d-%H%M%S", time.gmtime(start_ts)),
+                                       int(start_ts * 1000) % 1000, SEGMENT_EXT)
+        self.path = os.path.join(rec.index.dir, self.file)
+        self.out = av.open(self.path, "w", format="matroska")
+        self.stream = None
+        self._base_pts: Optional[int] = None
+        self._reformatter = None
+
+    def due(self, now: float) -> bool:
+        return now - self.start_ts >= self.rec.segment_s or self.bytes >= self.rec.segment_max_bytes
+
+    # --- сжатый источник: пакеты как есть, только сдвиг таймкодов к нулю -----
+
+    def remux(self, packet, now: float):
+        if self.stream is None:
+            self.stream = self.out.add_stream_from_template(packet.stream)
+            self.codec = packet.stream.codec_context.name
+        if self._base_pts is None:
+            self._base_pts = packet.dts if packet.dts is not None else packet.pts
+        if packet.pts is not None:
+            packet.pts -= self._base_pts
+        if packet.dts is not None:
+            packet.dts -= self._base_pts
+        packet.stream = self.stream
+        self.out.mux(packet)
+        self._count(packet.size, now)
+
+    # --- сырые кадры: один энкодер на запись, фиксированное качество ----------
+
+    def encode(self, frame, now: float):
+        from av.video.reformatter import VideoReformatter
+
+        rec = self.rec
+        if self._reformatter is None:
+            # свой swscale-контекст: кадры общие с пирами (см. EncodedTierTrack)
+            self._reformatter = VideoReformatter()
+        h = min(frame.height, rec.max_height) // 2 * 2
+        w = int(frame.width * h / frame.height) // 2 * 2
+        img = self._reformatter.reformat(frame, width=w, height=h, format="yuv420p")
+        if self.stream is None:
+            s = self.stream = self.out.add_stream(rec.codec, rate=max(1, round(rec.fps)))
+            s.width, s.height, s.pix_fmt = w, h, "yuv420p"
+            s.codec_context.time_base = fractions.Fraction(1, 1000)
+            s.codec_context.gop_size = max(1, int(rec.fps * 2))
+            if rec.codec == "libx264":
+                s.options = {"crf": str(rec.crf), "preset": "veryfast"}
+            else:
+                s.bit_rate = rec.kbps * 1000
+            self.codec = rec.codec
+        # время кадра — настенное, в мс от начала сегмента (частота у источника плавает)
+        img.pts = int((now - self.start_ts) * 1000)
+        img.time_base = fractions.Fraction(1, 1000)
+        for p in self.stream.encode(img):
+            self.out.mux(p)
+            self.bytes += p.size
+        self._count(0, now)
+
+    def _count(self, size: int, now: float):
+        self.frames += 1
+        self.bytes += size
+        self.end_ts = now
+
+    def close(self) -> Dict:
+        if self.stream is not None and self.mode == "encode":
+            for p in self.stream.encode(None):
+                self.out.mux(p)
+        self.out.close()
+        return {
+            "file": self.file,
+            "start_ts": round(self.start_ts, 3),
+            "end_ts": round(self.end_ts, 3),
+            "bytes": os.path.getsize(self.path),
+            "frames": self.frames,
+            "mode": self.mode,
+            "codec": self.codec,
+        }
+
+
+class Recorder:
+    """
+    Бортовая запись видео кольцом сегментов (SegmentIndex):
+      - passthrough: RTSP/файл уже сжат — пакеты общего демультиплексора источника
+        (DemuxTrack, тот же, что кормит пиров) перекладываются в сегменты без
+        перекодирования; очередь ограничена — переполнилась, ждём ключевой кадр.
+        Режем только на ключевых кадрах, так что сегмент — не короче GOP камеры;
+      - encode: сырой источник (камера через OpenCV, синтетика) — кадры общего
+        источника через MediaRelay, как у пиров, прореженные до REC_FPS, кодируются
+        один раз (libx264, REC_CRF) в потоке записи.
+    Сегмент закрывается по REC_SEGMENT_S или REC_SEGMENT_MAX_MB. Незакреплённые
+    сегменты старше REC_RING_S (или сверх REC_RING_MAX_MB) удаляются; keep(from, to)
+    закрепляет всё, что пересекает окно, включая ещё не записанное.
+    Кодирование, мультиплексирование и файловый I/O — только в потоке записи.
+    """
+
+    def __init__(self, directory: str = "/tmp/rocu_rec", segment_s: float = 60.0, segment_max_mb: float = 64.0,
+                 ring_s: float = 900.0, ring_max_mb: float = 2048.0, fps: float = 10.0, max_height: int = 720,
+                 codec: str = "libx264", crf: int = 28, kbps: int = 1500, passthrough: bool = True):
+        self.index = SegmentIndex(directory)
+        self.segment_s = segment_s
+        self.segment_max_bytes = int(segment_max_mb * 1024 * 1024)
+        self.ring_s = ring_s
+        self.ring_max_bytes = int(ring_max_mb * 1024 * 1024)
+        self.fps = fps
+        self.max_height = max_height
+        self.codec = codec
+        self.crf = crf
+        self.kbps = kbps
+        self.passthrough = passthrough
+
+        self.mode: Optional[str] = None
+        self.src: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_ts: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._frames: queue.Queue = queue.Queue(maxsize=max(2, int(fps)))
+        # пакеты passthrough: ~несколько секунд при 30 к/с; поток записи отстал — сброс до ключевого
+        self._packets: queue.Queue = queue.Queue(maxsize=256)
+        self._need_keyframe = False
+        self._pump: Optional[asyncio.Task] = None
+        self._sources = None
+        self._source = None
+        self._track = None
+        self._keep: List[Tuple[float, float]] = []
+        self._keep_lock = threading.Lock()
+        self._current: Optional[_Segment] = None
+
+        self.segments_written = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.segments_deleted = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    async def start(self, video, src: str):
+        """video — VideoStack (стек грузится здесь же); VideoUnavailable наружу."""
+        if self.running:
+            return
+        mod = await video.load()
+        os.makedirs(self.index.dir, exist_ok=True)
+        self.src, self.error = src, None
+        self._stop.clear()
+        self._drain(self._packets)
+        self._drain(self._frames)
+        self._need_keyframe = False
+        # источник — общий с пирами: сжатый поток ffmpeg отдаёт пакеты в _on_packet,
+        # остальное (OpenCV, синтетика, rawvideo) — кадры через MediaRelay
+        self._sources = mod.SOURCES
+        self._source, self._track = mod.SOURCES.acquire_recording(src, self._on_packet if self.passthrough else None)
+        if self._track is None:
+            self.mode = "passthrough"
+            target = self._passthrough_loop
+        else:
+            self.mode = "encode"
+            self._pump = asyncio.create_task(self._pump_frames(mod.MediaStreamError))
+            target = self._encode_loop
+        self.started_ts = time.time()
+        self._thread = threading.Thread(target=target, name="video-recorder", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._pump is not None:
+            self._pump.cancel()
+            try:
+                await self._pump
+            except asyncio.CancelledError:
+                pass
+            self._pump = None
+        if self._thread is not None:
+            # поток дописывает и закрывает текущий сегмент
+            await asyncio.to_thread(self._thread.join, 10.0)
+            self._thread = None
+        if self._source is not None:
+            self._sources.release_recording(self._source, self._track)
+            self._source = self._track = None
+
+    def keep(self, from_ts: float, to_ts: float) -> Dict:
+        """Закрепить окно: готовые сегменты — сразу, текущий и будущие — при закрытии."""
+        with self._keep_lock:
+            self._keep.append((from_ts, to_ts))
+        return {"kept": self.index.keep(from_ts, to_ts), "pending_until": to_ts if to_ts > time.time() else None}
+
+    # --- источник ------------------------------------------------------------
+
+    @staticmethod
+    def _drain(q: queue.Queue):
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                return
+
+    def _on_packet(self, packet):
+        # поток демультиплексора: не ждёт запись ни при каких условиях
+        if packet is None:
+            self.error = "source ended"
+            self._stop.set()
+            return
+        if self._need_keyframe:
+            if not packet.is_keyframe:
+                self.frames_dropped += 1
+                return
+            self._need_keyframe = False
+        try:
+            self._packets.put_nowait((time.time(), packet))
+        except queue.Full:
+            # без ссылочных кадров до ключевого пакеты бесполезны — сбрасываем всё
+            self.frames_dropped += self._packets.qsize() + 1
+            self._drain(self._packets)
+            self._need_keyframe = True
+
+    async def _pump_frames(self, stream_error):
+        # кадры общего источника → очередь потока записи; полная — выкидываем старейший
+        last = None
+        try:
+            while True:
+                frame = await self._track.recv()
+                now = time.time()
+                if last is not None and now - last < 0.9 / self.fps:
+                    continue
+                last = now
+                try:
+                    self._frames.put_nowait((now, frame))
+                except queue.Full:
+                    try:
+                        self._frames.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self._frames.put_nowait((now, frame))
+                    self.frames_dropped += 1
+        except stream_error:
+            self.error = "source ended"
+            self._stop.set()
+
+    # --- поток записи ----------------------------------------------------------
+
+    def _passthrough_loop(self):
+        seg = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    now, packet = self._packets.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if packet.is_keyframe and (seg is None or seg.due(now)):
+                    if seg is not None:
+                        self._finish(seg)
+                    seg = self._current = _Segment(self, now, "passthrough")
+                if seg is None:
+                    continue  # до первого ключевого кадра писать нечего
+                seg.remux(packet, now)
+                self.frames_written += 1
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            if seg is not None:
+                self._finish(seg)
+
+    def _encode_loop(self):
+        seg = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    now, frame = self._frames.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if seg is None or seg.due(now):
+                    if seg is not None:
+                        self._finish(seg)
+                    seg = self._current = _Segment(self, now, "encode")
+                seg.encode(frame, now)
+                self.frames_written += 1
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            if seg is not None:
+                self._finish(seg)
+
+    def _finish(self, seg: _Segment):
+        self._current = None
+        try:
+            rec = seg.close()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            return
+        if not rec["frames"]:
+            os.remove(seg.path)
+            return
+        now = time.time()
+        with self._keep_lock:
+            rec["kept"] = any(a <= rec["end_ts"] and b >= rec["start_ts"] for a, b in self._keep)
+            self._keep = [(a, b) for a, b in self._keep if b >= now]
+        self.index.add(rec)
+        self.segments_written += 1
+        self._prune()
+
+    def _prune(self):
+        ring = self.index.ring()
+        total_s = sum(r["end_ts"] - r["start_ts"] for r in ring)
+        total_b = sum(r["bytes"] for r in ring)
+        # самый свежий сегмент не трогаем, даже если он один больше лимита
+        for r in ring[:-1]:
+            if total_s <= self.ring_s and total_b <= self.ring_max_bytes:
+                break
+            self.index.drop(r)
+            self.segments_deleted += 1
+            total_s -= r["end_ts"] - r["start_ts"]
+            total_b -= r["bytes"]
+
+    def stats(self) -> Dict:
+        cur = self._current
+        return {
+            "running": self.running,
+            "mode": self.mode,
+            "src": self.src,
+            "error": self.error,
+            "started_ts": self.started_ts,
+            "current": {"file": cur.file, "start_ts": cur.start_ts, "frames": cur.frames, "bytes": cur.bytes}
+            if cur is not None else None,
+            "segments_written": self.segments_written,
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "segments_deleted": self.segments_deleted,
+            "ring_s": self.ring_s,
+            "index": self.index.stats(),
+        }
+
+
+def recorder_from_env() -> Recorder:
+    return Recorder(
+        directory=os.getenv("REC_DIR", "/tmp/rocu_rec"),
+        segment_s=float(os.getenv("REC_SEGMENT_S", "60")),
+        segment_max_mb=float(os.getenv("REC_SEGMENT_MAX_MB", "64")),
+        ring_s=float(os.getenv("REC_RING_S", "900")),
+        ring_max_mb=float(os.getenv("REC_RING_MAX_MB", "2048")),
+        fps=float(os.getenv("REC_FPS", "10")),
+        max_height=int(os.getenv("REC_MAX_HEIGHT", "720")),
+        codec=os.getenv("REC_CODEC", "libx264"),
+        crf=int(os.getenv("REC_CRF", "28")),
+        kbps=int(os.getenv("REC_KBPS", "1500")),
+        passthrough=os.getenv("REC_PASSTHROUGH", "1") != "0",
+    )
@@ -0,0 +1,157 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from .acks import AckTracker
+from .commands import SAFETY
+from .fanout import TelemetryFanout
+from .stats import LatencyHistogram
+
+
+class SafetyWatchdog:
+    """
+    Активный dead-man switch. На каждый аппарат — один таймер ровно на
+    last_cmd + heartbeat_timeout (без опроса): команды только сдвигают дедлайн,
+    таймер перевзводится, когда срабатывает раньше времени.
+    По срабатыванию — нулевая команда с id; пока сим не подтвердил, она
+    повторяется с удвоением интервала (retry_s … retry_max_s).
+    Переходы safe mode публикуются событиями в топик аппарата на /ws/telemetry.
+    Несколько воркеров: таймер — только у воркера с сокетом сима (остальные шлют
+    уставки ему), события отдаются on_event — в шину для UI на других воркерах.
+    """
+
+    def __init__(self, fanout: TelemetryFanout, acks: AckTracker, retry_s: float = 0.1, retry_max_s: float = 1.0,
+                 on_event: Optional[Callable[[Dict], None]] = None):
+        self.fanout = fanout
+        self.acks = acks
+        self.on_event = on_event
+        self.retry_s = retry_s
+        self.retry_max_s = retry_max_s
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._stoppers: Dict[str, asyncio.Task] = {}
+        self.engaged: Dict[str, float] = {}  # vehicle_id → дедлайн (monotonic), на котором сработали
+
+        # дедлайн → срабатывание таймера (запаздывание event loop)
+        self.trigger_lag = LatencyHistogram()
+        # дедлайн → ack нулевой команды от сима
+        self.trigger_to_stop = LatencyHistogram()
+        self.triggers = 0
+        self.stops_acked = 0
+        self.resends = 0
+        self.not_connected = 0
+        self.events: deque = deque(maxlen=100)
+
+    # --- heartbeat ------------------------------------------------------------
+
+    def on_cmd(self, v):
+        """Вызывается из VehicleState.touch_cmd: команда пришла — heartbeat жив."""
+        if v.vehicle_id in self.engaged:
+            self._release(v)
+        if v.vehicle_id not in self._timers:
+            self._arm(v)
+
+    def _arm(self, v):
+        loop = asyncio.get_running_loop()
+        deadline = v.last_cmd_mono + v.heartbeat_timeout
+        when = loop.time() + (deadline - time.monotonic())
+        self._timers[v.vehicle_id] = loop.call_at(when, self._check, v)
+
+    def _check(self, v):
+        self._timers.pop(v.vehicle_id, None)
+        if v.remote_owner is not None:
+            # сим ушёл к другому воркеру — следит его watchdog
+            return
+        now = time.monotonic()
+        deadline = v.last_cmd_mono + v.heartbeat_timeout
+        if now < deadline:
+            # были команды после взвода — ждём новый дедлайн
+            self._arm(v)
+            return
+        self._trigger(v, deadline, now)
+
+    # --- safe mode ------------------------------------------------------------
+
+    def _trigger(self, v, deadline: float, now: float):
+        vid = v.vehicle_id
+        self.engaged[vid] = deadline
+        self.triggers += 1
+        self.trigger_lag.record((now - deadline) * 1000.0)
+        self._publish(vid, "on", cmd_age_ms=round((now - v.last_cmd_mono) * 1000.0, 1))
+        if not v.connected:
+            self.not_connected += 1
+            return
+        self._stoppers[vid] = asyncio.create_task(self._stop(v, deadline))
+
+    async def _stop(self, v, deadline: float):
+        vid = v.vehicle_id
+        # один id на все повторы: засчитываем первый дошедший стоп, а не последний отправленный
+        cmd_id, fut = self.acks.register(vid)
+        delay = self.retry_s
+        try:
+            while self.engaged.get(vid) == deadline and v.connected:
+                await v.send_drive(0.0, 0.0, 0.0, heartbeat=False, cmd_id=cmd_id, source=SAFETY)
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), delay)
+                except asyncio.TimeoutError:
+                    self.resends += 1
+                    delay = min(delay * 2, self.retry_max_s)
+                    continue
+                except ConnectionError:
+                    return
+                ms = (time.monotonic() - deadline) * 1000.0
+                self.trigger_to_stop.record(ms)
+                self.stops_acked += 1
+                self._publish(vid, "stopped", trigger_to_stop_ms=round(ms, 1))
+                return
+        finally:
+            self.acks.pending.pop(cmd_id, None)
+            if self._stoppers.get(vid) is asyncio.current_task():
+                del self._stoppers[vid]
+
+    def _release(self, v):
+        vid = v.vehicle_id
+        self.engaged.pop(vid, None)
+        task = self._stoppers.pop(vid, None)
+        if task is not None:
+            task.cancel()
+        self._publish(vid, "off")
+
+    def _publish(self, vehicle_id: str, state: str, **extra):
+        ev = {"type": "event", "event": "safe_mode", "vehicle_id": vehicle_id,
+              "state": state, "ts": time.time(), **extra}
+        self.deliver(ev)
+        if self.on_event is not None:
+            self.on_event(ev)
+
+    def deliver(self, ev: Dict):
+        """Событие safe mode в историю и подписчикам аппарата (своё или с шины)."""
+        self.events.append(ev)
+        self.fanout.publish(ev["vehicle_id"], ev)
+
+    def forget(self, vehicle_id: str):
+        t = self._timers.pop(vehicle_id, None)
+        if t is not None:
+            t.cancel()
+        self.engaged.pop(vehicle_id, None)
+        task = self._stoppers.pop(vehicle_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def close(self):
+        for vid in list(self._timers) + list(self._stoppers):
+            self.forget(vid)
+
+    def stats(self, events: Optional[int] = None) -> Dict:
+        out = {
+            "engaged": sorted(self.engaged),
+            "triggers": self.triggers,
+            "stops_acked": self.stops_acked,
+            "resends": self.resends,
+            "not_connected": self.not_connected,
+            "trigger_lag": self.trigger_lag.snapshot(),
+            "trigger_to_stop": self.trigger_to_stop.snapshot(),
+        }
+        if events:
+            out["events"] = list(self.events)[-events:]
+        return out
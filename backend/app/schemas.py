@@ -1,6 +1,6 @@
 
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 from typing import List
 
@@ -33,10 +33,71 @@ class Waypoint(BaseModel):
 class Mission(BaseModel):
     waypoints: List[Waypoint]
 
+class GeoPoint(BaseModel):
+    lat: float
+    lon: float
+
+class Geofence(BaseModel):
+    id: str
+    kind: str = "keep_out"  # keep_out | keep_in
+    polygon: List[GeoPoint]
+
+class Geofences(BaseModel):
+    fences: List[Geofence]
+
 class CommandAck(BaseModel):
     accepted: bool
     ts: float
     rtt_ms: float
+    id: Optional[int] = None  # correlation id, echoed by the sim in its ack
+
+class ClientFanoutStats(BaseModel):
+    client_id: int
+    fmt: str
+    topics: List[str] = []
+    queued: int
+    enqueued: int
+    sent: int
+    dropped: int
+    resyncs: int = 0
+    bytes_sent: int = 0
+    last_lag_ms: float
+    max_lag_ms: float
+    connected_s: float
+
+class RttStats(BaseModel):
+    count: int
+    mean_ms: float
+    min_ms: float
+    max_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    timeouts: int = 0
+
+class LogStats(BaseModel):
+    path: str
+    buffered: int
+    written: int
+    dropped: int
+    flushes: int
+    rotations: int
+    errors: int
+    last_error: Optional[str] = None
+
+class VehicleStats(BaseModel):
+    vehicle_id: str
+    connected: bool
+    safe_mode: bool
+    last_cmd_ts: Optional[float] = None
+    last_telemetry_ts: Optional[float] = None
+    frames: int
+    takeovers: int
+    relayed: int = 0
+    remote_owner: Optional[str] = None
+    history: Dict[str, Any] = {}
+    commands: Dict[str, Any] = {}
+    mission: Dict[str, Any] = {}
 
 class Metrics(BaseModel):
     safe_mode: bool
@@ -45,3 +106,18 @@ class Metrics(BaseModel):
     telemetry_clients: int
     sim_connected: bool
     uptime_s: float
+    fanout: List[ClientFanoutStats] = []
+    cmd_rtt: Dict[str, RttStats] = {}
+    logs: List[LogStats] = []
+    video: Dict[str, Any] = {}
+    video_sources: List[Dict[str, Any]] = []
+    video_peers: Dict[str, Any] = {}
+    recorder: Dict[str, Any] = {}
+    static_assets: Dict[str, Any] = {}
+    metrics_watch: Dict[str, Any] = {}
+    mission_drivers: List[Dict[str, Any]] = []
+    vehicles: List[VehicleStats] = []
+    safety: Dict[str, Any] = {}
+    control: Dict[str, Any] = {}
+    geofences: Dict[str, Any] = {}
+    bus: Dict[str, Any] = {}
@@ -1,16 +1,50 @@
 
 import asyncio
+import json
+import os
+import re
 import time
-from typing import Set, Optional
+from typing import Callable, Dict, Iterator, Optional
 
-class GlobalState:
-    def __init__(self, heartbeat_timeout: float = 0.8):
-        # wall-clock: только для UI/логов
-        self.start_ts = time.time()
-        # monotonic: для расчётов (не дергается от NTP)
-        self.start_mono = time.monotonic()
+from .acks import AckTracker
+from .bus import make_bus
+from .codec import DeltaEncoder
+from .commands import MANUAL, MISSION, SAFETY, CommandScheduler
+from .fanout import TelemetryFanout
+from .history import TelemetryHistory
+from .safety import SafetyWatchdog
+
+# Аппарат, к которому относятся запросы без ?vehicle= (однобортовой режим)
+DEFAULT_VEHICLE = "default"
+_VEHICLE_ID = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def valid_vehicle_id(vehicle_id: str) -> bool:
+    return bool(_VEHICLE_ID.match(vehicle_id or ""))
 
+
+class MissionState:
+    def __init__(self):
+        self.home = None      # {'lat':..., 'lon':...}
+        self.rtl  = False
+        self.active = False
+        self.paused = False
+        self.waypoints = []
+        self.route = None     # geo.Route: длины/курсы плеч, считаются при загрузке миссии
+        self.current_idx = 0
+        self.log_path = "/tmp/rocu_mission.jsonl"
+
+
+class VehicleState:
+    """Всё, что относится к одному аппарату: сокет сима, heartbeat, кадр, миссия."""
+
+    def __init__(self, vehicle_id: str, heartbeat_timeout: float = 0.8, on_cmd: Optional[Callable] = None,
+                 history_size: int = 3000, cmd_max_hz: float = 20.0, manual_hold_s: float = 1.0,
+                 on_coalesce: Optional[Callable] = None, relay: Optional[Callable] = None):
+        self.vehicle_id = vehicle_id
         self.heartbeat_timeout = heartbeat_timeout
+        self.on_cmd = on_cmd  # watchdog: каждая команда сдвигает дедлайн dead-man switch (только у владельца сима)
+        self.created_ts = time.time()
 
         # wall-clock штампы (для отображения)
         self.last_cmd_ts: Optional[float] = None
@@ -20,10 +54,95 @@ class GlobalState:
         self.last_cmd_mono: Optional[float] = None
         self.last_telemetry_mono: Optional[float] = None
 
-        self.telemetry_clients: Set = set()
-        self.sim_websocket = None  # single sim connection
-        self._lock = asyncio.Lock()
+        self.sim_websocket = None  # one sim connection per vehicle
+        # несколько воркеров: сим подключён к другому воркеру (его id); уставки уходят
+        # через шину в его планировщик, watchdog аппарата — тоже у него
+        self.remote_owner: Optional[str] = None
+        self.relay = relay
+        self.takeovers = 0         # сколько раз новое подключение вытеснило старое
+        self.relayed = 0           # уставок отдано через шину планировщику владельца
         self.last_frame = None
+        # счётчик кадров + Condition: автопилот ждёт новый кадр, а не спит по таймеру
+        self.frame_count = 0
+        self._frame_cond = asyncio.Condition()
+        # последние кадры (фиксированная память) — история и догрузка для новых клиентов
+        self.history = TelemetryHistory(history_size)
+        # общий delta-кодер кадров этого аппарата для UI-клиентов с fmt=delta
+        self.delta = DeltaEncoder()
+        # все drive-команды на сим — через планировщик: последняя уставка, лимит частоты,
+        # ручное управление важнее автопилота; устаревшее не отправляется
+        self.commands = CommandScheduler(self._transmit, cmd_max_hz, manual_hold_s,
+                                         stale_s=heartbeat_timeout, on_coalesce=on_coalesce)
+        self.mission = MissionState()
+
+    async def publish_frame(self, frame):
+        self.last_frame = frame
+        self.history.append(frame)
+        self.frame_count += 1
+        self.last_telemetry_ts = time.time()
+        self.last_telemetry_mono = time.monotonic()
+        async with self._frame_cond:
+            self._frame_cond.notify_all()
+
+    async def wait_frame(self, seen: int, timeout: float) -> bool:
+        """True, когда frame_count ушёл дальше seen; False по таймауту."""
+        if self.frame_count != seen:
+            return True
+        try:
+            async with self._frame_cond:
+                await asyncio.wait_for(
+                    self._frame_cond.wait_for(lambda: self.frame_count != seen), timeout
+                )
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def send_drive(self, vx: float, vy: float, wz: float, heartbeat: bool = True,
+                         cmd_id: Optional[int] = None, source: str = MISSION) -> bool:
+        # команда без ожидания ack (автопилот, стопы). heartbeat=False — только для
+        # стопов самого watchdog'а, иначе он сам бы продлевал себе дедлайн
+        if heartbeat:
+            self.touch_cmd()
+        if not self.connected:
+            return False
+        data = {"ts": time.time(), "vx": vx, "vy": vy, "wz": wz}
+        if source == SAFETY:
+            return await self.commands.send_now(data, cmd_id)
+        return self.submit(data, source, cmd_id)
+
+    def submit(self, data: Dict, source: str = MANUAL, cmd_id: Optional[int] = None) -> bool:
+        """Уставка в планировщик аппарата; сим у другого воркера — в его планировщик через шину."""
+        if self.sim_websocket is None and self.remote_owner is not None and self.relay is not None:
+            # приоритет ручного, удержание и лимит частоты — одни на борт, у владельца сокета;
+            # ack по cmd_id вернётся сюда через шину
+            self.relayed += 1
+            return self.relay(self.vehicle_id, {"data": data, "source": source, "id": cmd_id})
+        return self.commands.submit(data, source, cmd_id)
+
+    async def _transmit(self, msg: Dict) -> bool:
+        ws = self.sim_websocket
+        if ws is None:
+            return False
+        # vehicle_id — для мультиплексного сокета сима (один сокет, много аппаратов)
+        msg["vehicle_id"] = self.vehicle_id
+        try:
+            await ws.send_text(json.dumps(msg))
+            return True
+        except Exception:
+            return False
+
+    def touch_cmd(self):
+        self.last_cmd_ts = time.time()
+        self.last_cmd_mono = time.monotonic()
+        # сим у другого воркера: heartbeat дойдёт до его watchdog'а вместе с уставкой
+        if self.on_cmd is not None and self.remote_owner is None:
+            self.on_cmd(self)
+
+    def touch_remote(self, ts: float):
+        """Heartbeat, принятый владельцем сима (шина): safe_mode здесь тот же, что у него."""
+        if self.last_cmd_ts is None or ts > self.last_cmd_ts:
+            self.last_cmd_ts = ts
+            self.last_cmd_mono = time.monotonic() - max(0.0, time.time() - ts)
 
     # Возраст последней команды/телеметрии в секундах (по monotonic)
     def cmd_age(self) -> float:
@@ -37,23 +156,127 @@ class GlobalState:
         # Dead-man switch: нет команд дольше порога → стоп
         return self.cmd_age() > self.heartbeat_timeout
 
-    @safe_mode.setter
-    def safe_mode(self, value: bool):
-        # Сеттер оставлен для совместимости; если хочешь жёстко управлять вручную,
-        # можно хранить override-флаг. По умолчанию игнорируем и не меняем расчётную логику.
-        pass
+    @property
+    def connected(self) -> bool:
+        return self.sim_websocket is not None or self.remote_owner is not None
+
+    def stats(self) -> Dict:
+        m = self.mission
+        return {
+            "vehicle_id": self.vehicle_id,
+            "connected": self.connected,
+            "remote_owner": self.remote_owner,
+            "safe_mode": self.safe_mode,
+            "last_cmd_ts": self.last_cmd_ts,
+            "last_telemetry_ts": self.last_telemetry_ts,
+            "frames": self.frame_count,
+            "takeovers": self.takeovers,
+            "relayed": self.relayed,
+            "history": self.history.stats(),
+            "commands": self.commands.stats(),
+            "mission": {
+                "active": m.active, "paused": m.paused, "rtl": m.rtl,
+                "idx": m.current_idx, "waypoints": len(m.waypoints),
+            },
+        }
+
+
+class Fleet:
+    """Реестр аппаратов по vehicle_id; запись появляется при первом подключении сима."""
+
+    def __init__(self, heartbeat_timeout: float = 0.8, on_cmd: Optional[Callable] = None, **vehicle_opts):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.on_cmd = on_cmd
+        self.vehicle_opts = vehicle_opts  # остальные параметры VehicleState (история, планировщик)
+        self.vehicles: Dict[str, VehicleState] = {}
+
+    def __len__(self) -> int:
+        return len(self.vehicles)
+
+    def __iter__(self) -> Iterator[VehicleState]:
+        return iter(list(self.vehicles.values()))
+
+    def get(self, vehicle_id: str) -> Optional[VehicleState]:
+        return self.vehicles.get(vehicle_id)
+
+    def ensure(self, vehicle_id: str) -> VehicleState:
+        v = self.vehicles.get(vehicle_id)
+        if v is None:
+            v = self.vehicles[vehicle_id] = VehicleState(vehicle_id, self.heartbeat_timeout, self.on_cmd, **self.vehicle_opts)
+        return v
+
+    def connected(self) -> int:
+        return sum(1 for v in self.vehicles.values() if v.connected)
+
+    def stats(self):
+        return [v.stats() for v in self.vehicles.values()]
+
+
+class GlobalState:
+    def __init__(self, heartbeat_timeout: float = 0.8):
+        # wall-clock: только для UI/логов
+        self.start_ts = time.time()
+        # monotonic: для расчётов (не дергается от NTP)
+        self.start_mono = time.monotonic()
+
+        self.heartbeat_timeout = heartbeat_timeout
+
+        # шина между воркерами (STATE_BACKEND=local|unix): зеркало кадров, владельцы
+        # сокетов сима, команды/ack'и, миссии; в одном воркере — заглушка без затрат
+        self.bus = make_bus()
+
+        # UI-клиенты телеметрии: у каждого своя очередь, задача-отправитель и подписки
+        self.fanout = TelemetryFanout(queue_size=int(os.getenv("TELEMETRY_QUEUE", "2")))
+        # id команд → ожидающие ack; RTT-гистограммы по аппаратам (link = vehicle_id)
+        # с шиной id команд уникальны между воркерами: ack приходит воркеру-владельцу сима
+        self.acks = AckTracker(timeout_s=float(os.getenv("CMD_ACK_TIMEOUT_MS", "500")) / 1000.0,
+                               id_base=(os.getpid() % 1_000_000) * 1_000_000_000 if self.bus.distributed else 0)
+        # dead-man switch: нулевая команда через heartbeat_timeout после последней;
+        # с шиной — только на воркере с сокетом сима, события — всем воркерам
+        self.safety = SafetyWatchdog(
+            self.fanout, self.acks, on_event=self._relay_safety if self.bus.distributed else None,
+            retry_s=float(os.getenv("SAFETY_RETRY_MS", "100")) / 1000.0,
+            retry_max_s=float(os.getenv("SAFETY_RETRY_MAX_MS", "1000")) / 1000.0,
+        )
+
+        # аппараты: у каждого свой сокет сима, heartbeat и миссия
+        # TELEMETRY_HISTORY — кадров в кольце на аппарат (3000 ≈ 5 мин при 10 Гц, ~190 КБ)
+        # CMD_MAX_HZ — не чаще стольких drive-команд в секунду на аппарат;
+        # CMD_MANUAL_HOLD_MS — сколько после ручной команды автопилот молчит
+        self.fleet = Fleet(
+            heartbeat_timeout, on_cmd=self._on_cmd,
+            history_size=int(os.getenv("TELEMETRY_HISTORY", "3000")),
+            cmd_max_hz=float(os.getenv("CMD_MAX_HZ", "20")),
+            manual_hold_s=float(os.getenv("CMD_MANUAL_HOLD_MS", "1000")) / 1000.0,
+            on_coalesce=self.acks.chain,
+            relay=self._relay_cmd,
+        )
+        self.default = self.fleet.ensure(DEFAULT_VEHICLE)
+        self._lock = asyncio.Lock()
+        # heartbeat владельца сима для остальных воркеров — не чаще раза в столько секунд
+        self.touch_every_s = float(os.getenv("BUS_TOUCH_MS", "100")) / 1000.0
+        self._touch_sent: Dict[str, float] = {}
+
+    def _on_cmd(self, v: VehicleState):
+        self.safety.on_cmd(v)
+        if self.bus.distributed:
+            prev = self._touch_sent.get(v.vehicle_id, float("-inf"))
+            if v.last_cmd_mono - prev >= self.touch_every_s:
+                self._touch_sent[v.vehicle_id] = v.last_cmd_mono
+                self.bus.publish("touch", {"v": v.vehicle_id, "ts": v.last_cmd_ts})
+
+    def _relay_cmd(self, vehicle_id: str, msg: Dict) -> bool:
+        self.bus.publish("cmd", {"v": vehicle_id, **msg})
+        return True
+
+    def _relay_safety(self, ev: Dict):
+        self.bus.publish("safety", ev)
+
+    def vehicle(self, vehicle_id: Optional[str]) -> Optional[VehicleState]:
+        return self.fleet.get(vehicle_id or DEFAULT_VEHICLE)
 
     def uptime(self) -> float:
         return time.time() - self.start_ts
-STATE = GlobalState()
-class MissionState:
-    def __init__(self):
-        self.home = None      # {'lat':..., 'lon':...}
-        self.rtl  = False
-        self.active = False
-        self.paused = False
-        self.waypoints = []
-        self.current_idx = 0
-        self.log_path = "/tmp/rocu_mission.jsonl"
-
-MISSION = MissionState()
+STATE = GlobalState(heartbeat_timeout=float(os.getenv("HEARTBEAT_TIMEOUT_MS", "800")) / 1000.0)
+# миссия аппарата по умолчанию — для кода, который пока знает об одном борте
+MISSION = STATE.default.mission
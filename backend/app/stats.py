@@ -0,0 +1,198 @@
+import asyncio
+import bisect
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+def _log_buckets(lo_ms: float = 0.05, hi_ms: float = 60_000.0, growth: float = 1.1) -> List[float]:
+    # Логарифмические корзины: ~10% относительной ошибки на любом масштабе
+    out, b = [], lo_ms
+    while b < hi_ms:
+        out.append(round(b, 4))
+        b *= growth
+    out.append(hi_ms)
+    return out
+
+
+_DEFAULT_BOUNDS = _log_buckets()
+
+
+class LatencyHistogram:
+    """
+    Дешёвая гистограмма задержек (мс): O(log n) на запись, без хранения сэмплов.
+    Перцентили — по верхней границе корзины, этого хватает для p50/p95/p99.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "total", "min", "max")
+
+    def __init__(self, bounds: List[float] = _DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, value_ms: float):
+        self.counts[bisect.bisect_left(self.bounds, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        if value_ms < self.min:
+            self.min = value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank and c:
+                if i >= len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "min_ms": round(self.min, 3) if self.count else 0.0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+        }
+
+
+# --- экспорт: Prometheus text + JSON ----------------------------------------
+
+# Корзины для Prometheus (мс): 150 внутренних корзин слишком много для скрейпа,
+# отдаём кумулятивные счётчики на этих границах (с точностью внутренних ~10%)
+PROM_BOUNDS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _labels(labels: Dict[str, str], extra: str = "") -> str:
+    parts = [f'{k}="{str(v)}"' for k, v in sorted(labels.items())]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def prom_histogram(name: str, h: LatencyHistogram, labels: Dict[str, str]) -> List[str]:
+    """Гистограмма в секундах (конвенция Prometheus), _bucket/_sum/_count."""
+    out = []
+    acc, i = 0, 0
+    for le in PROM_BOUNDS_MS:
+        while i < len(h.bounds) and h.bounds[i] <= le:
+            acc += h.counts[i]
+            i += 1
+        le_s = 'le="%g"' % (le / 1000.0)
+        out.append(f"{name}_bucket{_labels(labels, le_s)} {acc}")
+    inf = 'le="+Inf"'
+    out.append(f"{name}_bucket{_labels(labels, inf)} {h.count}")
+    out.append(f"{name}_sum{_labels(labels)} {h.total / 1000.0:.6f}")
+    out.append(f"{name}_count{_labels(labels)} {h.count}")
+    return out
+
+
+class PerfRegistry:
+    """
+    Гистограммы горячего пути по имени + метки. Запись — обычный
+    LatencyHistogram.record(), без блокировок и контекст-менеджеров: в горячем
+    пути замер — это два perf_counter() и bisect.
+    collect(fn) — дополнительные источники (ack RTT, watchdog, счётчики состояния):
+    fn() отдаёт ("histogram"|"gauge"|"counter", имя, help, метки, значение/гистограмма).
+    """
+
+    def __init__(self, prefix: str = "rocu"):
+        self.prefix = prefix
+        self._hists: Dict[Tuple[str, Tuple], LatencyHistogram] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple]]] = []
+
+    def histogram(self, name: str, help: str = "", **labels) -> LatencyHistogram:
+        key = (name, tuple(sorted(labels.items())))
+        h = self._hists.get(key)
+        if h is None:
+            h = self._hists[key] = LatencyHistogram()
+            if help:
+                self._help[name] = help
+        return h
+
+    def collect(self, fn: Callable[[], Iterable[Tuple]]):
+        self._collectors.append(fn)
+
+    def _samples(self):
+        for (name, labels), h in list(self._hists.items()):
+            yield "histogram", name, self._help.get(name, ""), dict(labels), h
+        for fn in self._collectors:
+            try:
+                yield from fn()
+            except Exception:
+                continue  # сломанный источник не должен ронять весь экспорт
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        out: Dict[str, List[Dict]] = {}
+        for kind, name, _, labels, value in self._samples():
+            entry = {"labels": labels}
+            if kind == "histogram":
+                entry.update(value.snapshot())
+            else:
+                entry["value"] = value
+            out.setdefault(name, []).append(entry)
+        return out
+
+    def prometheus(self) -> str:
+        groups: Dict[str, Tuple[str, str, List[str]]] = {}
+        for kind, name, help, labels, value in self._samples():
+            if kind == "histogram":
+                full = f"{self.prefix}_{name}_seconds"
+                lines = prom_histogram(full, value, labels)
+            else:
+                full = f"{self.prefix}_{name}" + ("_total" if kind == "counter" else "")
+                lines = [f"{full}{_labels(labels)} {value}"]
+            g = groups.setdefault(full, (kind, help, []))
+            g[2].extend(lines)
+        out = []
+        for full, (kind, help, lines) in groups.items():
+            if help:
+                out.append(f"# HELP {full} {help}")
+            out.append(f"# TYPE {full} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+class LoopLagMonitor:
+    """Лаг event loop: насколько позже заказанного просыпается sleep(interval)."""
+
+    def __init__(self, hist: LatencyHistogram, interval_s: float = 0.1):
+        self.hist = hist
+        self.interval_s = interval_s
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval_s)
+            self.hist.record(max(0.0, (loop.time() - t - self.interval_s) * 1000.0))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Общий реестр процесса: модули берут из него свои гистограммы
+PERF = PerfRegistry()
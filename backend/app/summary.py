@@ -0,0 +1,113 @@
+import asyncio
+import json
+import zlib
+from typing import Callable, Dict, Optional, Set, Tuple
+
+# Поля, которые меняются всегда и в версию не входят (клиент досчитывает сам)
+_VOLATILE = ("uptime_s",)
+
+Listener = Callable[[str, Dict], None]
+
+
+class MetricsWatch:
+    """
+    Короткая сводка аппарата для UI вместо опроса /api/v1/metrics из каждой
+    вкладки (pydantic Metrics целиком раз в 1.5 с на вкладку). Сводку строит
+    одна задача раз в interval_s, и только пока кто-то ждёт или подписан; etag —
+    crc32 значений без uptime_s, так что он меняется только при реальных
+    изменениях. Доставка: long-poll (wait до смены etag) или push — listener
+    кладёт событие в очередь канала /ws/telemetry.
+    """
+
+    def __init__(self, build: Callable[[str], Dict], interval_s: float = 0.5):
+        self.build = build
+        self.interval_s = interval_s
+        self._cur: Dict[str, Tuple[str, Dict]] = {}
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._listeners: Dict[str, Set[Listener]] = {}
+        self._waiters: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.builds = 0
+        self.changes = 0
+        self.pushes = 0
+        self.polls = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def etag(summary: Dict) -> str:
+        stable = {k: v for k, v in summary.items() if k not in _VOLATILE}
+        return '"%08x"' % zlib.crc32(json.dumps(stable, sort_keys=True, default=str).encode())
+
+    def current(self, vehicle_id: str) -> Tuple[str, Dict]:
+        """Свежая сводка (сразу, без ожидания) — заодно обновляет кэш и будит ждущих."""
+        summary = self.build(vehicle_id)
+        self.builds += 1
+        tag = self.etag(summary)
+        prev = self._cur.get(vehicle_id)
+        self._cur[vehicle_id] = (tag, summary)
+        if prev is not None and prev[0] != tag:
+            self.changes += 1
+            ev = self._changed.pop(vehicle_id, None)
+            if ev is not None:
+                ev.set()
+            for fn in list(self._listeners.get(vehicle_id, ())):
+                self.pushes += 1
+                fn(tag, summary)
+        return tag, summary
+
+    async def wait(self, vehicle_id: str, etag: Optional[str], timeout_s: float) -> Optional[Tuple[str, Dict]]:
+        """Long-poll: сводка, как только etag станет отличным от переданного; None — не дождались."""
+        self.polls += 1
+        tag, summary = self.current(vehicle_id)
+        if etag is None or tag != etag or timeout_s <= 0:
+            return (tag, summary) if tag != etag else None
+        ev = self._changed.get(vehicle_id)
+        if ev is None:
+            ev = self._changed[vehicle_id] = asyncio.Event()
+        self._hold(vehicle_id, 1)
+        try:
+            await asyncio.wait_for(ev.wait(), timeout_s)
+        except asyncio.TimeoutError:
+            self.not_modified += 1
+            return None
+        finally:
+            self._hold(vehicle_id, -1)
+        return self._cur[vehicle_id]
+
+    def subscribe(self, vehicle_id: str, fn: Listener):
+        self._listeners.setdefault(vehicle_id, set()).add(fn)
+        self._hold(vehicle_id, 1)
+
+    def unsubscribe(self, vehicle_id: str, fn: Listener):
+        fns = self._listeners.get(vehicle_id)
+        if fns is not None and fn in fns:
+            fns.discard(fn)
+            if not fns:
+                del self._listeners[vehicle_id]
+            self._hold(vehicle_id, -1)
+
+    def _hold(self, vehicle_id: str, d: int):
+        n = self._waiters.get(vehicle_id, 0) + d
+        if n > 0:
+            self._waiters[vehicle_id] = n
+        else:
+            self._waiters.pop(vehicle_id, None)
+        if self._waiters and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # одна задача на все вкладки; никого нет — выходит
+        while self._waiters:
+            await asyncio.sleep(self.interval_s)
+            for vid in list(self._waiters):
+                self.current(vid)
+
+    def stats(self) -> Dict:
+        return {
+            "watched": sorted(self._waiters),
+            "builds": self.builds,
+            "changes": self.changes,
+            "pushes": self.pushes,
+            "polls": self.polls,
+            "not_modified": self.not_modified,
+        }
@@ -1,6 +1,17 @@
-import asyncio, os, time, fractions, cv2, av
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from aiortc.contrib.media import MediaRelay, MediaPlayer
+import asyncio, os, threading, time, fractions, cv2, av
+import aiortc
+import logging
+import uuid
+import numpy as np
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCRtpSender, VideoStreamTrack
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from aiortc.contrib.media import MediaRelay, REAL_TIME_FORMATS
+from av.video.reformatter import VideoReformatter
+
+from .qos import RateController
+from .stats import PERF
 
 CURRENT_MAX_KBPS = 1500
 def set_max_kbps(v:int):
@@ -9,7 +20,43 @@ def set_max_kbps(v:int):
 def document_max_kbps():
     return CURRENT_MAX_KBPS
 
-_relay = MediaRelay()
+# Уровни общих энкодеров (kbps). Пиры с близким max_kbps попадают в один уровень
+# и получают одни и те же закодированные пакеты. Пустая строка — кодировать на пира.
+VIDEO_TIERS_KBPS = sorted(int(x) for x in os.getenv("VIDEO_TIERS_KBPS", "250,400,800,1500,2500").split(",") if x.strip())
+VIDEO_TIER_GOP_S = float(os.getenv("VIDEO_TIER_GOP_S", "2.0"))
+# Очередь пакетов уровня на пира: не успевает — очередь сбрасывается до следующего ключевого
+VIDEO_PEER_QUEUE = int(os.getenv("VIDEO_PEER_QUEUE", "60"))
+# Ключевые кадры по запросам (новый пир, PLI) — не чаще; лишние запросы ждут этого окна
+VIDEO_KEYFRAME_MIN_S = float(os.getenv("VIDEO_KEYFRAME_MIN_S", "0.5"))
+
+log = logging.getLogger(__name__)
+_warned: set = set()
+
+def _warn_once(key: str, msg: str):
+    if key not in _warned:
+        _warned.add(key)
+        log.warning(msg)
+def _tier_for(max_kbps: int) -> Optional[int]:
+    if not VIDEO_TIERS_KBPS:
+        return None
+    fit = [t for t in VIDEO_TIERS_KBPS if t <= max_kbps]
+    return fit[-1] if fit else VIDEO_TIERS_KBPS[0]
+
+def _tier_profile(kbps: int) -> Tuple[int, int]:
+    # (max_height, fps): на узких уровнях уменьшаем кадр и частоту —
+    # одним битрейтом 720p30 в 300 кбит/с не уложить
+    if kbps < 300:
+        return 240, 10
+    if kbps < 600:
+        return 360, 15
+    if kbps < 1200:
+        return 540, 30
+    return 720, 30
+
+# кадр в av.VideoFrame после ожидания темпа (next_timestamp в замер не входит)
+_H_RECV_SYNTH = PERF.histogram("video_recv", "source frame → av.VideoFrame", source="synthetic")
+_H_RECV_CAPTURE = PERF.histogram("video_recv", "source frame → av.VideoFrame", source="capture")
+_H_RECV_DEMUX = PERF.histogram("video_recv", "source frame → av.VideoFrame", source="demux")
 
 class SyntheticVideoTrack(VideoStreamTrack):
     kind = "video"
@@ -19,102 +66,901 @@ class SyntheticVideoTrack(VideoStreamTrack):
         self._width = width
         self._height = height
         self._start = time.time()
+        # фон с надписью рисуем один раз; кадр — переиспользуемый буфер,
+        # на каждом тике перерисовываются только полосы
+        self._background = np.zeros((height, width, 3), dtype=np.uint8)
+        cv2.putText(self._background, "ROCU-Lite Synthetic", (20,40), cv2.FONT_HERSHEY_SIMPLEX, 1,(200,200,200),2)
+        self._img = self._background.copy()
+        self._prev_xy = None
 
-    async def recv(self):
-
-        # получаем согласованные PTS и time_base от базового класса
-        pts, time_base = await self.next_timestamp()
-        import numpy as np
+    def _render(self):
         t = int((time.time() - self._start) * 1000)
-        img = np.zeros((self._height, self._width, 3), dtype=np.uint8)
         x = (t // 10) % self._width
         y = (t // 15) % self._height
+        img, bg = self._img, self._background
+        if self._prev_xy is not None:
+            px, py = self._prev_xy
+            img[:, px:px+10, :] = bg[:, px:px+10, :]
+            img[py:py+10, :, :] = bg[py:py+10, :, :]
         img[:, x:x+10, :] = (0,255,0)
         img[y:y+10, :, :] = (255,255,255)
-        cv2.putText(img, "ROCU-Lite Synthetic", (20,40), cv2.FONT_HERSHEY_SIMPLEX, 1,(200,200,200),2)
-        frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+        self._prev_xy = (x, y)
+        return img
+
+    async def recv(self):
+
+        # получаем согласованные PTS и time_base от базового класса
+        pts, time_base = await self.next_timestamp()
+        t0 = time.perf_counter()
+        # from_ndarray копирует данные, так что буфер можно сразу переиспользовать
+        frame = av.VideoFrame.from_ndarray(self._render(), format="bgr24")
+        _H_RECV_SYNTH.record((time.perf_counter() - t0) * 1000.0)
         frame.pts = pts
         frame.time_base = time_base
         return frame
 
 class OpenCVCaptureTrack(VideoStreamTrack):
+    """
+    cv2.VideoCapture читается в отдельном потоке в пул из трёх заранее выделенных
+    буферов (пишется / последний готовый / отдаётся сейчас), recv() на event loop
+    только забирает последний готовый кадр и никогда не ждёт камеру.
+    """
     kind = "video"
     def __init__(self, src):
         super().__init__()
         self.cap = cv2.VideoCapture(src)
+        self._pool: List[Optional[np.ndarray]] = [None, None, None]
+        self._latest: Optional[int] = None   # индекс последнего готового буфера
+        self._in_use: Optional[int] = None   # буфер, который сейчас копирует recv()
+        self._lock = threading.Lock()
+        self._running = False
+        self._ended = False
+        self._thread: Optional[threading.Thread] = None
+        self._first = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.frames_read = 0
 
+    def _ensure_reader(self):
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._running = True
+            self._thread = threading.Thread(target=self._reader, name="ocv-capture", daemon=True)
+            self._thread.start()
+
+    def _reader(self):
+        # файл читается быстрее реального времени — держим его родной FPS;
+        # камера/RTSP и так отдают кадры в своём темпе
+        is_file = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0
+        fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        period = 1.0 / fps if is_file and fps > 0 else 0.0
+        next_t = time.monotonic()
+        try:
+            while self._running:
+                if period:
+                    next_t += period
+                    delay = next_t - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                with self._lock:
+                    idx = next(i for i in range(3) if i != self._latest and i != self._in_use)
+                ok, img = self.cap.read(self._pool[idx])
+                if not ok:
+                    break
+                with self._lock:
+                    self._pool[idx] = img
+                    first = self._latest is None
+                    self._latest = idx
+                self.frames_read += 1
+                if first:
+                    self._loop.call_soon_threadsafe(self._first.set)
+        finally:
+            self._ended = True
+            self.cap.release()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._first.set)
 
     async def recv(self):
+        self._ensure_reader()
         # таймкоды от базового класса (темп тоже задаётся тут)
         pts, time_base = await self.next_timestamp()
-        ok, frame = self.cap.read()
-        if not ok:
-            raise RuntimeError("Video source ended")
-        frame = av.VideoFrame.from_ndarray(frame, format="bgr24")
+        await self._first.wait()
+        with self._lock:
+            if self._ended or self._latest is None:
+                raise MediaStreamError
+            idx = self._in_use = self._latest
+        t0 = time.perf_counter()
+        try:
+            frame = av.VideoFrame.from_ndarray(self._pool[idx], format="bgr24")
+        finally:
+            with self._lock:
+                self._in_use = None
+        _H_RECV_CAPTURE.record((time.perf_counter() - t0) * 1000.0)
         frame.pts = pts
         frame.time_base = time_base
         return frame
 
+    def stop(self):
+        super().stop()
+        self._running = False
+        if self._thread is None:
+            self.cap.release()
+
+class DemuxTrack(MediaStreamTrack):
+    """
+    Источник через ffmpeg (файл, RTSP, v4l2): открывается один раз, демультиплексор
+    в своём потоке. Пакеты отдаются отводу (запись перекладывает их без
+    перекодирования), кадры — пирам; декодировать начинаем с первого recv, так что
+    запись без зрителей не декодирует ничего.
+    Один демультиплексор на источник — RTSP не тянется дважды, камера не ловит EBUSY.
+    Файл читается в темпе своих таймкодов, живые форматы — как приходят.
+    """
+    kind = "video"
+
+    def __init__(self, src: str):
+        super().__init__()
+        opts = {"rtsp_transport": "tcp"} if src.startswith("rtsp") else {}
+        self._container = av.open(src, options=opts, timeout=5.0)
+        if not self._container.streams.video:
+            self._container.close()
+            raise RuntimeError(f"no video stream in {src}")
+        self._stream = self._container.streams.video[0]
+        self.codec = self._stream.codec_context.name
+        self._realtime = bool(set(self._container.format.name.split(",")) & set(REAL_TIME_FORMATS))
+        self._frames: asyncio.Queue = asyncio.Queue(maxsize=2)
+        self._tap = None
+        self._decode = False
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.packets_read = 0
+        self.frames_decoded = 0
+
+    def set_tap(self, tap):
+        """tap(packet) в потоке демультиплексора, пакет — во владение отвода; tap(None) — конец."""
+        self._tap = tap
+        if tap is not None:
+            self._ensure_reader()
+
+    def _ensure_reader(self):
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._running = True
+            self._thread = threading.Thread(target=self._reader, name="demux", daemon=True)
+            self._thread.start()
+
+    def _reader(self):
+        stream = self._stream
+        t0 = time.monotonic()
+        base_pts = None
+        synced = False  # декодер стартует с ключевого кадра
+        try:
+            for packet in self._container.demux(stream):
+                if not self._running:
+                    break
+                if packet.dts is None:
+                    continue  # пустой пакет конца потока
+                self.packets_read += 1
+                if not self._realtime and packet.pts is not None:
+                    # файл демультиплексируется быстрее реального времени — держим темп
+                    delay = float(packet.pts * stream.time_base) - (time.monotonic() - t0)
+                    if delay > 0:
+                        time.sleep(delay)
+                if self._decode and (synced or packet.is_keyframe):
+                    synced = True
+                    t1 = time.perf_counter()
+                    try:
+                        frames = stream.codec_context.decode(packet)
+                    except av.error.FFmpegError:
+                        frames = []
+                    for frame in frames:
+                        if frame.pts is not None:
+                            if base_pts is None:
+                                base_pts = frame.pts
+                            frame.pts -= base_pts
+                        self.frames_decoded += 1
+                        self._loop.call_soon_threadsafe(self._put, frame)
+                    if frames:
+                        _H_RECV_DEMUX.record((time.perf_counter() - t1) * 1000.0)
+                # после декодирования пакет больше не нужен — отдаём отводу как есть
+                tap = self._tap
+                if tap is not None:
+                    tap(packet)
+        except Exception:
+            log.warning("demux stopped", exc_info=True)
+        finally:
+            self._container.close()
+            tap = self._tap
+            if tap is not None:
+                tap(None)
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._put, None)
+
+    def _put(self, frame):
+        # пиры не успевают — выкидываем старейший кадр, как MediaRelay без буфера
+        if self._frames.full():
+            self._frames.get_nowait()
+        self._frames.put_nowait(frame)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        self._decode = True
+        self._ensure_reader()
+        frame = await self._frames.get()
+        if frame is None:
+            self.stop()
+            raise MediaStreamError
+        return frame
+
+    def stop(self):
+        super().stop()
+        self._running = False
+        if self._thread is None:
+            self._container.close()
+
+class EncodedTierTrack(MediaStreamTrack):
+    """
+    Общий VP8-энкодер уровня: кодирует кадры источника один раз и раздаёт av.Packet
+    подписчикам (subscribe) — у каждого своя ограниченная очередь. RTCRtpSender для
+    пакетов только пакетизирует, без своего энкодера, так что N пиров одного уровня
+    стоят одного кодирования. Ключевые кадры — каждые VIDEO_TIER_GOP_S секунд и по
+    запросу (новый пир, PLI, переполненная очередь), но не чаще VIDEO_KEYFRAME_MIN_S.
+    """
+    kind = "video"
+
+    def __init__(self, source: MediaStreamTrack, kbps: int):
+        super().__init__()
+        self._source = source
+        self.kbps = kbps
+        self.max_height, self.fps = _tier_profile(kbps)
+        self._last_pts_s: Optional[float] = None
+        self._ctx = None
+        self._force_keyframe = True
+        self._last_key_s = float("-inf")
+        self._subs: set = set()
+        self._fanout: Optional[asyncio.Task] = None
+        # полный круг через executor: ожидание потока + кодирование
+        self._encode_hist = PERF.histogram("video_encode", "tier encode via executor", kbps=str(kbps))
+        self._pending: deque = deque()
+        # свой swscale-контекст: кадры источника общие, а frame.reformat()
+        # кэширует контекст в самом кадре — из разных потоков это segfault
+        self._reformatter = VideoReformatter()
+        self.frames_encoded = 0
+        self.bytes_encoded = 0
+        self.encode_cpu_s = 0.0   # CPU-время потока энкодера (thread_time), не wall-clock
+        self.keyframes_requested = 0
+        self.packets_dropped = 0  # выброшено из очередей медленных пиров
+
+    def request_keyframe(self):
+        self.keyframes_requested += 1
+        self._force_keyframe = True
+
+    def subscribe(self) -> "TierSubscription":
+        sub = TierSubscription(self)
+        self._subs.add(sub)
+        if self._fanout is None or self._fanout.done():
+            self._fanout = asyncio.ensure_future(self._run_fanout())
+        # новому пиру нужен ключевой кадр, иначе он ждёт GOP
+        self.request_keyframe()
+        return sub
+
+    def _unsubscribe(self, sub: "TierSubscription"):
+        self._subs.discard(sub)
+
+    async def _run_fanout(self):
+        # одна задача читает энкодер за всех пиров уровня; подписчиков нет — выходит
+        try:
+            while self._subs:
+                packet = await self.recv()
+                for sub in list(self._subs):
+                    sub._push(packet)
+        except MediaStreamError:
+            pass
+        for sub in list(self._subs):
+            sub._push(None)
+
+    def _open(self, width: int, height: int):
+        bitrate = self.kbps * 1000
+        ctx = av.CodecContext.create("libvpx", "w")
+        ctx.width = width
+        ctx.height = height
+        ctx.bit_rate = bitrate
+        ctx.pix_fmt = "yuv420p"
+        ctx.framerate = fractions.Fraction(self.fps, 1)
+        ctx.time_base = fractions.Fraction(1, 90000)
+        ctx.gop_size = max(1, int(VIDEO_TIER_GOP_S * self.fps))
+        ctx.qmin = 2
+        ctx.qmax = 56
+        # те же параметры реального времени, что у aiortc.codecs.vpx.Vp8Encoder
+        ctx.options = {
+            "bufsize": str(bitrate),
+            "cpu-used": "-6",
+            "deadline": "realtime",
+            "lag-in-frames": "0",
+            "minrate": str(bitrate),
+            "maxrate": str(bitrate),
+            "noise-sensitivity": "4",
+            "overshoot-pct": "15",
+            "partitions": "0",
+            "static-thresh": "1",
+            "undershoot-pct": "100",
+        }
+        self._ctx = ctx
+
+    def _encode(self, frame: av.VideoFrame, force_keyframe: bool) -> List[av.Packet]:
+        t0 = time.thread_time()
+        try:
+            return self._encode_frame(frame, force_keyframe)
+        finally:
+            self.encode_cpu_s += time.thread_time() - t0
+
+    def _encode_frame(self, frame: av.VideoFrame, force_keyframe: bool) -> List[av.Packet]:
+        pts, time_base = frame.pts, frame.time_base
+        if frame.height > self.max_height:
+            w = int(frame.width * self.max_height / frame.height) // 2 * 2
+            frame = self._reformatter.reformat(frame, width=w, height=self.max_height, format="yuv420p")
+        elif frame.format.name != "yuv420p":
+            frame = self._reformatter.reformat(frame, format="yuv420p")
+        if self._ctx is None or self._ctx.width != frame.width or self._ctx.height != frame.height:
+            self._open(frame.width, frame.height)
+            force_keyframe = True
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+        packets = self._ctx.encode(frame)
+        for p in packets:
+            p.time_base = time_base
+            p.pts = pts
+            self.bytes_encoded += p.size
+        self.frames_encoded += 1
+        return packets
+
+    async def recv(self):
+        loop = asyncio.get_running_loop()
+        while not self._pending:
+            if self.readyState != "live":
+                raise MediaStreamError
+            frame = await self._source.recv()
+            # прореживание до fps уровня — по времени кадра, а не по счётчику
+            t = float(frame.pts * frame.time_base) if frame.pts is not None else time.monotonic()
+            if self._last_pts_s is not None and t - self._last_pts_s < 0.9 / self.fps:
+                continue
+            self._last_pts_s = t
+            # запрос, пришедший вскоре после ключевого, ждёт окна (флаг остаётся)
+            force = self._force_keyframe and time.monotonic() - self._last_key_s >= VIDEO_KEYFRAME_MIN_S
+            if force or self._ctx is None:
+                self._force_keyframe = False
+                self._last_key_s = time.monotonic()
+            t0 = time.perf_counter()
+            self._pending.extend(await loop.run_in_executor(None, self._encode, frame, force))
+            self._encode_hist.record((time.perf_counter() - t0) * 1000.0)
+        return self._pending.popleft()
+
+    def stop(self):
+        super().stop()
+        self._source.stop()
+        if self._fanout is not None:
+            self._fanout.cancel()
+        for sub in list(self._subs):
+            sub._push(None)
+
+class TierSubscription(MediaStreamTrack):
+    """
+    Пакеты общего энкодера для одного пира. Очередь — не больше VIDEO_PEER_QUEUE:
+    пир не успевает (медленный sender, забитый канал) — очередь сбрасывается,
+    до следующего ключевого кадра ему ничего не отдаётся, энкодер получает запрос
+    ключевого. Память на пира ограничена, остальных пиров уровня это не задерживает.
+    """
+    kind = "video"
+
+    def __init__(self, tier: EncodedTierTrack):
+        super().__init__()
+        self._tier: Optional[EncodedTierTrack] = tier
+        self._queue: deque = deque()
+        self._ready = asyncio.Event()
+        self._need_keyframe = True
+        self._ended = False
+        self.dropped = 0
+
+    def _push(self, packet: Optional[av.Packet]):
+        if packet is None:
+            self._ended = True
+            self._ready.set()
+            return
+        if self._need_keyframe:
+            if not packet.is_keyframe:
+                return
+            self._need_keyframe = False
+        if len(self._queue) >= VIDEO_PEER_QUEUE:
+            dropped = len(self._queue) + 1
+            self.dropped += dropped
+            self._tier.packets_dropped += dropped
+            self._queue.clear()
+            self._need_keyframe = True
+            self._tier.request_keyframe()
+            return
+        self._queue.append(packet)
+        self._ready.set()
+
+    async def recv(self):
+        while not self._queue:
+            if self.readyState != "live" or self._ended:
+                raise MediaStreamError
+            self._ready.clear()
+            await self._ready.wait()
+        return self._queue.popleft()
+
+    def request_keyframe(self):
+        if self._tier is not None:
+            self._tier.request_keyframe()
+
+    def stop(self):
+        super().stop()
+        self._queue.clear()
+        self._ready.set()
+        if self._tier is not None:
+            self._tier._unsubscribe(self)
+            self._tier = None
+
+class TierSwitchTrack(MediaStreamTrack):
+    """
+    Трек пира поверх пакетов уровня: уровень можно сменить на лету, sender этого
+    не замечает. Ожидающий recv() старого уровня отменяется, а до первого
+    ключевого кадра нового уровня пакеты не отдаются (иначе декодер ждёт GOP).
+    """
+    kind = "video"
+
+    def __init__(self, inner: MediaStreamTrack, request_keyframe):
+        super().__init__()
+        self._inner = inner
+        self._request_keyframe = request_keyframe
+        self._need_keyframe = True
+        self._switched = asyncio.Event()
+
+    def switch(self, inner: MediaStreamTrack, request_keyframe):
+        self._inner = inner
+        self._request_keyframe = request_keyframe
+        self._need_keyframe = True
+        self._switched.set()
+
+    def request_keyframe(self):
+        # PLI/FIR от браузера: пакеты готовые, ключевой кадр делает общий энкодер
+        self._request_keyframe()
+
+    async def recv(self):
+        while True:
+            if self.readyState != "live":
+                raise MediaStreamError
+            self._switched.clear()
+            get = asyncio.ensure_future(self._inner.recv())
+            sw = asyncio.ensure_future(self._switched.wait())
+            done, _ = await asyncio.wait({get, sw}, return_when=asyncio.FIRST_COMPLETED)
+            if get not in done:
+                get.cancel()
+                continue
+            sw.cancel()
+            packet = get.result()
+            if self._need_keyframe:
+                if not packet.is_keyframe:
+                    self._request_keyframe()
+                    continue
+                self._need_keyframe = False
+            return packet
+
+class VideoSource:
+    """Один открытый VIDEO_SRC: базовый трек, общие энкодеры уровней и счётчик пиров."""
+
+    def __init__(self, key: str, track: MediaStreamTrack, kind: str):
+        self.key = key
+        self.track = track
+        self.kind = kind
+        self.peers = 0
+        self.tiers: Dict[int, EncodedTierTrack] = {}
+        self.tier_peers: Dict[int, int] = {}
+        self.opened_ts = time.time()
+
+    def close(self):
+        for tier in self.tiers.values():
+            tier.stop()
+        self.tiers.clear()
+        self.track.stop()
+
+class SourceRegistry:
+    """
+    Реестр источников по ключу VIDEO_SRC: камера/RTSP открывается один раз и
+    раздаётся всем пирам через MediaRelay; закрывается, когда уходит последний пир.
+    """
+
+    def __init__(self):
+        self.sources: Dict[str, VideoSource] = {}
+        self.relay = MediaRelay()
+
+    def _open(self, src: str) -> VideoSource:
+        # 1) Пытаемся через ffmpeg (лучше для файлов/rtsp): один демультиплексор на пиров и запись
+        if src:
+            try:
+                track = DemuxTrack(src)
+                log.info("using ffmpeg demux track (%s)", track.codec)
+                return VideoSource(src, track, "demux")
+            except Exception as e:
+                log.warning("ffmpeg open of %r failed: %s", src, e)
+
+        # 2) Фолбэк на OpenCV (удобно для локальной камеры/файла)
+        if src:
+            try:
+                cam_or_file = int(src) if src.isdigit() else src
+                ocv = OpenCVCaptureTrack(cam_or_file)
+                # sanity-check: если это камера/файл, убедимся, что открыт
+                if hasattr(ocv, "cap") and not ocv.cap.isOpened():
+                    ocv.stop()
+                    raise RuntimeError(f"cv2 cannot open {src}")
+                print("[webrtc] using OpenCV capture track")
+                return VideoSource(src, ocv, "opencv")
+            except Exception as e:
+                print(f"[webrtc] OpenCV failed: {e}; falling back to synthetic")
+
+        # 3) Финальный фолбэк — синтетика (полосы и надпись)
+        print("[webrtc] using SyntheticVideoTrack")
+        return VideoSource(src, SyntheticVideoTrack(fps=15, width=1280, height=720), "synthetic")
+
+    def _hold(self, src: str) -> VideoSource:
+        source = self.sources.get(src)
+        if source is None or source.track.readyState != "live":
+            source = self.sources[src] = self._open(src)
+        source.peers += 1
+        return source
+
+    def acquire(self, src: str, max_kbps: int) -> Tuple[VideoSource, MediaStreamTrack, Optional[int]]:
+        """Трек для нового пира: пакеты общего энкодера уровня или (без уровней) сырые кадры."""
+        source = self._hold(src)
+
+        tier = _tier_for(max_kbps)
+        if tier is None:
+            return source, self.relay.subscribe(source.track, buffered=False), None
+        return source, self._subscribe_tier(source, tier), tier
+
+    def acquire_recording(self, src: str, tap=None) -> Tuple[VideoSource, Optional[MediaStreamTrack]]:
+        """
+        Источник для записи держится открытым, как пиром. Сжатый поток ffmpeg и tap —
+        пакеты идут в tap из того же демультиплексора, трек None; иначе — сырые кадры
+        через MediaRelay. Освобождать — release_recording.
+        """
+        source = self._hold(src)
+        track = source.track
+        if tap is not None and isinstance(track, DemuxTrack) and track.codec != "rawvideo":
+            track.set_tap(tap)
+            return source, None
+        return source, self.relay.subscribe(track, buffered=False)
+
+    def release_recording(self, source: VideoSource, track: Optional[MediaStreamTrack]):
+        if track is None:
+            source.track.set_tap(None)
+        self.release(source, track, None)
+
+    def _subscribe_tier(self, source: VideoSource, tier: int) -> MediaStreamTrack:
+        enc = source.tiers.get(tier)
+        if enc is None or enc.readyState != "live":
+            # сырые кадры — без буфера (всегда последний); пакеты — своя ограниченная
+            # очередь на пира (TierSubscription), MediaRelay с buffered=True копил бы без предела
+            enc = source.tiers[tier] = EncodedTierTrack(self.relay.subscribe(source.track, buffered=False), tier)
+        source.tier_peers[tier] = source.tier_peers.get(tier, 0) + 1
+        return enc.subscribe()
+
+    def _unsubscribe_tier(self, source: VideoSource, tier: int, track: MediaStreamTrack):
+        track.stop()
+        left = source.tier_peers.get(tier, 1) - 1
+        source.tier_peers[tier] = left
+        if left <= 0:
+            source.tier_peers.pop(tier, None)
+            enc = source.tiers.pop(tier, None)
+            if enc:
+                enc.stop()
+
+    def switch_tier(self, source: VideoSource, track: MediaStreamTrack, tier: int, new_tier: int) -> MediaStreamTrack:
+        """Перевести пира на другой уровень (новый трек отдаётся в sender.replaceTrack)."""
+        new_track = self._subscribe_tier(source, new_tier)
+        self._unsubscribe_tier(source, tier, track)
+        return new_track
+
+    def release(self, source: VideoSource, track: MediaStreamTrack, tier: Optional[int]):
+        if tier is not None:
+            self._unsubscribe_tier(source, tier, track)
+        elif track is not None:
+            track.stop()
+        source.peers -= 1
+        if source.peers <= 0 and self.sources.get(source.key) is source:
+            log.info("last peer left, closing source %r", source.key)
+            del self.sources[source.key]
+            source.close()
+
+    def stats(self) -> List[Dict]:
+        return [{
+            "src": s.key,
+            "kind": s.kind,
+            "peers": s.peers,
+            "tiers": {k: {"peers": s.tier_peers.get(k, 0), "frames_encoded": t.frames_encoded,
+                          "encode_cpu_s": round(t.encode_cpu_s, 3), "keyframes_requested": t.keyframes_requested,
+                          "packets_dropped": t.packets_dropped}
+                      for k, t in s.tiers.items()},
+            "open_s": round(time.time() - s.opened_ts, 1),
+        } for s in self.sources.values()]
+
+SOURCES = SourceRegistry()
+
+class PeerSession:
+    """Один WebRTC-зритель: его источник, текущий уровень и регулятор битрейта."""
+
+    def __init__(self, pc: RTCPeerConnection, source: VideoSource, track: MediaStreamTrack,
+                 tier: Optional[int], max_kbps: int):
+        self.peer_id = uuid.uuid4().hex[:12]
+        self.pc = pc
+        self.source = source
+        self.tier = tier
+        self._tier_track = track   # подписка на общий энкодер (или на сырые кадры)
+        # в режиме уровней sender читает обёртку, уровень под ней можно менять
+        self.track = track if tier is None else TierSwitchTrack(track, source.tiers[tier].request_keyframe)
+        self.sender: Optional[RTCRtpSender] = None
+        self.rate = RateController(ceiling_kbps=max_kbps, floor_kbps=min(250, max_kbps))
+        self.released = False
+        self.tier_switches = 0
+        self.created_mono = time.monotonic()
+        self.state_since = self.created_mono
+        self.last_state = pc.connectionState
+        self.usage: Dict = {}
+        self._prev_bytes: Optional[int] = None
+        self._prev_mono: Optional[float] = None
+
+    def on_state(self):
+        if self.pc.connectionState != self.last_state:
+            self.last_state = self.pc.connectionState
+            self.state_since = time.monotonic()
+
+    async def sample_usage(self):
+        """Счётчики RTP из sender.getStats() + доля CPU общего энкодера уровня."""
+        if self.sender is None or self.pc.connectionState != "connected":
+            return
+        try:
+            report = await self.sender.getStats()
+        except Exception:
+            return
+        now = time.monotonic()
+        out = next((r for r in report.values() if getattr(r, "type", "") == "outbound-rtp"), None)
+        if out is None:
+            return
+        kbps = None
+        if self._prev_bytes is not None and now > self._prev_mono:
+            kbps = (out.bytesSent - self._prev_bytes) * 8 / 1000.0 / (now - self._prev_mono)
+        self._prev_bytes, self._prev_mono = out.bytesSent, now
+        usage = {"bytes_sent": out.bytesSent, "packets_sent": out.packetsSent,
+                 "send_kbps": round(kbps, 1) if kbps is not None else None}
+        enc = self.source.tiers.get(self.tier) if self.tier is not None else None
+        if enc is not None:
+            # энкодер общий — делим его CPU поровну между зрителями уровня
+            usage["encoder_cpu_share_s"] = round(enc.encode_cpu_s / max(1, self.source.tier_peers.get(self.tier, 1)), 3)
+        self.usage = usage
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            if self.track is not self._tier_track:
+                self.track.stop()
+            SOURCES.release(self.source, self._tier_track, self.tier)
+
+    def apply_kbps(self, kbps: int) -> bool:
+        """Применить битрейт к живому sender'у без пересогласования SDP."""
+        if self.sender is None or self.released:
+            return False
+        if self.tier is not None:
+            new_tier = _tier_for(kbps)
+            if new_tier != self.tier:
+                # другой общий энкодер (битрейт/разрешение/fps) — просто другой источник пакетов
+                self._tier_track = SOURCES.switch_tier(self.source, self._tier_track, self.tier, new_tier)
+                self.track.switch(self._tier_track, self.source.tiers[new_tier].request_keyframe)
+                self.tier = new_tier
+                self.tier_switches += 1
+            return True
+        return _set_sender_bitrate(self.sender, kbps)
+
+    def stats(self) -> Dict:
+        return {
+            "peer_id": self.peer_id,
+            "state": self.pc.connectionState,
+            "tier_kbps": self.tier,
+            "tier_switches": self.tier_switches,
+            "age_s": round(time.monotonic() - self.created_mono, 1),
+            "usage": self.usage,
+            "rate": self.rate.stats(),
+        }
+
+class PeerLimitError(RuntimeError):
+    pass
+
+class PeerRegistry:
+    """
+    Все живые RTCPeerConnection. Фоновый сборщик закрывает пиров в failed/closed,
+    зависших в disconnected или так и не подключившихся, и отпускает их источники;
+    заодно раз в интервал снимает счётчики трафика/CPU для метрик.
+    """
+
+    def __init__(self):
+        self.peers: Dict[str, PeerSession] = {}
+        self.max_peers = int(os.getenv("VIDEO_MAX_PEERS", "8"))
+        self.disconnect_grace_s = float(os.getenv("VIDEO_PEER_DISCONNECT_S", "5"))
+        self.connect_timeout_s = float(os.getenv("VIDEO_PEER_CONNECT_S", "30"))
+        self.interval_s = 2.0
+        self._task: Optional[asyncio.Task] = None
+        self.closed_total = 0
+        self.rejected_total = 0
+        self._cpu_prev = (time.monotonic(), time.process_time())
+        self.process_cpu_pct = 0.0
+
+    def get(self, peer_id: str) -> Optional[PeerSession]:
+        return self.peers.get(peer_id)
+
+    def values(self):
+        return self.peers.values()
+
+    def check_capacity(self):
+        if len(self.peers) >= self.max_peers:
+            self.rejected_total += 1
+            raise PeerLimitError(f"too many video peers ({len(self.peers)}/{self.max_peers})")
+
+    def add(self, peer: PeerSession):
+        self.peers[peer.peer_id] = peer
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._reaper())
+
+    async def close(self, peer: PeerSession, reason: str = ""):
+        if self.peers.pop(peer.peer_id, None) is None:
+            return
+        self.closed_total += 1
+        if reason:
+            # штатное закрытие — info; таймаут или отказ ICE/DTLS — warning
+            level = logging.INFO if reason in ("closed", "shutdown") else logging.WARNING
+            log.log(level, "closing peer %s: %s", peer.peer_id, reason)
+        peer.release()
+        try:
+            await peer.pc.close()
+        except Exception:
+            pass
+
+    async def close_all(self):
+        for peer in list(self.peers.values()):
+            await self.close(peer, "shutdown")
+
+    def _verdict(self, peer: PeerSession, now: float) -> Optional[str]:
+        state = peer.pc.connectionState
+        age = now - peer.state_since
+        if state in ("failed", "closed"):
+            return state
+        if state == "disconnected" and age > self.disconnect_grace_s:
+            return f"disconnected for {age:.0f}s"
+        if state in ("new", "connecting") and now - peer.created_mono > self.connect_timeout_s:
+            return f"not connected after {self.connect_timeout_s:.0f}s"
+        return None
+
+    async def _reaper(self):
+        while self.peers:
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            for peer in list(self.peers.values()):
+                reason = self._verdict(peer, now)
+                if reason:
+                    await self.close(peer, reason)
+                else:
+                    await peer.sample_usage()
+            t, c = time.monotonic(), time.process_time()
+            pt, pc_ = self._cpu_prev
+            self.process_cpu_pct = round(100.0 * (c - pc_) / max(1e-6, t - pt), 1)
+            self._cpu_prev = (t, c)
+
+    def stats(self) -> Dict:
+        return {
+            "active": len(self.peers),
+            "max_peers": self.max_peers,
+            "closed_total": self.closed_total,
+            "rejected_total": self.rejected_total,
+            "process_cpu_pct": self.process_cpu_pct,
+            "sender_bitrate_control": SENDER_BITRATE_OK,
+            "peers": [p.stats() for p in self.peers.values()],
+        }
+
+PEERS = PeerRegistry()
+
+# Режим без уровней (VIDEO_TIERS_KBPS=): у aiortc нет RTCRtpSender.setParameters, битрейт
+# ставится энкодеру sender'а через приватный атрибут. Версия aiortc закреплена в
+# requirements.txt; если атрибута нет — один раз предупреждаем, битрейт остаётся за REMB.
+# С уровнями энкодер sender'а не трогаем вовсе: переключается TierSwitchTrack.
+_SENDER_ENCODER_ATTR = "_RTCRtpSender__encoder"
+SENDER_BITRATE_OK = _SENDER_ENCODER_ATTR in RTCRtpSender.__init__.__code__.co_names
+
+
+def _check_sender_bitrate():
+    if not SENDER_BITRATE_OK:
+        _warn_once("bitrate", f"aiortc {aiortc.__version__}: RTCRtpSender has no {_SENDER_ENCODER_ATTR}, "
+                              "per-peer bitrate control is disabled (use encoder tiers)")
+    return SENDER_BITRATE_OK
+
+if not VIDEO_TIERS_KBPS:
+    _check_sender_bitrate()  # при загрузке видеостека, а не на первом пире
+
+def _set_sender_bitrate(sender: RTCRtpSender, kbps: int) -> bool:
+    # энкодер появляется после первого кадра (его же двигает REMB от браузера)
+    if not _check_sender_bitrate():
+        return False
+    bps = int(max(250_000, kbps * 1000))
+    enc = getattr(sender, _SENDER_ENCODER_ATTR, None)
+    if enc is not None and hasattr(enc, "target_bitrate"):
+        enc.target_bitrate = bps
+        return True
+    return False
+
+def apply_qos(peer_id: str, report: Dict) -> Optional[Dict]:
+    """Отчёт браузера → регулятор пира → новый битрейт сразу на живом sender'е."""
+    peer = PEERS.get(peer_id)
+    if peer is None:
+        return None
+    target = peer.rate.update(report)
+    applied = peer.apply_kbps(target)
+    return {"target_kbps": target, "applied": applied, "tier_kbps": peer.tier, "state": peer.rate.state}
+
+def _forward_keyframe_requests(sender: RTCRtpSender, request_keyframe):
+    # На PLI/FIR aiortc зовёт sender._send_keyframe(), а тот лишь ставит флаг своему
+    # энкодеру — для готовых пакетов его никто не читает. Дублируем запрос общему энкодеру.
+    orig = getattr(sender, "_send_keyframe", None)
+    if orig is None:
+        _warn_once("pli", "aiortc RTCRtpSender has no _send_keyframe: PLI/FIR will not reach shared encoders")
+        return
+
+    def _send_keyframe():
+        orig()
+        request_keyframe()
+    sender._send_keyframe = _send_keyframe
+
+def _prefer_vp8(pc: RTCPeerConnection, sender: RTCRtpSender):
+    # общий энкодер выдаёт VP8 — оставляем в SDP только VP8 (+rtx)
+    caps = RTCRtpSender.getCapabilities("video")
+    prefs = [c for c in caps.codecs if c.mimeType in ("video/VP8", "video/rtx")]
+    for t in pc.getTransceivers():
+        if t.sender is sender:
+            t.setCodecPreferences(prefs)
+
 async def create_pc_and_answer(sdp_offer: str, type_offer: str, max_kbps: int = 1500):
     # выставим ограничение битрейта, если используешь это где-то ещё
-    from .video import set_max_kbps
     set_max_kbps(int(max_kbps))
 
+    PEERS.check_capacity()
     pc = RTCPeerConnection()
 
-    # ---------- выбор источника ----------
+    # ---------- выбор источника (общий на всех пиров) ----------
     src = os.getenv("VIDEO_SRC", "").strip()
     print(f"[webrtc] VIDEO_SRC={src!r}")
+    source, track, tier = SOURCES.acquire(src, int(max_kbps))
+    peer = PeerSession(pc, source, track, tier, int(max_kbps))
+    PEERS.add(peer)
 
-    track = None
-
-    # 1) Пытаемся через ffmpeg/MediaPlayer (лучше для файлов/rtsp)
-    if src:
-        try:
-            # Для RTSP можно options={"rtsp_transport": "tcp"}
-            player = MediaPlayer(src)
-            if player and player.video:
-                track = player.video
-                print("[webrtc] using MediaPlayer video track")
-        except Exception as e:
-            print(f"[webrtc] MediaPlayer failed: {e}")
-
-    # 2) Фолбэк на OpenCV (удобно для локальной камеры/файла)
-    if track is None and src:
-        try:
-            cam_or_file = int(src) if src.isdigit() else src
-            ocv = OpenCVCaptureTrack(cam_or_file)
-            # sanity-check: если это камера/файл, убедимся, что открыт
-            if hasattr(ocv, "cap") and not ocv.cap.isOpened():
-                raise RuntimeError(f"cv2 cannot open {src}")
-            track = ocv
-            print("[webrtc] using OpenCV capture track")
-        except Exception as e:
-            print(f"[webrtc] OpenCV failed: {e}; falling back to synthetic")
-
-    # 3) Финальный фолбэк — синтетика (полосы и надпись)
-    if track is None:
-        track = SyntheticVideoTrack(fps=15, width=1280, height=720)
-        print("[webrtc] using SyntheticVideoTrack")
+    @pc.on("connectionstatechange")
+    async def _on_state():
+        peer.on_state()
+        if pc.connectionState in ("failed", "closed"):
+            await PEERS.close(peer, pc.connectionState)
     # -------------------------------------
 
-    # Подключаем трек (через relay — как у тебя было)
-    sender = pc.addTrack(_relay.subscribe(track))
+    sender = peer.sender = pc.addTrack(peer.track)
 
-    # Ограничение битрейта (kbps -> bps), с нижним порогом
-    try:
-        params = sender.getParameters()
-        if not params.encodings:
-            params.encodings = [{}]
-        params.encodings[0]["maxBitrate"] = int(max(250_000, max_kbps * 1000))
-        await sender.setParameters(params)
-    except Exception as e:
-        print(f"[webrtc] setParameters failed: {e}")
+    if tier is not None:
+        # битрейт задаёт общий энкодер уровня
+        _prefer_vp8(pc, sender)
+        _forward_keyframe_requests(sender, peer.track.request_keyframe)
+        log.info("shared encoder tier %d kbps (requested %d)", tier, max_kbps)
 
     # SDP: принимаем offer, создаём answer
-    offer = RTCSessionDescription(sdp=sdp_offer, type=type_offer)
-    await pc.setRemoteDescription(offer)
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
+    try:
+        offer = RTCSessionDescription(sdp=sdp_offer, type=type_offer)
+        await pc.setRemoteDescription(offer)
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+    except Exception:
+        # битый offer — источник не должен остаться занятым
+        await PEERS.close(peer)
+        raise
 
-    return pc.localDescription.sdp, pc.localDescription.type
+    return pc.localDescription.sdp, pc.localDescription.type, peer.peer_id
@@ -0,0 +1,731 @@
+"""
+Нагрузочный бенчмарк бэкенда на базе ugv_sim.py.
+
+Поднимает бэкенд (uvicorn, отдельный процесс) или бьёт в уже запущенный,
+запускает N симулированных аппаратов с заданной частотой телеметрии, M UI-подписчиков
+на /ws/telemetry и поток drive-команд, и пишет JSON-отчёт:
+  - задержка сим → UI (по ts кадра; сим и подписчики в одном процессе — часы общие),
+  - доля недоставленных кадров,
+  - RTT drive-команд,
+  - CPU/RSS процесса бэкенда (только для --spawn, Linux /proc).
+
+Сетевые профили (net-profiles/profiles/*.conf) проигрываются в процессе через
+netem_proxy.WsProxy — без root и tc, можно в CI.
+
+  python bench.py --vehicles 1,20,100 --rate-hz 10 --subscribers 4 --cmd-hz 20 \\
+      --duration 15 --profile ../net-profiles/profiles/urban-lossy-20.conf --out report.json
+
+--startup N — вместо нагрузки: время импорта, время до /health и RSS бэкенда
+с видео lazy/off/eager, по N холодных стартов.
+
+--workers-check — два воркера на общей шине (STATE_BACKEND=unix): сим у A,
+команды сначала в A, потом в B. Проверяет, что стопов нет, пока команды идут
+(watchdog один — у A), что уставки B прошли планировщик A, что после тишины
+ровно один стоп и что safe_mode на обоих воркерах совпадает.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+
+from netem_proxy import Impairment, WsProxy, load_profiles
+from ugv_sim import TAG_DELTA, TAG_DELTA_KEY, TELEMETRY_FIELDS, DeltaDecoder, fleet_ids, msgpack, run_sim, with_param
+
+REPORT_SCHEMA = 1
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+# UI получает bin с именем аппарата: u8 0x02 | u8 len | id | тело (см. backend/app/codec.py)
+TAG_TELEMETRY_V = 0x02
+TELEMETRY_BODY = struct.Struct("<dI6f2d3f")
+# /ws/control: команда u8 0x10 | u32 seq | f64 ts | f32 vx, vy, wz; ack u8 0x11 | u32 seq | u8 ok | f32 rtt_ms
+TAG_CONTROL_DRIVE = 0x10
+TAG_CONTROL_ACK = 0x11
+CONTROL_DRIVE = struct.Struct("<BIdfff")
+CONTROL_ACK = struct.Struct("<BIBf")
+_TS = TELEMETRY_FIELDS.index("ts")
+
+
+def percentiles(xs: List[float]) -> Dict:
+    if not xs:
+        return {"count": 0}
+    xs = sorted(xs)
+    n = len(xs)
+
+    def q(p):
+        return round(xs[min(n - 1, int(p * n))], 3)
+    return {
+        "count": n,
+        "mean": round(sum(xs) / n, 3),
+        "p50": q(0.50), "p95": q(0.95), "p99": q(0.99),
+        "max": round(xs[-1], 3),
+    }
+
+
+def decode_ui(msg) -> Optional[tuple]:
+    """(vehicle_id, ts) из кадра /ws/telemetry в любом формате; None — не телеметрия."""
+    if isinstance(msg, (bytes, bytearray)):
+        if msg and msg[0] == TAG_TELEMETRY_V:
+            n = msg[1]
+            vals = TELEMETRY_BODY.unpack_from(msg, 2 + n)
+            return bytes(msg[2:2 + n]).decode(), vals[_TS]
+        obj = msgpack.unpackb(msg, raw=False) if msgpack is not None else None
+    else:
+        obj = json.loads(msg)
+    if not isinstance(obj, dict) or obj.get("type") != "telemetry":
+        return None
+    return obj.get("vehicle_id", "default"), obj["data"]["ts"]
+
+
+# --- процесс бэкенда ---------------------------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_backend(port: int, env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env={**os.environ, **(env or {})},
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            return proc
+        except Exception:
+            if proc.poll() is not None:
+                raise RuntimeError("backend exited during startup")
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("backend did not become healthy in 30 s")
+
+
+class ProcSampler:
+    """CPU (доля одного ядра) и RSS процесса по /proc — без psutil."""
+
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self._t0 = self._cpu0 = None
+        self.rss_max_kb = 0
+
+    def _cpu_s(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                parts = f.read().rsplit(")", 1)[1].split()
+            return (int(parts[11]) + int(parts[12])) / self.tick  # utime + stime
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _rss_kb(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def start(self):
+        if self.pid:
+            self._t0, self._cpu0 = time.monotonic(), self._cpu_s()
+
+    def sample(self):
+        rss = self._rss_kb() if self.pid else None
+        if rss:
+            self.rss_max_kb = max(self.rss_max_kb, rss)
+
+    def result_rss_mb(self) -> Optional[float]:
+        rss = self._rss_kb() if self.pid else None
+        return round(rss / 1024, 1) if rss else None
+
+    def result(self) -> Dict:
+        if not self.pid or self._cpu0 is None:
+            return {}
+        cpu = self._cpu_s()
+        rss = self._rss_kb()
+        return {
+            "cpu_pct": round(100.0 * (cpu - self._cpu0) / (time.monotonic() - self._t0), 1) if cpu is not None else None,
+            "rss_mb": round(rss / 1024, 1) if rss else None,
+            "rss_peak_mb": round(self.rss_max_kb / 1024, 1) if self.rss_max_kb else None,
+        }
+
+
+# --- участники нагрузки ------------------------------------------------------
+
+class Run:
+    def __init__(self, base_url: str, vehicles: int, rate_hz: float, subscribers: int, watch: int,
+                 cmd_hz: float, fmt: str, ui_fmt: str, starve_s: float = 0.0, control: str = "http"):
+        self.base_url = base_url  # ws://host:port бэкенда
+        self.ids = fleet_ids(vehicles, "bench") if vehicles > 1 else ["bench0"]
+        self.rate_hz = rate_hz
+        self.subscribers = subscribers
+        self.watch = watch
+        self.cmd_hz = cmd_hz
+        self.fmt = fmt
+        self.ui_fmt = ui_fmt
+        self.starve_s = starve_s
+        self.control = control  # http — POST на команду, ws — постоянный /ws/control
+
+        self.measuring = False
+        self.window = False  # внутри окна замера (без drain) — для байт/с
+        self.window_s = 0.0
+        self.sent: Dict[str, Dict] = {vid: {} for vid in self.ids}
+        self.sent_at_start: Dict[str, int] = {}
+        self.sent_at_stop: Dict[str, int] = {}
+        self.bytes_at_start: Dict[str, int] = {}
+        self.bytes_at_stop: Dict[str, int] = {}
+        self.ui_bytes = 0
+        self.ui_resyncs = 0
+        self.received: List[Dict[str, int]] = []
+        self.latency_ms: List[float] = []
+        self.cmd_rtt_ms: List[float] = []
+        self.cmd_wall_ms: List[float] = []
+        self.cmd_sent = 0
+        self.cmd_accepted = 0
+
+    def watched(self, i: int) -> List[str]:
+        if self.watch <= 0 or self.watch >= len(self.ids):
+            return self.ids
+        # подписчики разбирают флот по кругу — нагрузка на топики равномерная
+        return [self.ids[(i * self.watch + k) % len(self.ids)] for k in range(self.watch)]
+
+    async def subscriber(self, i: int, url: str):
+        topics = self.watched(i)
+        got: Dict[str, int] = {vid: 0 for vid in topics}
+        self.received.append(got)
+        q = "*" if topics is self.ids else ",".join(topics)
+        async with websockets.connect(with_param(with_param(url, "vehicles", q), "fmt", self.ui_fmt),
+                                      max_size=None) as ws:
+            # hello: для fmt=delta в нём шаги квантования
+            quant = json.loads(await ws.recv()).get("quant")
+            decoders: Dict[str, DeltaDecoder] = {}
+            async for msg in ws:
+                if self.window:
+                    self.ui_bytes += len(msg)
+                if isinstance(msg, bytes) and msg and msg[0] in (TAG_DELTA_KEY, TAG_DELTA) and quant:
+                    vid = bytes(msg[2:2 + msg[1]]).decode()
+                    dec = decoders.setdefault(vid, DeltaDecoder(quant))
+                    out = dec.decode(msg)
+                    if out is None:
+                        # ключевой кадр выпал из очереди — как UI, просим resync;
+                        # key_id=-1 не совпадёт ни с одной дельтой: повторно не просим до ключевого
+                        if dec.key_id != -1:
+                            dec.key_id = -1
+                            self.ui_resyncs += 1
+                            await ws.send(json.dumps({"type": "resync", "vehicles": [vid]}))
+                        continue
+                    r = (vid, out[1]["ts"])
+                else:
+                    r = decode_ui(msg)
+                if r is None or not self.measuring:
+                    continue
+                vid, ts = r
+                if vid in got:
+                    got[vid] += 1
+                    self.latency_ms.append((time.time() - ts) * 1000.0)
+
+    async def commander(self, http_base: str):
+        if self.cmd_hz <= 0:
+            return
+        period = 1.0 / self.cmd_hz
+        # в starve-режиме едем (vx≠0), чтобы было что останавливать
+        vx = 0.5 if self.starve_s > 0 else 0.0
+        body = json.dumps({"ts": 0.0, "vx": vx, "vy": 0.0, "wz": 0.0}).encode()
+
+        def post(vid: str):
+            req = urllib.request.Request(
+                f"{http_base}/api/v1/cmd/drive?vehicle={vid}", data=body,
+                headers={"Content-Type": "application/json"}, method="POST",
+            )
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(req, timeout=5) as r:
+                out = json.loads(r.read())
+            return out, (time.perf_counter() - t0) * 1000.0
+
+        async def one(vid: str):
+            try:
+                out, wall = await asyncio.to_thread(post, vid)
+            except Exception:
+                out, wall = {"accepted": False}, None
+            if self.measuring:
+                self.cmd_sent += 1
+                if out.get("accepted"):
+                    self.cmd_accepted += 1
+                    self.cmd_rtt_ms.append(out["rtt_ms"])
+                    self.cmd_wall_ms.append(wall)
+
+        if self.control == "ws":
+            await self.ws_commander(vx, period)
+            return
+
+        if self.starve_s > 0:
+            # S секунд команды всем аппаратам на cmd_hz, затем S секунд тишины —
+            # каждая пауза должна закончиться стопом (watchdog бэкенда или failsafe сима)
+            while True:
+                t_end = time.monotonic() + self.starve_s
+                nxt = time.monotonic()
+                while time.monotonic() < t_end:
+                    await asyncio.gather(*(one(vid) for vid in self.ids))
+                    nxt += period
+                    await asyncio.sleep(max(0.0, nxt - time.monotonic()))
+                await asyncio.sleep(self.starve_s)
+
+        nxt = time.monotonic()
+        for vid in itertools.cycle(self.ids):
+            await one(vid)
+            nxt += period
+            await asyncio.sleep(max(0.0, nxt - time.monotonic()))
+
+    async def ws_commander(self, vx: float, period: float):
+        """Команды по /ws/control: сокет на аппарат, бинарные команды, ack по seq."""
+        t_start = time.monotonic()
+
+        async def one(vid: str):
+            url = with_param(with_param(self.base_url + "/ws/control", "vehicle", vid), "fmt", "bin")
+            sent_at: Dict[int, float] = {}
+            async with websockets.connect(url) as ws:
+                await ws.recv()  # hello
+
+                async def reader():
+                    async for msg in ws:
+                        if not isinstance(msg, bytes) or msg[0] != TAG_CONTROL_ACK:
+                            continue
+                        _, seq, accepted, rtt_ms = CONTROL_ACK.unpack(msg)
+                        t0 = sent_at.pop(seq, None)
+                        if self.measuring and t0 is not None:
+                            self.cmd_sent += 1
+                            if accepted:
+                                self.cmd_accepted += 1
+                                self.cmd_rtt_ms.append(rtt_ms)
+                                self.cmd_wall_ms.append((time.perf_counter() - t0) * 1000.0)
+
+                r = asyncio.create_task(reader())
+                try:
+                    seq = 0
+                    nxt = time.monotonic()
+                    while True:
+                        if self.starve_s > 0 and ((time.monotonic() - t_start) // self.starve_s) % 2:
+                            await asyncio.sleep(period)  # фаза тишины starve-режима
+                            nxt = time.monotonic()
+                            continue
+                        seq += 1
+                        sent_at[seq] = time.perf_counter()
+                        await ws.send(CONTROL_DRIVE.pack(TAG_CONTROL_DRIVE, seq, time.time(), vx, 0.0, 0.0))
+                        nxt += period
+                        await asyncio.sleep(max(0.0, nxt - time.monotonic()))
+                finally:
+                    r.cancel()
+
+        # POST-режим делит cmd_hz на весь флот, здесь — та же суммарная частота
+        period *= len(self.ids) if self.starve_s <= 0 else 1
+        await asyncio.gather(*(one(vid) for vid in self.ids))
+
+    def mark(self, into: Dict[str, int], key: str = "sent"):
+        for vid, c in self.sent.items():
+            into[vid] = c.get(key, 0)
+
+    def safety_result(self, http_base: str) -> Dict:
+        stops: Dict[str, List[float]] = {}
+        for c in self.sent.values():
+            for source, ms in c.get("stops", ()):
+                stops.setdefault(source, []).append(ms)
+        try:
+            backend = json.loads(urllib.request.urlopen(f"{http_base}/api/v1/safety?events=0", timeout=5).read())
+        except Exception:
+            backend = None
+        return {
+            # на борту: от последней ненулевой команды до стопа, по источнику стопа
+            "sim_time_to_stop_ms": {src: percentiles(xs) for src, xs in sorted(stops.items())},
+            "backend": backend,
+        }
+
+    def telemetry_result(self) -> Dict:
+        sent = {vid: self.sent_at_stop.get(vid, 0) - self.sent_at_start.get(vid, 0) for vid in self.ids}
+        expected = sum(sent[vid] for got in self.received for vid in got)
+        received = sum(sum(got.values()) for got in self.received)
+        return {
+            "frames_sent": sum(sent.values()),
+            "frames_expected": expected,
+            "frames_received": received,
+            # > 0: недоставлено (или ещё в пути на момент остановки); < 0 не бывает
+            "drop_ratio": round(max(0.0, 1.0 - received / expected), 5) if expected else None,
+            "latency_ms": percentiles(self.latency_ms),
+            "bytes": self.bytes_result(),
+        }
+
+    def bytes_result(self) -> Dict:
+        sim = sum(self.bytes_at_stop.get(vid, 0) - self.bytes_at_start.get(vid, 0) for vid in self.ids)
+        dur = self.window_s or 1.0
+        return {
+            # сим → бэкенд, все аппараты; бэкенд → UI, в среднем на подписчика
+            "sim_bps": round(sim / dur, 1),
+            "ui_bps_per_subscriber": round(self.ui_bytes / dur / max(1, self.subscribers), 1),
+            "ui_resyncs": self.ui_resyncs,
+        }
+
+    def command_result(self) -> Dict:
+        return {
+            "sent": self.cmd_sent,
+            "accepted": self.cmd_accepted,
+            "ack_rtt_ms": percentiles(self.cmd_rtt_ms),
+            "http_ms": percentiles(self.cmd_wall_ms),
+        }
+
+
+def proxy_stats(proxy: WsProxy) -> Dict:
+    s = proxy.stats()
+    s.pop("per_connection", None)  # в отчёте — только агрегаты по направлениям
+    return s
+
+
+async def run_once(args, vehicles: int, subscribers: int, profile: Optional[Tuple[Impairment, Impairment]]) -> Dict:
+    proc = None
+    if args.url:
+        http_base = args.url.rstrip("/")
+    else:
+        port = free_port()
+        proc = spawn_backend(port)
+        http_base = f"http://127.0.0.1:{port}"
+    ws_base = "ws" + http_base[4:]
+    sampler = ProcSampler(proc.pid if proc else None)
+
+    proxies: List[WsProxy] = []
+    sim_base = ui_base = ws_base
+    if profile is not None:
+        # по прокси на сторону: сим ↔ /ws/sim и UI ↔ /ws/telemetry
+        # up — от клиента (сим, UI) к бэкенду, down — обратно; UP_/DOWN_ ключи профиля
+        up, down = profile
+        sim_proxy = await WsProxy(ws_base, up, down, seed=args.seed).start()
+        ui_proxy = await WsProxy(ws_base, up, down, seed=args.seed + 1).start()
+        proxies = [sim_proxy, ui_proxy]
+        sim_base, ui_base = sim_proxy.url, ui_proxy.url
+
+    run = Run(ws_base, vehicles, args.rate_hz, subscribers, args.watch, args.cmd_hz, args.fmt, args.ui_fmt,
+              args.starve, args.control)
+    tasks = []
+    try:
+        for i in range(subscribers):
+            tasks.append(asyncio.create_task(run.subscriber(i, ui_base + "/ws/telemetry")))
+        for i, vid in enumerate(run.ids):
+            tasks.append(asyncio.create_task(run_sim(
+                vid, 32.0853, 34.7818 + i * 1e-4, verbose=False,
+                backend_url=sim_base + "/ws/sim", fmt=args.fmt, rate_hz=args.rate_hz,
+                counters=run.sent[vid],
+            )))
+        tasks.append(asyncio.create_task(run.commander(http_base)))
+
+        await asyncio.sleep(args.warmup)
+        run.mark(run.sent_at_start)
+        run.mark(run.bytes_at_start, "bytes")
+        sampler.start()
+        run.measuring = run.window = True
+        t0 = time.monotonic()
+        t_end = t0 + args.duration
+        while time.monotonic() < t_end:
+            sampler.sample()
+            await asyncio.sleep(min(1.0, max(0.0, t_end - time.monotonic())))
+        run.window = False
+        run.window_s = time.monotonic() - t0
+        run.mark(run.sent_at_stop)
+        run.mark(run.bytes_at_stop, "bytes")
+        backend = sampler.result()
+        # кадры, отправленные до конца окна, ещё могут быть в пути — дождёмся
+        await asyncio.sleep(args.drain)
+        run.measuring = False
+        safety = run.safety_result(http_base)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for p in proxies:
+            await p.close()
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    return {
+        "params": {
+            "vehicles": vehicles, "rate_hz": args.rate_hz, "subscribers": subscribers,
+            "watch": args.watch or "*", "cmd_hz": args.cmd_hz, "starve_s": args.starve,
+            "sim_fmt": args.fmt, "ui_fmt": args.ui_fmt, "control": args.control,
+            "duration_s": args.duration, "warmup_s": args.warmup,
+        },
+        "telemetry": run.telemetry_result(),
+        "commands": run.command_result(),
+        "safety": safety,
+        "backend": backend,
+        "proxy": {"sim": proxy_stats(proxies[0]), "ui": proxy_stats(proxies[1])} if proxies else None,
+    }
+
+
+# --- старт бэкенда: время импорта, время до /health, RSS ----------------------
+
+# Импорт app.main в чистом процессе; eager — плюс app.video (так стартовал бэкенд,
+# пока видеостек грузился при импорте)
+IMPORT_PROBE = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+import app.main
+t1 = time.perf_counter()
+if sys.argv[1] == "eager":
+    import app.video
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_ms": round((t2 - t0) * 1000, 1),
+    "import_main_ms": round((t1 - t0) * 1000, 1),
+    "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "video_modules": sorted(m for m in ("cv2", "av", "aiortc") if m in sys.modules),
+}))
+"""
+
+STARTUP_MODES = {
+    "lazy": {},                        # по умолчанию: видео на первом offer
+    "off": {"VIDEO_ENABLED": "0"},     # только контур управления
+    "eager": {"VIDEO_PRELOAD": "1"},   # видео сразу, в фоне после старта
+}
+
+
+def _median(xs: List[float]) -> Optional[float]:
+    xs = sorted(x for x in xs if x is not None)
+    return round(xs[len(xs) // 2], 1) if xs else None
+
+
+def startup_once(mode: str) -> Dict:
+    env = {**os.environ, **STARTUP_MODES[mode]}
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE, mode], cwd=BACKEND_DIR, env=env,
+                         capture_output=True, text=True, check=True)
+    res = json.loads(out.stdout.strip().splitlines()[-1])
+
+    port = free_port()
+    t0 = time.monotonic()
+    proc = spawn_backend(port, STARTUP_MODES[mode])
+    try:
+        res["ready_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        if mode == "eager":
+            # контур управления готов; ждём, пока догрузится видео
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                video = json.load(urllib.request.urlopen(f"http://127.0.0.1:{port}/api/v1/metrics"))["video"]
+                if video["loaded"] or video["error"]:
+                    break
+                time.sleep(0.05)
+            res["video_ready_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        res["ready_rss_mb"] = ProcSampler(proc.pid).result_rss_mb()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return res
+
+
+def startup_bench(runs: int) -> Dict:
+    """Каждый режим runs раз с холодным процессом; в отчёте — медианы."""
+    modes = {}
+    for mode in STARTUP_MODES:
+        samples = [startup_once(mode) for _ in range(runs)]
+        keys = [k for k, v in samples[0].items() if isinstance(v, (int, float))]
+        modes[mode] = {k: _median([s.get(k) for s in samples]) for k in keys}
+        modes[mode]["video_modules"] = samples[0]["video_modules"]
+        print(f"[bench] startup {mode}: import={modes[mode]['import_ms']} ms ready={modes[mode]['ready_ms']} ms"
+              f" rss={modes[mode]['ready_rss_mb']} MB", flush=True)
+    return {"runs": runs, "modes": modes}
+
+
+# --- два воркера на одной шине ---------------------------------------------------
+
+def _get(base: str, path: str) -> Dict:
+    return json.loads(urllib.request.urlopen(base + path, timeout=5).read())
+
+
+def _vehicle(base: str, vid: str) -> Optional[Dict]:
+    return next((v for v in _get(base, "/api/v1/metrics")["vehicles"] if v["vehicle_id"] == vid), None)
+
+
+async def workers_check(cmd_hz: float) -> Dict:
+    vid = "wk0"
+    tmp = tempfile.mkdtemp(prefix="rocu-bench-")
+    env = {"STATE_BACKEND": "unix", "STATE_BUS_PATH": os.path.join(tmp, "bus.sock"), "VIDEO_ENABLED": "0"}
+    procs, bases = [], []
+    for _ in range(2):
+        port = free_port()
+        procs.append(spawn_backend(port, env))
+        bases.append(f"http://127.0.0.1:{port}")
+    a, b = bases
+    counters: Dict = {}
+    body = json.dumps({"ts": 0.0, "vx": 0.5, "vy": 0.0, "wz": 0.0}).encode()
+
+    def post(base: str) -> bool:
+        req = urllib.request.Request(f"{base}/api/v1/cmd/drive?vehicle={vid}", data=body,
+                                     headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(req, timeout=5) as r:
+            return bool(json.loads(r.read())["accepted"])
+
+    async def drive(base: str, seconds: float) -> Tuple[int, int]:
+        sent = accepted = 0
+        t_end = time.monotonic() + seconds
+        while time.monotonic() < t_end:
+            sent += 1
+            accepted += await asyncio.to_thread(post, base)
+            await asyncio.sleep(1.0 / cmd_hz)
+        return sent, accepted
+
+    async def safe_modes() -> List[bool]:
+        return [(await asyncio.to_thread(_vehicle, base, vid))["safe_mode"] for base in bases]
+
+    sim = asyncio.create_task(run_sim(vid, verbose=False, backend_url="ws" + a[4:] + "/ws/sim",
+                                      counters=counters))
+    try:
+        # B узнаёт владельца через шину
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            vb = await asyncio.to_thread(_vehicle, b, vid)
+            if vb is not None and vb["remote_owner"]:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError("worker B never saw the sim owner on the bus")
+        sent_a, acc_a = await drive(a, 1.0)
+        # дедлайн watchdog'а A (heartbeat 0.8 с) проходит, пока команды идут в B
+        sent_b, acc_b = await drive(b, 2.0)
+        driving_modes = await safe_modes()
+        stops_driving = len(counters.get("stops", []))
+        await asyncio.sleep(2.0)
+        idle_modes = await safe_modes()
+        stops = counters.get("stops", [])
+        va = await asyncio.to_thread(_vehicle, a, vid)
+        vb = await asyncio.to_thread(_vehicle, b, vid)
+        safety = [await asyncio.to_thread(_get, base, "/api/v1/safety?events=0") for base in bases]
+    finally:
+        sim.cancel()
+        await asyncio.gather(sim, return_exceptions=True)
+        for proc in procs:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    cmds = va["commands"]
+    checks = {
+        "no_stop_while_driving": stops_driving == 0,
+        "relayed_via_owner_scheduler": vb.get("relayed", 0) == sent_b and cmds["submitted"]["manual"] == sent_a + sent_b,
+        "acks_from_b": acc_b == sent_b,
+        "one_stop_after_silence": [s for s, _ in stops] == ["backend"],
+        "watchdog_only_on_owner": safety[0]["triggers"] == 1 and safety[1]["triggers"] == 0,
+        "safe_mode_agrees": driving_modes == [False, False] and idle_modes == [True, True],
+    }
+    return {
+        "ok": all(checks.values()),
+        "checks": checks,
+        "commands": {"a": {"sent": sent_a, "accepted": acc_a}, "b": {"sent": sent_b, "accepted": acc_b},
+                     "owner_scheduler": cmds},
+        "stops": [{"source": s, "idle_ms": round(ms, 1)} for s, ms in stops],
+        "safe_mode": {"driving": driving_modes, "idle": idle_modes},
+        "safety_triggers": [s["triggers"] for s in safety],
+    }
+
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def ints(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+async def main(args) -> Dict:
+    if args.startup:
+        return {
+            "schema": REPORT_SCHEMA,
+            "ts": time.time(),
+            "git": git_rev(),
+            "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+            "startup": startup_bench(args.startup),
+        }
+    if args.workers_check:
+        res = await workers_check(args.cmd_hz)
+        failed = [k for k, v in res["checks"].items() if not v]
+        print(f"[bench] workers-check {'FAILED: ' + ', '.join(failed) if failed else 'ok'}", flush=True)
+        return {"schema": REPORT_SCHEMA, "ts": time.time(), "git": git_rev(), "workers_check": res}
+    profile = load_profiles(args.profile) if args.profile else None
+    runs = []
+    for vehicles, subscribers in itertools.product(ints(args.vehicles), ints(args.subscribers)):
+        print(f"[bench] vehicles={vehicles} subscribers={subscribers} ...", flush=True)
+        res = await run_once(args, vehicles, subscribers, profile)
+        t = res["telemetry"]
+        print(f"[bench]   latency p50={t['latency_ms'].get('p50')} p99={t['latency_ms'].get('p99')} ms"
+              f" drop={t['drop_ratio']} cpu={res['backend'].get('cpu_pct')}%", flush=True)
+        runs.append(res)
+    return {
+        "schema": REPORT_SCHEMA,
+        "ts": time.time(),
+        "git": git_rev(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "backend": args.url or "spawned",
+        "profile": {"path": args.profile, "up": profile[0].as_dict(), "down": profile[1].as_dict()} if profile else None,
+        "runs": runs,
+    }
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="ROCU-Lite backend load/latency benchmark")
+    p.add_argument("--url", help="already running backend, e.g. http://127.0.0.1:8000 (default: spawn one)")
+    p.add_argument("--vehicles", default="1", help="comma list → one run per value")
+    p.add_argument("--subscribers", default="1", help="UI /ws/telemetry clients, comma list")
+    p.add_argument("--watch", type=int, default=0, help="vehicles per subscriber (0 = all, '*')")
+    p.add_argument("--rate-hz", type=float, default=10.0, help="telemetry rate per vehicle")
+    p.add_argument("--cmd-hz", type=float, default=5.0, help="POST /cmd/drive rate (round-robin over vehicles)")
+    p.add_argument("--control", default="http", choices=("http", "ws"),
+                   help="drive commands via POST /cmd/drive or the persistent /ws/control socket")
+    p.add_argument("--starve", type=float, default=0.0,
+                   help="S: drive all vehicles for S s, then stop commanding for S s, repeat (dead-man switch test)")
+    p.add_argument("--fmt", default="json", choices=("json", "msgpack", "bin", "delta"), help="sim → backend format")
+    p.add_argument("--ui-fmt", default="json", choices=("json", "msgpack", "bin", "delta"), help="backend → UI format")
+    p.add_argument("--profile", help="net-profiles/profiles/*.conf to apply in-process on both links")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--duration", type=float, default=10.0)
+    p.add_argument("--warmup", type=float, default=2.0)
+    p.add_argument("--drain", type=float, default=1.0)
+    p.add_argument("--startup", type=int, default=0, metavar="N",
+                   help="startup benchmark instead of load: import time, time to /health and RSS, "
+                        "video lazy/off/eager, N cold starts each")
+    p.add_argument("--workers-check", action="store_true",
+                   help="two workers on one unix bus: sim on A, commands to A then B; "
+                        "checks the owner's scheduler and watchdog handle both (uses --cmd-hz)")
+    p.add_argument("--out", help="write JSON report here (default: stdout)")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+        print(f"[bench] report → {args.out}")
+    else:
+        print(text)
@@ -0,0 +1,657 @@
+"""
+Userspace-аналог net-profiles/apply_profile.sh: WebSocket/UDP-прокси, который вносит
+потери, задержку, джиттер и ограничение скорости на уровне сообщений.
+Не требует root/tc и не трогает lo — можно поднять сколько угодно прокси рядом.
+
+Читает те же профили (LOSS, DELAY_MS, JITTER_MS, RATE_KBIT); ключи с префиксом
+UP_/DOWN_ (UP_LOSS=5, DOWN_DELAY_MS=200 …) переопределяют значение для одного
+направления. up — клиент → upstream (сим → /ws/sim, UI → /ws/telemetry), down — обратно.
+
+WebSocket идёт поверх TCP, поэтому «потеря» здесь, как и у netem на TCP,
+проявляется не пропажей сообщения, а перепосылкой: задержка ~RTO и
+head-of-line blocking для следующих сообщений; порядок сохраняется.
+В UDP-режиме потеря — настоящий дроп, а джиттер может переупорядочить пакеты.
+
+  # сим → прокси :8100 → бэкенд :8000, профиль меняется по расписанию
+  python netem_proxy.py ws --listen 8100 --upstream ws://127.0.0.1:8000 \\
+      --schedule "0:../net-profiles/profiles/good.conf,20:../net-profiles/profiles/tunnel-lossy-40.conf" \\
+      --record /tmp/sim.rec.jsonl
+  BACKEND_URL=ws://127.0.0.1:8100/ws/sim python ugv_sim.py
+
+  # тот же трафик ещё раз, с записанными решениями о потерях/задержках
+  python netem_proxy.py replay /tmp/sim.rec.jsonl --upstream ws://127.0.0.1:8000
+  # или с другим профилем (детерминированно при том же --seed)
+  python netem_proxy.py replay /tmp/sim.rec.jsonl --upstream ws://127.0.0.1:8000 \
+      --profile ../net-profiles/profiles/urban-lossy-20.conf --seed 1
+"""
+import argparse
+import asyncio
+import base64
+import bisect
+import hashlib
+import heapq
+import json
+import os
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import websockets
+
+# Linux: минимальный RTO для TCP — 200 мс
+TCP_MIN_RTO_S = 0.2
+
+
+class Impairment:
+    """Параметры одного направления, как в profiles/*.conf."""
+
+    __slots__ = ("loss", "delay_ms", "jitter_ms", "rate_kbit")
+
+    def __init__(self, loss: float = 0.0, delay_ms: float = 0.0, jitter_ms: float = 0.0, rate_kbit: float = 0.0):
+        self.loss = loss            # %
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.rate_kbit = rate_kbit  # 0 — без ограничения
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, str], prefix: str = "") -> "Impairment":
+        def get(key):
+            return float(d.get(prefix + key, d.get(key, 0)) or 0)
+        return cls(loss=get("LOSS"), delay_ms=get("DELAY_MS"), jitter_ms=get("JITTER_MS"), rate_kbit=get("RATE_KBIT"))
+
+    def as_dict(self) -> Dict[str, float]:
+        return {"loss": self.loss, "delay_ms": self.delay_ms, "jitter_ms": self.jitter_ms, "rate_kbit": self.rate_kbit}
+
+
+def parse_profile(path: str) -> Dict[str, str]:
+    """KEY=VALUE из shell-профиля; закомментированные строки (# RATE_KBIT=...) пропускаются."""
+    out: Dict[str, str] = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            k, v = line.split("=", 1)
+            out[k.strip()] = v.split("#", 1)[0].strip().strip('"\'')
+    return out
+
+
+def load_profile(path: str) -> Impairment:
+    return Impairment.from_dict(parse_profile(path))
+
+
+def load_profiles(path: str) -> Tuple[Impairment, Impairment]:
+    """(up, down) с учётом UP_*/DOWN_* переопределений."""
+    d = parse_profile(path)
+    return Impairment.from_dict(d, "UP_"), Impairment.from_dict(d, "DOWN_")
+
+
+class Schedule:
+    """
+    Смена профиля во времени: [(t_s, up, down), ...] от старта прокси.
+    Текстом: "0:good.conf,20:tunnel-lossy-40.conf" или файл со строками "T_S path.conf"
+    (пути — относительно файла расписания).
+    """
+
+    def __init__(self, stages: List[Tuple[float, str, Impairment, Impairment]]):
+        self.stages = sorted(stages, key=lambda s: s[0])
+
+    @classmethod
+    def parse(cls, spec: str) -> "Schedule":
+        if os.path.isfile(spec):
+            base = os.path.dirname(os.path.abspath(spec))
+            items = []
+            with open(spec) as f:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        t, path = line.split(None, 1)
+                        items.append((t, os.path.join(base, path)))
+        else:
+            items = [item.split(":", 1) for item in spec.split(",") if item.strip()]
+        stages = []
+        for t, path in items:
+            up, down = load_profiles(path.strip())
+            stages.append((float(t), os.path.basename(path.strip()), up, down))
+        return cls(stages)
+
+    def at(self, t: float):
+        i = bisect.bisect_right([s[0] for s in self.stages], t) - 1
+        return self.stages[max(0, i)]
+
+
+class Direction:
+    """Текущие параметры направления; общий объект для всех соединений прокси."""
+
+    __slots__ = ("name", "imp")
+
+    def __init__(self, name: str, imp: Impairment):
+        self.name = name
+        self.imp = imp
+
+
+class LinkStats:
+    __slots__ = ("messages", "bytes", "delivered", "retransmits", "dropped", "max_queued", "added_ms")
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.delivered = 0
+        self.retransmits = 0  # TCP: «потерянное» сообщение ушло после RTO
+        self.dropped = 0      # UDP: пакет выброшен
+        self.max_queued = 0
+        self.added_ms: List[float] = []  # внесённая задержка на сообщение
+
+    def as_dict(self) -> Dict:
+        xs = sorted(self.added_ms)
+        n = len(xs)
+
+        def q(p):
+            return round(xs[min(n - 1, int(p * n))], 3) if n else None
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "delivered": self.delivered,
+            "retransmits": self.retransmits,
+            "dropped": self.dropped,
+            "max_queued": self.max_queued,
+            "added_delay_ms": {"p50": q(0.5), "p95": q(0.95), "p99": q(0.99), "max": round(xs[-1], 3) if n else None},
+        }
+
+    def merge(self, other: "LinkStats"):
+        for k in ("messages", "bytes", "delivered", "retransmits", "dropped"):
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+        self.max_queued = max(self.max_queued, other.max_queued)
+        self.added_ms.extend(other.added_ms)
+
+
+class ImpairedLink:
+    """
+    Одно направление одного соединения: сообщение получает момент доставки
+    (задержка + джиттер + сериализация на RATE_KBIT + RTO или дроп при «потере»).
+    ordered=True (TCP/WebSocket) — отдельная задача отдаёт по порядку;
+    ordered=False (UDP) — каждый пакет по своему таймеру, возможен reorder.
+    """
+
+    def __init__(self, direction: Direction, send: Callable, rng: random.Random,
+                 ordered: bool = True, recorder: Optional["Recorder"] = None, conn: int = 0):
+        self.dir = direction
+        self.send = send
+        self.rng = rng
+        self.ordered = ordered
+        self.recorder = recorder
+        self.conn = conn
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._busy_until = 0.0
+        self._last_due = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._inflight = 0
+        self.stats = LinkStats()
+
+    def start(self):
+        if self.ordered:
+            self._task = asyncio.create_task(self._pump())
+
+    def schedule(self, size: int, now: float) -> Optional[float]:
+        """Момент доставки сообщения размера size, пришедшего в now; None — потерян (UDP)."""
+        imp, st = self.dir.imp, self.stats
+        base = now
+        if imp.rate_kbit > 0:
+            # канал занят отправкой предыдущих сообщений
+            start = max(now, self._busy_until)
+            self._busy_until = start + size * 8 / (imp.rate_kbit * 1000.0)
+            base = self._busy_until
+        delay = imp.delay_ms
+        if imp.jitter_ms:
+            delay += self.rng.uniform(-imp.jitter_ms, imp.jitter_ms)
+        due = base + max(0.0, delay) / 1000.0
+        if imp.loss and self.rng.random() * 100.0 < imp.loss:
+            if not self.ordered:
+                st.dropped += 1
+                return None
+            st.retransmits += 1
+            due += max(TCP_MIN_RTO_S, 2 * imp.delay_ms / 1000.0)
+        if self.ordered:
+            # TCP не переупорядочивает: не раньше предыдущего
+            due = max(due, self._last_due)
+            self._last_due = due
+        st.added_ms.append((due - now) * 1000.0)
+        return due
+
+    def push(self, msg):
+        now = time.monotonic()
+        st = self.stats
+        st.messages += 1
+        st.bytes += len(msg)
+        due = self.schedule(len(msg), now)
+        if self.recorder is not None:
+            self.recorder.write(self.conn, self.dir.name, msg, now, due)
+        if due is None:
+            return
+        if self.ordered:
+            self.queue.put_nowait((due, msg))
+            st.max_queued = max(st.max_queued, self.queue.qsize())
+        else:
+            self._inflight += 1
+            st.max_queued = max(st.max_queued, self._inflight)
+            asyncio.get_running_loop().call_at(self._loop_time(due), self._deliver_now, msg)
+
+    @staticmethod
+    def _loop_time(due_mono: float) -> float:
+        loop = asyncio.get_running_loop()
+        return loop.time() + (due_mono - time.monotonic())
+
+    def _deliver_now(self, msg):
+        self._inflight -= 1
+        self.send(msg)
+        self.stats.delivered += 1
+
+    async def _pump(self):
+        while True:
+            due, msg = await self.queue.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.send(msg)
+            self.stats.delivered += 1
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+def link_rng(seed: Optional[int], conn: int, direction: str) -> random.Random:
+    # свой RNG на соединение и направление: решения не зависят от чередования соединений,
+    # поэтому запись проигрывается детерминированно
+    return random.Random(None if seed is None else f"{seed}:{conn}:{direction}")
+
+
+class Recorder:
+    """
+    Запись трафика в JSONL: по строке на событие.
+      {"ev":"open","conn":1,"t":0.01,"path":"/ws/sim?vehicle=a"}
+      {"ev":"msg","conn":1,"dir":"up","t":0.12,"due":0.16,"text":"..."}  (или "b64" для bytes)
+      {"ev":"close","conn":1,"t":9.9}
+    t/due — секунды от старта прокси; due=null — пакет потерян.
+    """
+
+    def __init__(self, path: str, t0: float):
+        self.path = path
+        self.t0 = t0
+        self._f = open(path, "w", buffering=1 << 16)
+
+    def _line(self, obj: Dict):
+        self._f.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+    def open(self, conn: int, path: str):
+        self._line({"ev": "open", "conn": conn, "t": round(time.monotonic() - self.t0, 6), "path": path})
+
+    def close_conn(self, conn: int):
+        self._line({"ev": "close", "conn": conn, "t": round(time.monotonic() - self.t0, 6)})
+
+    def write(self, conn: int, direction: str, msg, now: float, due: Optional[float]):
+        rec = {"ev": "msg", "conn": conn, "dir": direction, "t": round(now - self.t0, 6),
+               "due": None if due is None else round(due - self.t0, 6)}
+        if isinstance(msg, str):
+            rec["text"] = msg
+        else:
+            rec["b64"] = base64.b64encode(msg).decode()
+        self._line(rec)
+
+    def close(self):
+        self._f.close()
+
+
+class _ProxyBase:
+    def __init__(self, up: Impairment, down: Optional[Impairment], host: str, port: int,
+                 seed: Optional[int], schedule: Optional[Schedule], record: Optional[str]):
+        self.up = Direction("up", up)
+        self.down = Direction("down", down if down is not None else up)
+        self.host = host
+        self.port = port
+        self.seed = seed
+        self.schedule = schedule
+        self.stage: Optional[str] = None
+        self.t0 = time.monotonic()
+        self.recorder = Recorder(record, self.t0) if record else None
+        self.links: List[Tuple[int, ImpairedLink, ImpairedLink]] = []
+        self._next_conn = 1
+        self._sched_task: Optional[asyncio.Task] = None
+
+    def set_impairment(self, up: Impairment, down: Optional[Impairment] = None):
+        # применяется сразу ко всем живым соединениям
+        self.up.imp = up
+        self.down.imp = down if down is not None else up
+
+    def _start_schedule(self):
+        if self.schedule and self.schedule.stages:
+            self._sched_task = asyncio.create_task(self._run_schedule())
+
+    async def _run_schedule(self):
+        for t, name, up, down in self.schedule.stages:
+            wait = self.t0 + t - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.set_impairment(up, down)
+            self.stage = name
+            print(f"[netem] t={t:.1f}s → {name}: up={up.as_dict()} down={down.as_dict()}")
+
+    def _new_conn(self) -> int:
+        conn = self._next_conn
+        self._next_conn += 1
+        return conn
+
+    async def _close_base(self):
+        if self._sched_task:
+            self._sched_task.cancel()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def stats(self) -> Dict:
+        total = {"up": LinkStats(), "down": LinkStats()}
+        per_conn = []
+        for conn, up, down in self.links:
+            total["up"].merge(up.stats)
+            total["down"].merge(down.stats)
+            per_conn.append({"conn": conn, "up": up.stats.as_dict(), "down": down.stats.as_dict()})
+        return {
+            "connections": len(self.links),
+            "stage": self.stage,
+            "impairment": {"up": self.up.imp.as_dict(), "down": self.down.imp.as_dict()},
+            "up": total["up"].as_dict(),
+            "down": total["down"].as_dict(),
+            "per_connection": per_conn,
+        }
+
+
+class WsProxy(_ProxyBase):
+    """ws://host:port/<path?query> → upstream/<path?query>."""
+
+    def __init__(self, upstream: str, up: Impairment, down: Optional[Impairment] = None,
+                 host: str = "127.0.0.1", port: int = 0, seed: Optional[int] = None,
+                 schedule: Optional[Schedule] = None, record: Optional[str] = None):
+        super().__init__(up, down, host, port, seed, schedule, record)
+        self.upstream = upstream.rstrip("/")
+        self._server = None
+
+    async def start(self) -> "WsProxy":
+        self._server = await websockets.serve(self._handle, self.host, self.port, max_size=None)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._start_schedule()
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def _handle(self, client):
+        path = client.request.path if getattr(client, "request", None) else getattr(client, "path", "/")
+        conn = self._new_conn()
+        if self.recorder:
+            self.recorder.open(conn, path)
+        async with websockets.connect(self.upstream + path, ping_interval=None, max_size=None) as server:
+            up = ImpairedLink(self.up, server.send, link_rng(self.seed, conn, "up"), recorder=self.recorder, conn=conn)
+            down = ImpairedLink(self.down, client.send, link_rng(self.seed, conn, "down"), recorder=self.recorder, conn=conn)
+            self.links.append((conn, up, down))
+            up.start()
+            down.start()
+
+            async def pipe(src, link):
+                try:
+                    async for msg in src:
+                        link.push(msg)
+                except websockets.ConnectionClosed:
+                    pass
+
+            tasks = [asyncio.create_task(pipe(client, up)), asyncio.create_task(pipe(server, down))]
+            try:
+                # любая сторона закрылась — закрываем обе
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await up.close()
+                await down.close()
+                if self.recorder:
+                    self.recorder.close_conn(conn)
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        await self._close_base()
+
+
+class _UdpUpstream(asyncio.DatagramProtocol):
+    def __init__(self, on_reply: Callable):
+        self.on_reply = on_reply
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_reply(data)
+
+
+class UdpProxy(_ProxyBase, asyncio.DatagramProtocol):
+    """
+    UDP-релей: host:port → upstream_host:upstream_port. На каждый адрес клиента —
+    свой сокет к upstream (как NAT), ответы идут обратно тому же клиенту.
+    """
+
+    def __init__(self, upstream_host: str, upstream_port: int, up: Impairment, down: Optional[Impairment] = None,
+                 host: str = "127.0.0.1", port: int = 0, seed: Optional[int] = None,
+                 schedule: Optional[Schedule] = None, record: Optional[str] = None):
+        super().__init__(up, down, host, port, seed, schedule, record)
+        self.upstream_addr = (upstream_host, upstream_port)
+        self.transport = None
+        self.clients: Dict[Tuple, Tuple[ImpairedLink, "_UdpUpstream"]] = {}
+        self._pending: Dict[Tuple, List[bytes]] = {}
+
+    async def start(self) -> "UdpProxy":
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info("sockname")[1]
+        self._start_schedule()
+        return self
+
+    def datagram_received(self, data, addr):
+        entry = self.clients.get(addr)
+        if entry is not None:
+            entry[0].push(data)
+            return
+        pending = self._pending.get(addr)
+        if pending is not None:
+            pending.append(data)  # upstream-сокет ещё открывается
+            return
+        self._pending[addr] = [data]
+        asyncio.ensure_future(self._open_client(addr))
+
+    async def _open_client(self, addr):
+        loop = asyncio.get_running_loop()
+        conn = self._new_conn()
+        if self.recorder:
+            self.recorder.open(conn, f"udp:{addr[0]}:{addr[1]}")
+        down = ImpairedLink(self.down, lambda m: self.transport.sendto(m, addr),
+                            link_rng(self.seed, conn, "down"), ordered=False, recorder=self.recorder, conn=conn)
+        transport, proto = await loop.create_datagram_endpoint(
+            lambda: _UdpUpstream(down.push), remote_addr=self.upstream_addr)
+        up = ImpairedLink(self.up, transport.sendto, link_rng(self.seed, conn, "up"),
+                          ordered=False, recorder=self.recorder, conn=conn)
+        self.clients[addr] = (up, proto)
+        self.links.append((conn, up, down))
+        for data in self._pending.pop(addr, []):
+            up.push(data)
+
+    async def close(self):
+        for _, proto in self.clients.values():
+            if proto.transport:
+                proto.transport.close()
+        if self.transport:
+            self.transport.close()
+        await self._close_base()
+
+
+# --- детерминированное воспроизведение записи --------------------------------
+
+def load_recording(path: str) -> Dict[int, Dict]:
+    """conn → {"path": ..., "up": [(t, msg), ...], "due": [...]} — только то, что слал клиент."""
+    conns: Dict[int, Dict] = {}
+    with open(path) as f:
+        for line in f:
+            ev = json.loads(line)
+            c = conns.setdefault(ev["conn"], {"path": "/", "up": [], "due": []})
+            if ev["ev"] == "open":
+                c["path"] = ev["path"]
+                c["t_open"] = ev["t"]
+            elif ev["ev"] == "msg" and ev["dir"] == "up":
+                msg = ev["text"] if "text" in ev else base64.b64decode(ev["b64"])
+                c["up"].append((ev["t"], msg))
+                c["due"].append(ev["due"])
+    return conns
+
+
+def plan(conns: Dict[int, Dict], imp: Impairment, seed: Optional[int], ordered: bool = True) -> Dict[int, List]:
+    """
+    Расписание доставки без сети: conn → [(t_arrive, t_due | None), ...].
+    При том же seed и профиле совпадает с тем, что сделал бы прокси, — основа
+    для сравнения сценариев и проверки детерминизма.
+    """
+    out = {}
+    for conn, c in conns.items():
+        link = ImpairedLink(Direction("up", imp), None, link_rng(seed, conn, "up"), ordered=ordered)
+        # ImpairedLink считает в monotonic; для плана время — из записи
+        out[conn] = [(t, link.schedule(len(m), t)) for t, m in c["up"]]
+    return out
+
+
+def schedule_digest(schedule: Dict[int, List]) -> str:
+    # одинаковый digest = одинаковые решения о потерях/задержках
+    return hashlib.sha256(json.dumps(schedule, sort_keys=True).encode()).hexdigest()[:16]
+
+
+async def replay(path: str, upstream: str, imp: Optional[Impairment] = None, seed: Optional[int] = None,
+                 speed: float = 1.0) -> Dict:
+    """
+    Проиграть записанные клиентом сообщения в upstream с исходными интервалами
+    (ускорение speed). imp=None — ровно с записанными решениями (due/потери),
+    иначе — заново через модель искажений с seed. Ответы upstream только считаются.
+    """
+    conns = load_recording(path)
+    if imp is None:
+        schedule = {conn: [(t, due) for (t, _), due in zip(c["up"], c["due"])] for conn, c in conns.items()}
+    else:
+        schedule = plan(conns, imp, seed)
+    upstream = upstream.rstrip("/")
+    t0 = time.monotonic()
+    result: Dict[int, Dict] = {}
+
+    async def one(conn: int, c: Dict):
+        sent = received = 0
+        heap = []
+        for (t, msg), (_, due) in zip(c["up"], schedule[conn]):
+            if due is not None:
+                heapq.heappush(heap, (due, len(heap), msg))
+        await asyncio.sleep(max(0.0, c.get("t_open", 0.0) / speed - (time.monotonic() - t0)))
+        async with websockets.connect(upstream + c["path"], ping_interval=None, max_size=None) as ws:
+            async def drain():
+                nonlocal received
+                async for _ in ws:
+                    received += 1
+            reader = asyncio.create_task(drain())
+            while heap:
+                due, _, msg = heapq.heappop(heap)
+                await asyncio.sleep(max(0.0, due / speed - (time.monotonic() - t0)))
+                await ws.send(msg)
+                sent += 1
+            await asyncio.sleep(0.5)
+            reader.cancel()
+        result[conn] = {"path": c["path"], "sent": sent, "received": received}
+
+    await asyncio.gather(*(one(conn, c) for conn, c in conns.items()))
+    return {"connections": result, "schedule_digest": schedule_digest(schedule)}
+
+
+# --- CLI ---------------------------------------------------------------------
+
+def _impairments(args) -> Tuple[Impairment, Impairment]:
+    up, down = load_profiles(args.profile) if args.profile else (Impairment(), Impairment())
+    if args.up_profile:
+        up = load_profile(args.up_profile)
+    if args.down_profile:
+        down = load_profile(args.down_profile)
+    return up, down
+
+
+async def _serve(args):
+    up, down = _impairments(args)
+    schedule = Schedule.parse(args.schedule) if args.schedule else None
+    if args.mode == "ws":
+        proxy = WsProxy(args.upstream, up, down, host=args.host, port=args.listen, seed=args.seed,
+                        schedule=schedule, record=args.record)
+    else:
+        uhost, uport = args.upstream.rsplit(":", 1)
+        proxy = UdpProxy(uhost, int(uport), up, down, host=args.host, port=args.listen, seed=args.seed,
+                         schedule=schedule, record=args.record)
+    await proxy.start()
+    print(f"[netem] {args.mode} {args.host}:{proxy.port} → {args.upstream} up={up.as_dict()} down={down.as_dict()}")
+    try:
+        while True:
+            await asyncio.sleep(args.stats_every or 3600)
+            if args.stats_every:
+                s = proxy.stats()
+                s.pop("per_connection")
+                print("[netem]", json.dumps(s))
+    finally:
+        if args.stats_out:
+            with open(args.stats_out, "w") as f:
+                json.dump(proxy.stats(), f, indent=2)
+        await proxy.close()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="In-process netem: WebSocket/UDP impairment relay")
+    sub = p.add_subparsers(dest="mode", required=True)
+    for mode in ("ws", "udp"):
+        s = sub.add_parser(mode)
+        s.add_argument("--listen", type=int, required=True)
+        s.add_argument("--host", default="127.0.0.1")
+        s.add_argument("--upstream", required=True,
+                       help="ws://host:port (ws) or host:port (udp)")
+        s.add_argument("--profile", help="profiles/*.conf for both directions (UP_/DOWN_ keys override)")
+        s.add_argument("--up-profile", help="profile for client → upstream only")
+        s.add_argument("--down-profile", help="profile for upstream → client only")
+        s.add_argument("--schedule", help='"T:profile.conf,..." or a file with "T_S profile.conf" lines')
+        s.add_argument("--seed", type=int)
+        s.add_argument("--record", help="write traffic + impairment decisions to JSONL")
+        s.add_argument("--stats-every", type=float, default=0.0, help="print aggregate stats every N s")
+        s.add_argument("--stats-out", help="write final stats JSON on exit")
+    r = sub.add_parser("replay")
+    r.add_argument("recording")
+    r.add_argument("--upstream", required=True)
+    r.add_argument("--profile")
+    r.add_argument("--up-profile")
+    r.add_argument("--down-profile")
+    r.add_argument("--seed", type=int)
+    r.add_argument("--speed", type=float, default=1.0)
+    args = p.parse_args(argv)
+
+    if args.mode == "replay":
+        # без профиля — как записано; с профилем — новая модель искажений поверх записи
+        up = _impairments(args)[0] if (args.profile or args.up_profile) else None
+        print(json.dumps(asyncio.run(replay(args.recording, args.upstream, up, args.seed, args.speed)), indent=2))
+        return
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,25 +4,212 @@ import json
 import math
 import os
 import random
+import struct
 import time
 import websockets
 
+try:  # optional: pip install msgpack
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:  # optional: pip install numpy (только для SIM_ENGINE=batch)
+    import numpy as np
+except ImportError:
+    np = None
+
 BACKEND_URL = os.getenv("BACKEND_URL", "ws://127.0.0.1:8000/ws/sim")
+# json | msgpack | bin | delta — см. backend/app/codec.py
+TELEMETRY_FMT = os.getenv("TELEMETRY_FMT", "json").strip().lower()
+# SIM_VEHICLES=N — N аппаратов в одном процессе, каждый со своим сокетом:
+# vehicle_id = VEHICLE_ID (по умолчанию бэкенд считает его "default"),
+# при N > 1 — <VEHICLE_ID или ugv>0..N-1
+SIM_VEHICLES = int(os.getenv("SIM_VEHICLES", "1"))
+VEHICLE_ID = os.getenv("VEHICLE_ID", "")
+SIM_RATE_HZ = float(os.getenv("SIM_RATE_HZ", "10"))
+# Локальный failsafe: нет drive-команд дольше SIM_FAILSAFE_S — стоп на борту,
+# независимо от сети и бэкенда (0 — выключить). Должен быть > heartbeat бэкенда.
+SIM_FAILSAFE_S = float(os.getenv("SIM_FAILSAFE_S", "1.0"))
+# SIM_ENGINE=batch — весь флот в массивах NumPy, один векторный шаг на тик и
+# мультиплексные сокеты (?mux=1) вместо сокета на аппарат; tasks — по задаче на борт
+SIM_ENGINE = os.getenv("SIM_ENGINE", "tasks").strip().lower()
+SIM_CONNECTIONS = int(os.getenv("SIM_CONNECTIONS", "1"))
+SIM_REPORT_S = float(os.getenv("SIM_REPORT_S", "5"))
+
+# Раскладка должна совпадать с backend/app/codec.py: TELEMETRY_STRUCT
+TELEMETRY_FIELDS = ("ts", "seq", "imu_ax", "imu_ay", "imu_az", "yaw", "pitch", "roll",
+                    "lat", "lon", "vx", "vy", "wz")
+TAG_TELEMETRY = 0x01
+TELEMETRY_STRUCT = struct.Struct("<BdI6f2d3f")
+# мультиплекс: u8 tag=0x02 | u8 len | vehicle_id | тело как выше без тега
+TAG_TELEMETRY_V = 0x02
+
+
+# delta: ключевой кадр + квантованные дельты от него (раскладка — backend/app/codec.py).
+# Шаги квантования сим берёт из hello бэкенда.
+TAG_DELTA_KEY = 0x03
+TAG_DELTA = 0x04
+DELTA_KEYFRAME_EVERY = int(os.getenv("TELEMETRY_KEYFRAME_EVERY", "20"))
+
+
+def _put_varint(out: bytearray, v: int):
+    v = (v << 1) ^ (v >> 63)
+    while v > 0x7F:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+
+
+def _get_varint(buf, pos: int):
+    v = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (v >> 1) ^ -(v & 1), pos
+        shift += 7
+
+
+class DeltaEncoder:
+    def __init__(self, quant: dict, keyframe_every: int = DELTA_KEYFRAME_EVERY):
+        self.steps = [quant[f] for f in TELEMETRY_FIELDS]
+        self.keyframe_every = max(1, keyframe_every)
+        self.key_id = 0
+        self.key_q = None
+        self.since_key = 0
+        self.force_key = False  # бэкенд прислал resync
+
+    def encode(self, frame: dict, vehicle_id: str = "") -> bytes:
+        # vehicle_id — только в мультиплексном сокете; иначе аппарат известен по сокету
+        q = [round(frame[f] / st) for f, st in zip(TELEMETRY_FIELDS, self.steps)]
+        vid = vehicle_id.encode()
+        if self.key_q is None or self.force_key or self.since_key >= self.keyframe_every:
+            self.key_id = (self.key_id + 1) & 0xFF
+            self.key_q, self.since_key, self.force_key = q, 0, False
+            out = bytearray((TAG_DELTA_KEY, len(vid))) + vid
+            out.append(self.key_id)
+            for v in q:
+                _put_varint(out, v)
+            return bytes(out)
+        self.since_key += 1
+        body = bytearray()
+        mask = 0
+        for i, (v, k) in enumerate(zip(q, self.key_q)):
+            if v != k:
+                mask |= 1 << i
+                _put_varint(body, v - k)
+        return bytes((TAG_DELTA, len(vid))) + vid + bytes((self.key_id, mask & 0xFF, mask >> 8)) + body
+
+
+class DeltaDecoder:
+    """Декодер delta-потока одного аппарата (нужен bench.py для UI-стороны)."""
+
+    def __init__(self, quant: dict):
+        self.steps = [quant[f] for f in TELEMETRY_FIELDS]
+        self.key_id = None
+        self.key_q = None
 
-async def run_sim():
+    def decode(self, raw):
+        """(vehicle_id, data) или None, если дельта к неизвестному ключевому кадру."""
+        n = raw[1]
+        vid = bytes(raw[2:2 + n]).decode() if n else None
+        key_id, pos = raw[2 + n], 3 + n
+        if raw[0] == TAG_DELTA_KEY:
+            q = []
+            for _ in TELEMETRY_FIELDS:
+                v, pos = _get_varint(raw, pos)
+                q.append(v)
+            self.key_id, self.key_q = key_id, q
+        else:
+            if key_id != self.key_id:
+                return None
+            mask = raw[pos] | (raw[pos + 1] << 8)
+            pos += 2
+            q = list(self.key_q)
+            for i in range(len(q)):
+                if mask >> i & 1:
+                    dv, pos = _get_varint(raw, pos)
+                    q[i] += dv
+        return vid, {f: v * st for f, v, st in zip(TELEMETRY_FIELDS, q, self.steps)}
+
+
+def with_param(url: str, key: str, value: str) -> str:
+    return url + ("&" if "?" in url else "?") + key + "=" + value
+
+
+def with_fmt(url: str, fmt: str) -> str:
+    if fmt == "json":
+        return url
+    return with_param(url, "fmt", fmt)
+
+
+def encode_telemetry(frame: dict, fmt: str):
+    if fmt == "bin":
+        return TELEMETRY_STRUCT.pack(TAG_TELEMETRY, *(frame[k] for k in TELEMETRY_FIELDS))
+    if fmt == "msgpack":
+        return msgpack.packb({"type": "telemetry", "data": frame}, use_bin_type=True)
+    return json.dumps({"type": "telemetry", "data": frame})
+
+
+async def run_sim(
+    vehicle_id: str = "",
+    lat: float = 32.0853,
+    lon: float = 34.7818,
+    verbose: bool = True,
+    backend_url: str = None,
+    fmt: str = None,
+    rate_hz: float = SIM_RATE_HZ,
+    counters: dict = None,
+    failsafe_s: float = SIM_FAILSAFE_S,
+):
+    # backend_url/fmt/counters переопределяет bench.py (прокси, формат, счётчик отправленного)
     seq = 0
     yaw = 0.0
-    lat, lon = 32.0853, 34.7818  # TLV-ish
+    # lat, lon: старт TLV-ish; для флота — со сдвигом, чтобы борта не лежали в одной точке
     vx, vy, wz = 0.0, 0.0, 0.0
     prev_mono = time.monotonic()  # <— добавили монотонные часы
-    print(f"[sim] connecting to {BACKEND_URL}")
-    
-    async with websockets.connect(BACKEND_URL, ping_interval=10, ping_timeout=10) as ws:
-        print("[sim] connected")
+    fmt = fmt or TELEMETRY_FMT
+    if fmt == "msgpack" and msgpack is None:
+        print("[sim] msgpack not installed, falling back to json")
+        fmt = "json"
+    url = with_fmt(backend_url or BACKEND_URL, fmt)
+    if vehicle_id:
+        url = with_param(url, "vehicle", vehicle_id)
+    name = vehicle_id or "default"
+    if verbose:
+        print(f"[sim:{name}] connecting to {url}")
+    period = 1.0 / rate_hz
+
+    async with websockets.connect(url, ping_interval=10, ping_timeout=10) as ws:
+        delta = None
+        if fmt == "delta":
+            # шаги квантования задаёт бэкенд; старый бэкенд без delta ответит json
+            hello = json.loads(await ws.recv())
+            if hello.get("fmt") == "delta":
+                delta = DeltaEncoder(hello["quant"])
+            else:
+                fmt = "json"
+        if verbose:
+            print(f"[sim:{name}] connected (telemetry fmt={fmt})")
         last_cmd_ts = 0.0
+        last_cmd_mono = time.monotonic()
+        last_motion_mono = None  # последняя ненулевая команда — от неё считаем время до стопа
+
+        def record_stop(source: str):
+            nonlocal last_motion_mono
+            if last_motion_mono is None:
+                return
+            idle_ms = (time.monotonic() - last_motion_mono) * 1000.0
+            last_motion_mono = None
+            if counters is not None:
+                counters.setdefault("stops", []).append((source, idle_ms))
+            if verbose:
+                print(f"[sim:{name}] stop ({source}) {idle_ms:.0f} ms after last motion command")
 
         async def sender():
             nonlocal prev_mono, seq, yaw, lat, lon, vx, vy, wz
+            next_tick = time.monotonic()
             while True:
 
                 # integrate yaw and position a bit (toy model)
@@ -57,11 +244,29 @@ async def run_sim():
                     "wz": wz,
                 }
                 seq += 1
-                await ws.send(json.dumps({"type": "telemetry", "data": frame}))
-                await asyncio.sleep(0.1)  # ~10 Hz
+                payload = delta.encode(frame) if delta is not None else encode_telemetry(frame, fmt)
+                await ws.send(payload)
+                if counters is not None:
+                    counters["sent"] = counters.get("sent", 0) + 1
+                    counters["bytes"] = counters.get("bytes", 0) + len(payload)
+                # шаг по дедлайну: частота не плывёт от времени отправки
+                next_tick += period
+                await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+        async def failsafe():
+            nonlocal vx, vy, wz
+            while True:
+                if vx or vy or wz:
+                    left = last_cmd_mono + failsafe_s - time.monotonic()
+                    if left > 0:
+                        await asyncio.sleep(left)
+                        continue
+                    vx = vy = wz = 0.0
+                    record_stop("failsafe")
+                await asyncio.sleep(failsafe_s / 4)
 
         async def receiver():
-            nonlocal vx, vy, wz, last_cmd_ts
+            nonlocal vx, vy, wz, last_cmd_ts, last_cmd_mono, last_motion_mono
             async for msg in ws:
                 try:
                     obj = json.loads(msg)
@@ -73,15 +278,285 @@ async def run_sim():
                     vy = float(data.get("vy", 0.0))
                     wz = float(data.get("wz", 0.0))
                     last_cmd_ts = time.time()
-                    print(f"[sim] drive cmd: vx={vx:.2f} vy={vy:.2f} wz={wz:.2f}")
+                    last_cmd_mono = time.monotonic()
+                    if vx or vy or wz:
+                        last_motion_mono = last_cmd_mono
+                    else:
+                        record_stop("backend")
+                    # ack с тем же id → бэкенд меряет реальный RTT
+                    if "id" in obj:
+                        await ws.send(json.dumps({"type": "ack", "id": obj["id"], "ts": last_cmd_ts}))
+                    if verbose:
+                        print(f"[sim:{name}] drive cmd: vx={vx:.2f} vy={vy:.2f} wz={wz:.2f}")
+                elif obj.get("type") == "resync" and delta is not None:
+                    # бэкенд потерял ключевой кадр — следующий кадр будет ключевым
+                    delta.force_key = True
                 else:
                     # ignore others for now
                     pass
 
-        await asyncio.gather(sender(), receiver())
+        tasks = [sender(), receiver()]
+        if failsafe_s > 0:
+            tasks.append(failsafe())
+        await asyncio.gather(*tasks)
+
+
+def fleet_ids(n: int, base: str = "") -> list:
+    if n <= 1:
+        return [base]
+    return [f"{base or 'ugv'}{i}" for i in range(n)]
+
+
+async def run_fleet(n: int = SIM_VEHICLES, base: str = VEHICLE_ID):
+    ids = fleet_ids(n, base)
+    if n > 1:
+        print(f"[sim] fleet of {n}: {ids[0]}..{ids[-1]} → {BACKEND_URL}")
+    tasks = [
+        # ~10 м между бортами по долготе
+        run_sim(vid, 32.0853, 34.7818 + i * 1e-4, verbose=(n == 1))
+        for i, vid in enumerate(ids)
+    ]
+    # один отвалившийся борт не роняет остальных
+    for vid, res in zip(ids, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(res, Exception):
+            print(f"[sim:{vid or 'default'}] stopped: {res!r}")
+
+
+# --- векторный движок флота (SIM_ENGINE=batch) --------------------------------
+
+# Тело кадра TELEMETRY_STRUCT без тега как structured dtype (packed, 64 байта):
+# tobytes() всей таблицы — готовые bin-тела всех аппаратов сразу
+_BODY_FORMATS = ("<f8", "<u4") + ("<f4",) * 6 + ("<f8",) * 2 + ("<f4",) * 3
+
+
+class FleetSim:
+    """
+    Состояние всех аппаратов — массивы NumPy (yaw, lat/lon, скорости, время
+    последней команды). step() — один векторный шаг интеграции + failsafe +
+    IMU-шум пачкой для всего флота; результат — таблица кадров (structured array),
+    из которой кодируются сообщения. Стоимость тика почти не зависит от N
+    до кодирования/отправки, которые остаются по кадру на аппарат.
+    """
+
+    def __init__(self, ids, lat: float = 32.0853, lon: float = 34.7818, spacing: float = 1e-4,
+                 failsafe_s: float = SIM_FAILSAFE_S, seed=None):
+        n = len(ids)
+        self.ids = list(ids)
+        self.index = {vid: i for i, vid in enumerate(self.ids)}
+        self.failsafe_s = failsafe_s
+        self.rng = np.random.default_rng(seed)
+        self.yaw = np.zeros(n)
+        self.lat = np.full(n, lat)
+        # ~10 м между бортами по долготе, как в run_fleet
+        self.lon = lon + np.arange(n) * spacing
+        self.vx = np.zeros(n)
+        self.vy = np.zeros(n)
+        self.wz = np.zeros(n)
+        self.last_cmd = np.full(n, time.monotonic())
+        self.seq = 0
+        self.failsafe_stops = 0
+        self.frames = np.zeros(n, dtype=np.dtype(list(zip(TELEMETRY_FIELDS, _BODY_FORMATS))))
+
+    def command(self, vehicle_id: str, vx: float, vy: float, wz: float) -> bool:
+        i = self.index.get(vehicle_id)
+        if i is None:
+            return False
+        self.vx[i], self.vy[i], self.wz[i] = vx, vy, wz
+        self.last_cmd[i] = time.monotonic()
+        return True
+
+    def step(self, dt: float):
+        now = time.monotonic()
+        if self.failsafe_s > 0:
+            # локальный failsafe всего флота одной маской
+            stale = (now - self.last_cmd > self.failsafe_s) & ((self.vx != 0) | (self.vy != 0) | (self.wz != 0))
+            if stale.any():
+                self.vx[stale] = self.vy[stale] = self.wz[stale] = 0.0
+                self.failsafe_stops += int(stale.sum())
+
+        self.yaw += self.wz * dt
+        np.arctan2(np.sin(self.yaw), np.cos(self.yaw), out=self.yaw)   # [-pi, pi]
+        self.lat += (self.vx * dt) / 111111.0
+        self.lon += (self.vy * dt) / (111111.0 * np.cos(np.radians(self.lat)))
+
+        f = self.frames
+        f["ts"] = time.time()
+        f["seq"] = self.seq
+        noise = self.rng.uniform(-0.05, 0.05, (3, len(self.ids)))
+        f["imu_ax"] = noise[0]
+        f["imu_ay"] = noise[1]
+        f["imu_az"] = noise[2] + 9.81
+        f["yaw"] = self.yaw
+        f["lat"] = self.lat
+        f["lon"] = self.lon
+        f["vx"] = self.vx
+        f["vy"] = self.vy
+        f["wz"] = self.wz
+        self.seq += 1
+        return f
+
+
+class _MuxLink:
+    """Один мультиплексный сокет (?mux=1): его аппараты, кодеры delta, приём команд."""
+
+    def __init__(self, sim: FleetSim, idx, url: str, fmt: str, counters: dict, verbose: bool):
+        self.sim = sim
+        self.idx = idx                  # индексы аппаратов этого сокета в таблице кадров
+        self.url = url
+        self.fmt = fmt
+        self.counters = counters
+        self.verbose = verbose
+        self.ws = None
+        self.delta = None               # vehicle_id → DeltaEncoder
+        self.prefix = [bytes((TAG_TELEMETRY_V, len(sim.ids[i]))) + sim.ids[i].encode() for i in idx]
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, ping_interval=10, ping_timeout=10)
+        hello = json.loads(await self.ws.recv())
+        if self.fmt == "delta":
+            if hello.get("fmt") == "delta":
+                self.delta = {self.sim.ids[i]: DeltaEncoder(hello["quant"]) for i in self.idx}
+            else:
+                self.fmt = "json"
+
+    def encode(self, frames, rows) -> list:
+        ids = self.sim.ids
+        if self.fmt == "bin":
+            body = frames[self.idx].tobytes()
+            size = frames.dtype.itemsize
+            return [p + body[k * size:(k + 1) * size] for k, p in enumerate(self.prefix)]
+        if self.delta is not None:
+            return [self.delta[ids[i]].encode(rows[i], ids[i]) for i in self.idx]
+        if self.fmt == "msgpack":
+            return [msgpack.packb({"type": "telemetry", "vehicle_id": ids[i], "data": rows[i]}, use_bin_type=True)
+                    for i in self.idx]
+        return [json.dumps({"type": "telemetry", "vehicle_id": ids[i], "data": rows[i]}) for i in self.idx]
+
+    async def send(self, payloads: list):
+        for p in payloads:
+            await self.ws.send(p)
+        self.counters["sent"] = self.counters.get("sent", 0) + len(payloads)
+        self.counters["bytes"] = self.counters.get("bytes", 0) + sum(len(p) for p in payloads)
+
+    async def receiver(self):
+        async for msg in self.ws:
+            try:
+                obj = json.loads(msg)
+            except Exception:
+                continue
+            vid = obj.get("vehicle_id")
+            if obj.get("type") == "command" and obj.get("command") == "drive":
+                data = obj.get("data", {})
+                vx, vy, wz = (float(data.get(k, 0.0)) for k in ("vx", "vy", "wz"))
+                if not self.sim.command(vid, vx, vy, wz):
+                    continue
+                if "id" in obj:
+                    await self.ws.send(json.dumps({"type": "ack", "id": obj["id"], "ts": time.time()}))
+                if self.verbose:
+                    print(f"[sim:{vid}] drive cmd: vx={vx:.2f} vy={vy:.2f} wz={wz:.2f}")
+            elif obj.get("type") == "resync" and self.delta is not None and vid in self.delta:
+                self.delta[vid].force_key = True
+
+
+def _pct(xs, q: float) -> float:
+    return float(np.percentile(xs, q)) if len(xs) else 0.0
+
+
+async def run_batch(
+    n: int = SIM_VEHICLES,
+    base: str = VEHICLE_ID,
+    rate_hz: float = SIM_RATE_HZ,
+    connections: int = SIM_CONNECTIONS,
+    backend_url: str = None,
+    fmt: str = None,
+    counters: dict = None,
+    report_s: float = SIM_REPORT_S,
+    duration_s: float = 0.0,
+):
+    """
+    Флот из n аппаратов в одном процессе и одном потоке: FleetSim + connections
+    мультиплексных сокетов (аппараты раскладываются по ним по кругу).
+    counters["ticks"] — тайминги тиков (мс): step / encode / send / total;
+    раз в report_s — строка p50/p99/max и число тиков, не уложившихся в период.
+    """
+    if np is None:
+        raise RuntimeError("SIM_ENGINE=batch needs numpy (pip install numpy)")
+    fmt = fmt or TELEMETRY_FMT
+    if fmt == "msgpack" and msgpack is None:
+        print("[sim] msgpack not installed, falling back to json")
+        fmt = "json"
+    counters = counters if counters is not None else {}
+    ids = fleet_ids(n, base) if n > 1 else [base or "default"]
+    sim = FleetSim(ids)
+    connections = max(1, min(connections, n))
+    url = with_param(with_fmt(backend_url or BACKEND_URL, fmt), "mux", "1")
+    links = [_MuxLink(sim, np.arange(j, n, connections), url, fmt, counters, verbose=(n == 1))
+             for j in range(connections)]
+    for link in links:
+        await link.connect()
+    print(f"[sim] batch fleet of {n} ({ids[0]}..{ids[-1]}) @ {rate_hz:g} Hz "
+          f"over {connections} socket(s), fmt={links[0].fmt} → {url}")
+
+    period = 1.0 / rate_hz
+    ticks = counters.setdefault("ticks", {"step": [], "encode": [], "send": [], "total": []})
+    overruns = 0
+
+    async def ticker():
+        nonlocal overruns
+        prev = next_tick = time.monotonic()
+        report_at = prev + report_s
+        stop_at = prev + duration_s if duration_s > 0 else None
+        while stop_at is None or prev < stop_at:
+            t0 = time.perf_counter()
+            now = time.monotonic()
+            frames = sim.step(min(0.2, now - prev))   # страховка от больших скачков dt
+            prev = now
+            t1 = time.perf_counter()
+            # dict-кадры нужны только текстовым форматам и delta; bin кодируется из таблицы
+            rows = None
+            if any(link.fmt != "bin" for link in links):
+                cols = [frames[f].tolist() for f in TELEMETRY_FIELDS]
+                rows = [dict(zip(TELEMETRY_FIELDS, r)) for r in zip(*cols)]
+            payloads = [link.encode(frames, rows) for link in links]
+            t2 = time.perf_counter()
+            await asyncio.gather(*(link.send(p) for link, p in zip(links, payloads)))
+            t3 = time.perf_counter()
+            ticks["step"].append((t1 - t0) * 1000.0)
+            ticks["encode"].append((t2 - t1) * 1000.0)
+            ticks["send"].append((t3 - t2) * 1000.0)
+            ticks["total"].append((t3 - t0) * 1000.0)
+            if t3 - t0 > period:
+                overruns += 1
+            counters["overruns"] = overruns
+            counters["failsafe_stops"] = sim.failsafe_stops
+
+            if report_s > 0 and time.monotonic() >= report_at:
+                tot = ticks["total"][-int(report_s * rate_hz):]
+                print(f"[sim] tick ms p50={_pct(tot, 50):.2f} p99={_pct(tot, 99):.2f} max={max(tot):.2f} "
+                      f"(budget {period * 1000:.1f}; step {_pct(ticks['step'][-len(tot):], 50):.2f} "
+                      f"encode {_pct(ticks['encode'][-len(tot):], 50):.2f} send {_pct(ticks['send'][-len(tot):], 50):.2f}) "
+                      f"overruns={overruns} frames={counters.get('sent', 0)}")
+                report_at += report_s
+                for xs in ticks.values():
+                    if len(xs) > 100_000:   # долгий прогон: держим только хвост
+                        del xs[:-50_000]
+            # шаг по дедлайну; отстали больше чем на тик — не догоняем пачкой
+            next_tick = max(next_tick + period, time.monotonic())
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+    receivers = [asyncio.create_task(link.receiver()) for link in links]
+    try:
+        await ticker()
+    finally:
+        for t in receivers:
+            t.cancel()
+        for link in links:
+            await link.ws.close()
+    return counters
+
 
 if __name__ == "__main__":
     try:
-        asyncio.run(run_sim())
+        asyncio.run(run_batch() if SIM_ENGINE == "batch" else run_fleet())
     except KeyboardInterrupt:
         pass